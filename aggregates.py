@@ -0,0 +1,270 @@
+import json
+import logging
+import os
+
+from collections import deque
+from datetime import date
+from atomicfile import write_atomic
+from userindex import day_number
+
+# days of the short and long moving averages
+SHORT_WINDOW = 7
+LONG_WINDOW = 30
+
+# smoothing of the trend weight per day, like the Hacker's Diet trend line. A gap of n days
+# counts as n steps, a morning after a week away moves the trend as much as a week of mornings
+TREND_ALPHA = 0.1
+
+# rate of change is the trend's change over the short window, in kg per this many days
+RATE_DAYS = 7
+
+# mornings appended to the journal before the whole state is written again
+JOURNAL_SIZE = 100
+
+
+def week_key(day):
+    year, week, _ = date.fromordinal(day).isocalendar()
+    return "{}-W{:02d}".format(year, week)
+
+
+def month_key(day):
+    d = date.fromordinal(day)
+    return "{}-{:02d}".format(d.year, d.month)
+
+
+class Window:
+    # (day, weight, trend) of the mornings within the last <days> days, with the running sum
+    def __init__(self, days):
+        self.days = days
+        self.entries = deque()
+        self.sum = 0.0
+
+    def add(self, day, w, trend):
+        self.entries.append((day, w, trend))
+        self.sum += w
+        while self.entries[0][0] <= day - self.days:
+            self.sum -= self.entries.popleft()[1]
+
+    def mean(self):
+        if not self.entries:
+            return None
+        return self.sum / len(self.entries)
+
+    def load(self, entries):
+        for day, w, trend in entries:
+            self.entries.append((day, w, trend))
+            self.sum += w
+
+
+class Buckets:
+    # count, min, sum and max of the mornings per week or month key
+    def __init__(self, key):
+        self.key = key
+        self.buckets = {}
+
+    def add(self, day, w):
+        key = self.key(day)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            self.buckets[key] = [1, w, w, w]
+        else:
+            bucket[0] += 1
+            bucket[1] = min(bucket[1], w)
+            bucket[2] += w
+            bucket[3] = max(bucket[3], w)
+
+    # [(key, count, min, mean, max)] in key order. Called from the query API's thread, keys()
+    # copies the keys in one call while the writer may add a bucket
+    def summary(self, last=None):
+        keys = sorted(self.buckets.keys())
+        if last is not None:
+            keys = keys[-last:]
+        return [(key, self.buckets[key][0], self.buckets[key][1], self.buckets[key][2] / self.buckets[key][0],
+                 self.buckets[key][3]) for key in keys]
+
+
+class UserAggregates:
+    # Everything the screen and the exporters show about one user's morning line, updated in O(1)
+    # per morning record. Mornings come in day order, an older day than the last one is ignored
+    # (the whole thing is rebuilt from the history when it doesn't match the database).
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.last_day = None
+        self.last_time = None
+        self.last_weight = None
+        self.trend = None
+        self.short = Window(SHORT_WINDOW)
+        self.long = Window(LONG_WINDOW)
+        self.weeks = Buckets(week_key)
+        self.months = Buckets(month_key)
+
+    def add(self, record):
+        day = day_number(record)
+        if self.last_day is not None and day < self.last_day:
+            logging.warning("Aggregates of {}: morning of {} is older than {}, ignored".format(
+                self.name, date.fromordinal(day), date.fromordinal(self.last_day)))
+            return
+        w = record.w
+        if self.trend is None:
+            self.trend = w
+        else:
+            alpha = 1 - (1 - TREND_ALPHA) ** max(day - self.last_day, 1)
+            self.trend += alpha * (w - self.trend)
+        self.short.add(day, w, self.trend)
+        self.long.add(day, w, self.trend)
+        self.weeks.add(day, w)
+        self.months.add(day, w)
+        self.count += 1
+        self.last_day = day
+        self.last_time = getattr(record, 'time', None)
+        self.last_weight = w
+
+    def average(self, days=SHORT_WINDOW):
+        if days == SHORT_WINDOW:
+            return self.short.mean()
+        if days == LONG_WINDOW:
+            return self.long.mean()
+        raise ValueError("No {} day average, only {} and {}".format(days, SHORT_WINDOW, LONG_WINDOW))
+
+    # kg per RATE_DAYS of the trend over the short window, None until there are two days
+    def rate(self):
+        if not self.short.entries:
+            return None
+        first_day, _, first_trend = self.short.entries[0]
+        if self.last_day == first_day:
+            return None
+        return (self.trend - first_trend) / (self.last_day - first_day) * RATE_DAYS
+
+    def summary(self, weeks=None, months=None):
+        return {'user': self.name, 'count': self.count, 'weight': self.last_weight,
+                'date': date.fromordinal(self.last_day).isoformat() if self.last_day is not None else None,
+                'trend': self.trend, 'average_7': self.short.mean(), 'average_30': self.long.mean(),
+                'rate_per_week': self.rate(),
+                'weeks': self.weeks.summary(weeks), 'months': self.months.summary(months)}
+
+    def to_json(self):
+        return {'count': self.count, 'last_day': self.last_day, 'last_time': self.last_time,
+                'last_weight': self.last_weight, 'trend': self.trend,
+                'long': list(self.long.entries), 'weeks': self.weeks.buckets, 'months': self.months.buckets}
+
+    @staticmethod
+    def from_json(name, state):
+        user = UserAggregates(name)
+        user.count = state['count']
+        user.last_day = state['last_day']
+        user.last_time = state['last_time']
+        user.last_weight = state['last_weight']
+        user.trend = state['trend']
+        # the short window is the tail of the long one
+        user.long.load(state['long'])
+        if user.last_day is not None:
+            user.short.load(entry for entry in state['long'] if entry[0] > user.last_day - SHORT_WINDOW)
+        user.weeks.buckets = state['weeks']
+        user.months.buckets = state['months']
+        return user
+
+
+class JournalRecord:
+    # a morning read back from the journal, with the fields UserAggregates.add uses
+    def __init__(self, fields):
+        self.__dict__.update(fields)
+
+
+class Aggregates:
+    # Per user aggregates of the morning records, kept as a JSON file next to the database. Every
+    # morning is appended to <path>.journal as one JSON line, the whole state is only written
+    # again every JOURNAL_SIZE mornings (and after a rebuild), which empties the journal. On start
+    # the file and the journal are used only if every user's newest morning matches the database,
+    # otherwise it's rebuilt from the history in one pass. The journal isn't synced, a morning
+    # lost in a crash is caught by that check.
+    def __init__(self, path=None):
+        self.path = path
+        self.journal_path = path + ".journal" if path is not None else None
+        self.journaled = 0
+        self.users = {}
+        # counts the changes, like the data providers' version
+        self.version = 0
+
+    def user(self, name):
+        return self.users.get(name)
+
+    def add(self, record):
+        user = self.users.get(record.user)
+        if user is None:
+            user = self.users[record.user] = UserAggregates(record.user)
+        user.add(record)
+        self.version += 1
+
+    # a saved record, only mornings count
+    def update(self, record):
+        if not getattr(record, 'morning', False):
+            return
+        self.add(record)
+        self.append(record)
+
+    def rebuild(self, users, data):
+        self.users = {}
+        for name in users:
+            for record in sorted(data.all_mornings(name), key=lambda r: (day_number(r), r.time)):
+                self.add(record)
+        self.save()
+
+    def load(self, users, data):
+        if self.path is not None and os.path.exists(self.path):
+            try:
+                with open(self.path, 'rb') as f:
+                    state = json.load(f)
+                self.users = dict((name, UserAggregates.from_json(name, user)) for name, user in state.items())
+                self.replay()
+                self.version += 1
+                if self.matches(users, data):
+                    return
+                logging.info("Aggregates in {} are behind the database, rebuilding".format(self.path))
+            except (ValueError, KeyError, TypeError):
+                logging.error("Aggregates in {} are corrupted, rebuilding".format(self.path))
+        self.rebuild(users, data)
+
+    def matches(self, users, data):
+        for name in users:
+            user = self.users.get(name)
+            last = data.last(name)
+            if last is not None and getattr(last, 'morning', False):
+                if user is None or user.last_time != last.time:
+                    return False
+        return True
+
+    def append(self, record):
+        if self.path is None:
+            return
+        with open(self.journal_path, 'ab') as f:
+            f.write(json.dumps({'user': record.user, 'year': record.year, 'month': record.month,
+                                'day': record.day, 'w': record.w, 'time': getattr(record, 'time', None)}) + "\n")
+        self.journaled += 1
+        if self.journaled >= JOURNAL_SIZE:
+            self.save()
+
+    # the journaled mornings on top of the loaded state. A morning the state has already (a crash
+    # between writing the state and emptying the journal) is skipped, a line cut short ends it
+    def replay(self):
+        self.journaled = 0
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, 'rb') as f:
+            for line in f:
+                try:
+                    record = JournalRecord(json.loads(line))
+                except ValueError:
+                    break
+                self.journaled += 1
+                user = self.users.get(record.user)
+                if user is not None and user.last_time is not None and record.time <= user.last_time:
+                    continue
+                self.add(record)
+
+    def save(self):
+        if self.path is not None:
+            write_atomic(self.path, json.dumps(dict((name, user.to_json()) for name, user in self.users.items())))
+            if os.path.exists(self.journal_path):
+                os.remove(self.journal_path)
+            self.journaled = 0
@@ -0,0 +1,12 @@
+import os
+
+
+# replaces <path> with <data> as a whole: written and synced to a temporary file first, then
+# renamed over it, so a crash leaves either the old or the new content
+def write_atomic(path, data):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
@@ -0,0 +1,2138 @@
+#!/usr/bin/env python
+
+# Benchmarks for the scale hot paths. Runs without a board, bluetooth or display:
+#   python benchmark.py [--capture <file>] [--realtime] [name ...]
+# --capture replays a capture recorded by the scale (CAPTURE_PATH) instead of generated reports,
+# --realtime replays it at the recorded pace instead of as fast as possible
+
+import collections
+import logging
+import Queue
+import os
+import random
+import socket
+import struct
+import tempfile
+import threading
+import time
+
+from boarddecoder import BoardDecoder, BoardEvent, CALIBRATION_STEP_KG, TOP_RIGHT, BOTTOM_RIGHT, TOP_LEFT, BOTTOM_LEFT
+from boardtransport import CaptureWriter, CaptureTransport, SocketTransport
+from eventprocessor import EventProcessor
+from weightestimator import CounterEstimator, HistogramEstimator, StabilityDetector
+from wiiboard import Wiiboard
+
+# calibration as read from a real board (0kg, 17kg, 34kg rows)
+SAMPLE_CALIBRATION = [[4650, 17437, 2412, 3545],
+                      [6418, 19221, 4150, 5293],
+                      [8194, 21014, 5898, 7048]]
+
+
+def make_report(raw_tr, raw_br, raw_tl, raw_bl, buttons=0):
+    return struct.pack(">BBH4H", 0xa1, 0x32, buttons, raw_tr, raw_br, raw_tl, raw_bl) + "\x00" * 13
+
+
+# recorded-like session at 100 reports/s, a weigh-in every 1000 reports: idle board, step on with
+# overshoot, settling, standing still around ~78 kg with a little noise (long enough for the
+# stability detector to finish early), step off
+def sample_reports(count=10000, seed=1):
+    rnd = random.Random(seed)
+    zero, mid, high = SAMPLE_CALIBRATION
+    reports = []
+    weight = None
+    for i in xrange(count):
+        phase = i % 1000
+        if phase == 0:
+            weight = 78.2 + rnd.uniform(-0.3, 0.3)
+        if phase < 200 or phase > 900:
+            kg = 0.0
+        elif phase < 240:
+            kg = weight * (phase - 199) / 40.0 * (1.05 if phase > 230 else 1.0)
+        elif phase < 300:
+            kg = weight + 2.0 * (0.9 ** (phase - 240)) * (-1) ** phase + rnd.gauss(0, 0.05)
+        else:
+            kg = weight + rnd.gauss(0, 0.05)
+        # each sensor carries a quarter, CALIBRATION_STEP_KG between the calibration rows
+        load = kg / 4 / CALIBRATION_STEP_KG
+        if load <= 1:
+            raws = [zero[pos] + (mid[pos] - zero[pos]) * load for pos in xrange(4)]
+        else:
+            raws = [mid[pos] + (high[pos] - mid[pos]) * (load - 1) for pos in xrange(4)]
+        raws = [int(raw) + rnd.randint(-3, 3) for raw in raws]
+        reports.append(make_report(raws[TOP_RIGHT], raws[BOTTOM_RIGHT], raws[TOP_LEFT], raws[BOTTOM_LEFT]))
+    return reports
+
+
+# decode path as it was before the table driven decoder, kept as a baseline
+def legacy_decode(calibration, data):
+    def calc_mass(raw, pos):
+        val = 0.0
+        if raw < calibration[0][pos]:
+            return val
+        elif raw < calibration[1][pos]:
+            val = 17 * ((raw - calibration[0][pos]) / float((calibration[1][pos] - calibration[0][pos])))
+        elif raw > calibration[1][pos]:
+            val = 17 + 17 * ((raw - calibration[1][pos]) / float((calibration[2][pos] - calibration[1][pos])))
+        return val
+
+    data = data[2:12]
+    button_bytes = data[0:2]
+    data = data[2:12]
+    state = (int(button_bytes[0].encode("hex"), 16) << 8) | int(button_bytes[1].encode("hex"), 16)
+    raw_tr = (int(data[0].encode("hex"), 16) << 8) + int(data[1].encode("hex"), 16)
+    raw_br = (int(data[2].encode("hex"), 16) << 8) + int(data[3].encode("hex"), 16)
+    raw_tl = (int(data[4].encode("hex"), 16) << 8) + int(data[5].encode("hex"), 16)
+    raw_bl = (int(data[6].encode("hex"), 16) << 8) + int(data[7].encode("hex"), 16)
+    return (state, calc_mass(raw_tl, TOP_LEFT), calc_mass(raw_tr, TOP_RIGHT),
+            calc_mass(raw_bl, BOTTOM_LEFT), calc_mass(raw_br, BOTTOM_RIGHT))
+
+
+def rate(count, seconds):
+    if seconds <= 0:
+        return float('inf')
+    return count / seconds
+
+
+def report(name, count, seconds, unit="packets"):
+    print "{:<40} {:>12.0f} {}/s  ({:.3f}s for {})".format(name, rate(count, seconds), unit, seconds, count)
+
+
+def bench_decode():
+    reports = sample_reports()
+    decoder = BoardDecoder(SAMPLE_CALIBRATION)
+
+    for data in reports[:2000]:
+        expected = legacy_decode(SAMPLE_CALIBRATION, data)
+        actual = decoder.decode(data)
+        assert all(abs(a - b) < 1e-9 for a, b in zip(expected, actual)), (expected, actual)
+
+    start = time.time()
+    for data in reports:
+        legacy_decode(SAMPLE_CALIBRATION, data)
+    report("decode: legacy hex/int", len(reports), time.time() - start)
+
+    decode = decoder.decode
+    start = time.time()
+    for data in reports:
+        decode(data)
+    report("decode: struct + calibration table", len(reports), time.time() - start)
+
+    views = [memoryview(bytearray(data)) for data in reports]
+    start = time.time()
+    for data in views:
+        decode(data)
+    report("decode: struct + table, memoryview", len(views), time.time() - start)
+
+
+class CountingProcessor:
+    def __init__(self):
+        self.done = False
+        self.count = 0
+        self.board = None
+
+    def init_board(self, board):
+        self.board = board
+
+    def mass(self, event):
+        self.count += 1
+
+
+def calibration_reports(calibration):
+    words = [w for row in calibration for w in row]
+    first = struct.pack(">BBHBH8H", 0xa1, 0x21, 0, 0xf0, 0x0024, *words[0:8])
+    second = struct.pack(">BBHBH4H", 0xa1, 0x21, 0, 0x70, 0x0034, *words[8:12]) + "\x00" * 8
+    return [first, second]
+
+
+# reports are stamped 10 ms apart, the board's report rate
+def write_capture(path, reports, start=1400000000.0):
+    writer = CaptureWriter(path)
+    for i, data in enumerate(reports):
+        writer.write(data, timestamp=start + i * 0.01)
+    writer.close()
+
+
+# capture to replay: the one given with --capture or a generated one (temporary)
+def replay_capture():
+    if OPTIONS['capture']:
+        return OPTIONS['capture'], False
+    fd, path = tempfile.mkstemp(suffix=".cap")
+    os.close(fd)
+    write_capture(path, calibration_reports(SAMPLE_CALIBRATION) + sample_reports(5000))
+    return path, True
+
+
+class TimingProcessor:
+    # measures capture time from stepping on to the final weight of each measurement
+    def __init__(self, processor, clock):
+        self.processor = processor
+        self.clock = clock
+        self.stepped_on = None
+        self.times = []
+
+    @property
+    def done(self):
+        return self.processor.done
+
+    def init_board(self, board):
+        self.processor.init_board(board)
+
+    def mass(self, event):
+        measured = self.processor.measured
+        self.processor.mass(event)
+        if not measured and self.processor.measured:
+            self.stepped_on = self.clock()
+        if self.processor.done and self.stepped_on is not None:
+            self.times.append(self.clock() - self.stepped_on)
+            self.stepped_on = None
+
+
+def replay_board(transport):
+    processor = CountingProcessor()
+    board = Wiiboard(processor, transport)
+    board.connect("00:00:00:00:00:00")
+    return board, processor
+
+
+def bench_receive():
+    reports = calibration_reports(SAMPLE_CALIBRATION) + sample_reports(50000)
+    fd, path = tempfile.mkstemp(suffix=".cap")
+    os.close(fd)
+    try:
+        write_capture(path, reports)
+
+        board, processor = replay_board(CaptureTransport(path))
+        start = time.time()
+        board.receive()
+        report("receive: capture replay, recv_into", processor.count, time.time() - start)
+        print "    {}".format(board.stats)
+        assert board.decoder.table.zero == SAMPLE_CALIBRATION[0]
+    finally:
+        os.remove(path)
+
+    # SOCK_SEQPACKET keeps report boundaries like L2CAP does
+    for name, legacy in (("receive: socketpair, recv(25) + hex", True),
+                         ("receive: socketpair, recv_into ring", False)):
+        board_side, feeder_side = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+
+        def feed():
+            for data in reports:
+                feeder_side.send(data)
+            feeder_side.close()
+
+        feeder = threading.Thread(target=feed)
+        start = time.time()
+        feeder.start()
+        if legacy:
+            count = 0
+            while True:
+                data = board_side.recv(25)
+                if not data:
+                    break
+                if int(data.encode("hex")[2:4]) == 32:
+                    legacy_decode(SAMPLE_CALIBRATION, data)
+                    count += 1
+        else:
+            board, processor = replay_board(SocketTransport(board_side))
+            board.receive()
+            count = processor.count
+        feeder.join()
+        report(name, count, time.time() - start)
+        if not legacy:
+            print "    {}".format(board.stats)
+        board_side.close()
+
+
+class FlakyLink:
+    # Board stand-in for the supervisor: reports come over a SOCK_SEQPACKET pair at <rate> Hz, the
+    # link drops (its end is closed) every <drop_after> reports and the next <refuse> connects
+    # fail like a board that is still waking up. Calibration is only sent when it is read.
+    def __init__(self, reports, drop_after, refuse=2, rate=100):
+        self.reports = reports
+        self.position = 0
+        self.drop_after = drop_after
+        self.refuse = refuse
+        self.refusing = 0
+        self.interval = 1.0 / rate
+        self.pending = collections.deque()
+        self.board_side = None
+        self.feeder = None
+        self.drops = []
+        # time of the first report received on each connection
+        self.first_reports = []
+        self.received = 0
+        self.calibration_reads = 0
+        self.finished = False
+
+    def connect(self, address):
+        if self.refusing > 0:
+            self.refusing -= 1
+            raise IOError("Host is down")
+        self.board_side, feeder_side = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.received = 0
+        self.feeder = threading.Thread(target=self.feed, args=(feeder_side,))
+        self.feeder.daemon = True
+        self.feeder.start()
+        return True
+
+    def feed(self, sock):
+        sent = 0
+        while self.position < len(self.reports) and sent < self.drop_after:
+            if self.pending:
+                sock.send(self.pending.popleft())
+                continue
+            sock.send(self.reports[self.position])
+            self.position += 1
+            sent += 1
+            time.sleep(self.interval)
+        if self.position >= len(self.reports):
+            self.finished = True
+        else:
+            self.drops.append(time.time())
+            self.refusing = self.refuse
+        sock.close()
+
+    def recv_into(self, buf, nbytes):
+        size = self.board_side.recv_into(buf, nbytes)
+        if size and self.received == 0:
+            self.first_reports.append(time.time())
+        self.received += 1
+        return size
+
+    def send(self, data):
+        # read register request (0x17), answered with the two calibration blocks
+        if ord(data[1]) == 0x17:
+            self.calibration_reads += 1
+            self.pending.extend(calibration_reports(SAMPLE_CALIBRATION))
+
+    def close(self):
+        if self.board_side is not None:
+            self.board_side.close()
+            self.board_side = None
+
+
+def bench_reconnect():
+    from boardsupervisor import BoardSupervisor
+
+    link = FlakyLink(sample_reports(1000), drop_after=200)
+    processor = CountingProcessor()
+    board = Wiiboard(processor, link)
+    board.connect("00:00:00:00:00:00")
+    supervisor = BoardSupervisor(board, min_delay=0.05)
+    while True:
+        board.receive()
+        if link.finished or not supervisor.supervise():
+            break
+    board.disconnect()
+
+    gaps = [first - dropped for dropped, first in zip(link.drops, link.first_reports[1:])]
+    # the empty board reports of the trace are skipped by the idle fast path
+    assert processor.count + board.stats.idle == 1000, (processor.count, board.stats.idle)
+    assert board.decoder.table.zero == SAMPLE_CALIBRATION[0]
+    print "{:<40} {} drops, {} reconnects, {} failed attempts, calibration read {} time(s)".format(
+        "reconnect: flaky link", len(link.drops), supervisor.reconnects, supervisor.failures,
+        link.calibration_reads)
+    print "{:<40} first sample {:.0f} ms after the drop (max {:.0f} ms)".format(
+        "reconnect: link back", sum(gaps) / len(gaps) * 1000, max(gaps) * 1000)
+    print "    {}".format(board.stats)
+
+
+# receive + decode + measure with metrics off and on, then the cost of an export
+def bench_metrics():
+    import metrics
+
+    reports = calibration_reports(SAMPLE_CALIBRATION) + sample_reports(50000)
+    fd, path = tempfile.mkstemp(suffix=".cap")
+    os.close(fd)
+    try:
+        write_capture(path, reports)
+        for name in ("disabled", "enabled"):
+            if name == "enabled":
+                metrics.enable()
+            processor = EventProcessor(StubWeightProcessor(), None, HistogramEstimator(),
+                                       StabilityDetector(100, 0.15, 0.1), 0)
+            board, _ = replay(processor, path)
+            start = time.time()
+            while board.is_connected():
+                processor.reset()
+                board.receive()
+            report("metrics: replay, " + name, board.stats.decoded, time.time() - start)
+    finally:
+        os.remove(path)
+
+    # the database metrics the scale takes: the commit of a weigh-in's unit of work is timed too
+    import shutil
+    from dataprovider import WeightRecord
+    from weightlog import LogDataProvider
+    from weightprocessor import WeightProcessor, WeightProcessorConfiguration
+
+    directory = tempfile.mkdtemp(suffix="_metrics")
+    try:
+        data = LogDataProvider(os.path.join(directory, "weight.log"))
+        fill_database(data, ("Alex",), days=30)
+        data = metrics.timed(data, ("last", "all_mornings", "last_morning", "today_morning", "save"),
+                             "scale_db_seconds", "Database call latency")
+        weight_processor = WeightProcessor(data, WeightProcessorConfiguration(30, 2, 5, (0, 23)),
+                                           StaticUsers({"Alex": {'weight': 50}}))
+        for _ in xrange(3):
+            weight_processor.process(WeightRecord({'year': 2013, 'month': 1, 'day': 1, 'w': 50.2}))
+        latency = metrics.histogram("scale_db_seconds", "Database call latency")
+        print "    scale_db_seconds: {}".format(", ".join(
+            "{} {}".format(method, latency.count(method)) for method in sorted(latency.series)))
+        assert latency.count('commit') >= 3 and latency.count('write_batch') >= 3
+        data.close()
+    finally:
+        shutil.rmtree(directory)
+
+    rounds = 1000
+    start = time.time()
+    for _ in xrange(rounds):
+        metrics.REGISTRY.render()
+    report("metrics: text export", rounds, time.time() - start, "exports")
+
+
+# archive writer cost per report, then the vectorized analysis of a few months of archives
+def bench_archive():
+    import shutil
+    from boarddecoder import CalibrationTable
+    from rawarchive import SensorArchive, archive_files, blocks, load, masses, session_stats
+
+    directory = tempfile.mkdtemp(suffix="_archive")
+    try:
+        reports = sample_reports(50000)
+        decoder = BoardDecoder(SAMPLE_CALIBRATION)
+        totals = [sum(decoder.decode(data)[1:]) for data in reports]
+        # the timestamps of a recording at 100 reports/s, a weigh-in every 10 seconds
+        base = time.time()
+        times = [base + i * 0.01 for i in xrange(len(reports))]
+        archive = SensorArchive(directory)
+        start = time.time()
+        for data, total, now in zip(reports, totals, times):
+            archive.add(data, total, SAMPLE_CALIBRATION, now=now)
+        archive.close()
+        report("archive: append", len(reports), time.time() - start, "reports")
+        weighings = len(reports) / 1000
+        sessions = set()
+        for path in archive_files([directory]):
+            with open(path, 'rb') as f:
+                sessions.update(session for session, _, _, _ in blocks(f.read(), path))
+        assert len(sessions) == weighings, "{} sessions archived for {} weigh-ins".format(len(sessions), weighings)
+
+        try:
+            import numpy
+        except ImportError:
+            print "archive: analysis skipped, numpy not installed"
+            return
+        # ~90 days with a handful of weighings each: the same sessions again under other ids
+        samples = load([directory])
+        copies = 90 * 5 / max(len(numpy.unique(samples.session)), 1)
+        samples.time = numpy.concatenate([samples.time + i * 86400 for i in xrange(copies)])
+        samples.session = numpy.concatenate([samples.session + i * 86400 for i in xrange(copies)])
+        samples.block = numpy.tile(samples.block, copies)
+        samples.raw = numpy.tile(samples.raw, (copies, 1))
+
+        table = CalibrationTable(SAMPLE_CALIBRATION)
+        expected = [[table.mass(samples.raw[i][pos], pos) for pos in xrange(4)] for i in xrange(100)]
+        calibration = numpy.array(SAMPLE_CALIBRATION, numpy.float64)
+        assert numpy.allclose(masses(samples.raw[:100], calibration[0], calibration[1], calibration[2]), expected)
+
+        start = time.time()
+        stats = session_stats(samples)
+        elapsed = time.time() - start
+        assert len(stats['session']) == copies * weighings
+        assert (stats['settle_time'] > 0).all(), "a session settled on its first sample"
+        report("archive: session stats", len(samples.time), elapsed, "samples")
+        print "    {} sessions, mode {:.1f} kg, settle {:.2f}s, left {:.1%}".format(
+            len(stats['session']), stats['mode'][0], stats['settle_time'][0], stats['left'][0])
+    finally:
+        shutil.rmtree(directory)
+
+
+# raw word of a sensor carrying kg, the inverse of CalibrationTable.mass
+def sensor_raw(kg, pos):
+    zero, mid, high = [row[pos] for row in SAMPLE_CALIBRATION]
+    if kg < CALIBRATION_STEP_KG:
+        return zero + kg * (mid - zero) / CALIBRATION_STEP_KG
+    return mid + (kg - CALIBRATION_STEP_KG) * (high - mid) / CALIBRATION_STEP_KG
+
+
+# two hours at 100 Hz: the zero starts <offset> kg off and drifts <drift> kg (both for all four
+# sensors), somebody of <weight> kg stands on the board for 8 s every 10 minutes.
+# returns (report, true load) pairs
+def drifting_reports(weight=77.9, offset=-2.0, drift=1.5, seconds=7200, seed=1):
+    rnd = random.Random(seed)
+    reports = []
+    count = seconds * 100
+    for i in xrange(count):
+        load = weight if i % 60000 >= 59200 else 0.0
+        zero_kg = (offset + drift * i / float(count)) / 4
+        raws = [int(round(sensor_raw(load / 4 + zero_kg, pos))) + rnd.randint(-2, 2) for pos in xrange(4)]
+        reports.append((make_report(raws[TOP_RIGHT], raws[BOTTOM_RIGHT], raws[TOP_LEFT], raws[BOTTOM_LEFT]), load))
+    return reports
+
+
+class LastEventProcessor(CountingProcessor):
+    def __init__(self):
+        CountingProcessor.__init__(self)
+        self.total = None
+
+    def mass(self, event):
+        self.count += 1
+        self.total = event.totalWeight
+
+
+# connected board with SAMPLE_CALIBRATION already read, as after calibrate()
+def calibrated_board(processor, transport, tare=None):
+    board = Wiiboard(processor, transport)
+    board.status = "Connected"
+    for row, words in zip(board.calibration, SAMPLE_CALIBRATION):
+        row[:] = words
+    board.decoder.set_tare(tare)
+    board.decoder.update_calibration(board.calibration)
+    board.calibrated = True
+    board.update_idle_threshold()
+    return board
+
+
+def bench_tare():
+    from boarddecoder import TareTracker
+
+    reports = [(bytearray(data), load) for data, load in drifting_reports()]
+    for name, tare in (("factory zero", None),
+                       ("tracked zero", TareTracker(clock=lambda: clock[0]))):
+        clock = [0.0]
+        processor = LastEventProcessor()
+        board = calibrated_board(processor, SocketTransport(None), tare)
+        errors = []
+        start = time.time()
+        for i, (packet, load) in enumerate(reports):
+            clock[0] = i / 100.0
+            processor.total = None
+            board.dispatch(packet, memoryview(packet), len(packet))
+            if load:
+                errors.append(processor.total - load)
+        elapsed = time.time() - start
+        worst = max(errors, key=abs)
+        print "{:<40} mean error {:+.2f} kg, worst {:+.2f} kg".format(
+            "tare: " + name, sum(errors) / len(errors), worst)
+        if tare is not None:
+            print "    offsets {} kg, drift {:+.2f} kg/h".format(
+                ", ".join("{:+.2f}".format(o) for o in tare.offsets_kg()), tare.drift_rate)
+        report("tare: " + name + " dispatch", len(reports), elapsed, "reports")
+
+
+class CyclingTransport(SocketTransport):
+    # replays <reports> round robin until <count> were received, then closes
+    def __init__(self, reports, count):
+        SocketTransport.__init__(self, None)
+        self.reports = reports
+        self.count = count
+        self.position = 0
+
+    def recv_into(self, buf, nbytes):
+        if self.position >= self.count:
+            return 0
+        data = self.reports[self.position % len(self.reports)]
+        self.position += 1
+        buf[:len(data)] = data
+        return len(data)
+
+
+# CPU time of an empty board: an hour of idle reports replayed, scaled to a day
+def bench_idle():
+    from boarddecoder import TareTracker
+
+    rnd = random.Random(1)
+    zero = SAMPLE_CALIBRATION[0]
+    pool = [make_report(*[zero[pos] + rnd.randint(-3, 3) for pos in (TOP_RIGHT, BOTTOM_RIGHT, TOP_LEFT, BOTTOM_LEFT)])
+            for _ in xrange(6000)]
+    count = 3600 * 100
+    for name, fast, tare in (("full decode", False, None), ("full decode + tare", False, TareTracker()),
+                             ("idle fast path", True, None), ("idle fast path + tare", True, TareTracker())):
+        processor = EventProcessor(StubWeightProcessor(), None, HistogramEstimator(),
+                                   StabilityDetector(100, 0.15, 0.1), 0)
+        board = calibrated_board(processor, CyclingTransport(pool, count), tare)
+        processor.init_board(StubBoard())
+        if not fast:
+            board.idle_threshold = None
+        start = time.clock()
+        board.receive()
+        cpu = time.clock() - start
+        print "{:<40} {:>6.1f} CPU s per idle day, {:.1f}% of a core ({} decoded, {} idle)".format(
+            "idle: " + name, cpu * 24, cpu / 36.0, board.stats.decoded, board.stats.idle)
+
+
+def weight_samples(count, seed=1):
+    rnd = random.Random(seed)
+    return [rnd.gauss(77.9, 0.08) for _ in xrange(count)]
+
+
+# at 100 Hz the live view reads the estimate every ~50 samples (500 ms)
+def run_estimator(estimator, samples, read_every=50):
+    estimator.reset()
+    for i, value in enumerate(samples):
+        estimator.add(value)
+        if i % read_every == 0:
+            estimator.weight
+    return estimator.weight
+
+
+def bench_estimator():
+    for length in (100, 1000, 10000, 30000):
+        samples = weight_samples(length)
+        results = []
+        for name, estimator in (("counter", CounterEstimator()), ("histogram", HistogramEstimator())):
+            start = time.time()
+            results.append(run_estimator(estimator, samples))
+            report("estimator: {} {} samples".format(name, length), length, time.time() - start, "samples")
+        # ties between equally common bins may resolve differently, the count must match
+        counter = collections.Counter(round(v, 1) for v in samples)
+        assert counter[results[0]] == counter[results[1]], results
+
+
+class StubWeightProcessor:
+    def get_user_by_weight(self, w):
+        return None
+
+
+class StubBoard:
+    def set_light(self, light):
+        pass
+
+
+# 100 Hz event trace: empty board, step on with overshoot, settling, standing, step off
+def stand_trace(weight=77.9, stand_seconds=8, seed=1):
+    rnd = random.Random(seed)
+    trace = [0.3] * 50
+    for i in xrange(40):
+        trace.append(weight * (i + 1) / 40.0 * (1.05 if i > 30 else 1.0))
+    for i in xrange(60):
+        trace.append(weight + 2.0 * (0.9 ** i) * (-1) ** i + rnd.gauss(0, 0.05))
+    trace += [weight + rnd.gauss(0, 0.05) for _ in xrange(stand_seconds * 100)]
+    trace += [weight * (1 - i / 20.0) for i in xrange(20)] + [0.2] * 50
+    return [BoardEvent(w / 4, w / 4, w / 4, w / 4, False, False) for w in trace]
+
+
+# feeds the trace like the receive loop: until done, then reset and carry on with the rest
+def replay_events(processor, events):
+    finished = []
+    processor.reset()
+    for i, event in enumerate(events):
+        processor.mass(event)
+        if processor.done:
+            finished.append((i, processor.weight))
+            processor.reset()
+    return finished
+
+
+def bench_settle():
+    events = stand_trace()
+    for name, detector in (("step off", None), ("stability detector", StabilityDetector(100, 0.15, 0.1))):
+        processor = EventProcessor(StubWeightProcessor(), None, HistogramEstimator(), detector)
+        processor.init_board(StubBoard())
+        start = time.time()
+        finished = replay_events(processor, events * 10)
+        elapsed = time.time() - start
+        assert len(finished) == 10, finished
+        on_board = next(i for i, e in enumerate(events) if e.totalWeight > 10)
+        print "{:<40} final after {:.2f}s on the board, weight {}".format(
+            "settle: " + name, (finished[0][0] - on_board) / 100.0, finished[0][1])
+        report("settle: " + name + " replay", len(events) * 10, elapsed, "events")
+
+
+# one morning record per user and day plus a couple of regular ones, like years of real use
+def fill_database(provider, users=("Alex", "Olya", "Platon"), days=3 * 365, seed=1):
+    from dataprovider import WeightRecord
+    from datetime import datetime, timedelta
+
+    rnd = random.Random(seed)
+    start = datetime(2012, 1, 1, 7)
+    last = {}
+    for day in xrange(days):
+        when = start + timedelta(days=day)
+        for n, user in enumerate(users):
+            record = WeightRecord({'year': when.year, 'month': when.month, 'day': when.day, 'user': user,
+                                   'w': round(50 + 15 * n + rnd.uniform(-1, 1), 1),
+                                   'morning': True, 'last': True,
+                                   'time': int((when - datetime(1970, 1, 1)).total_seconds() * 1000) + n})
+            if user in last:
+                last[user].last = False
+                provider.save(last[user])
+            provider.save(record)
+            last[user] = record
+            for _ in xrange(rnd.randint(0, 2)):
+                provider.save(WeightRecord({'year': when.year, 'month': when.month, 'day': when.day,
+                                            'user': rnd.choice((user, 'User')), 'w': 40.0,
+                                            'morning': False, 'last': False}))
+    provider.commit()
+
+
+def time_queries(provider, users, rounds):
+    from dataprovider import WeightRecord
+
+    probe = WeightRecord({'year': 2013, 'month': 6, 'day': 1})
+    start = time.time()
+    for _ in xrange(rounds):
+        for user in users:
+            probe.user = user
+            provider.last(user)
+            provider.last_morning(probe)
+            provider.today_morning(probe)
+            provider.all_mornings(user)
+    return (time.time() - start) / (rounds * len(users))
+
+
+def bench_db():
+    import shutil
+    from dataprovider import DataProvider, CachedDataProvider
+
+    users = ("Alex", "Olya", "Platon")
+    path = tempfile.mkdtemp(suffix="_weight_db")
+    try:
+        fill_database(DataProvider(path), users)
+        for name, provider_class, rounds in (("blitzdb filter", DataProvider, 3),
+                                             ("indexed cache", CachedDataProvider, 300)):
+            start = time.time()
+            provider = provider_class(path)
+            opened = time.time() - start
+            per_weigh_in = time_queries(provider, users, rounds)
+            print "{:<40} {:>10.3f} ms per weigh-in queries (open {:.3f}s)".format(
+                "db: " + name, per_weigh_in * 1000, opened)
+    finally:
+        shutil.rmtree(path)
+
+
+def bench_storage():
+    import shutil
+    from dataprovider import DataProvider, WeightRecord
+    from weightlog import LogDataProvider
+
+    users = ("Alex", "Olya", "Platon")
+    path = tempfile.mkdtemp(suffix="_weight_storage")
+    try:
+        for name, provider in (("blitzdb", DataProvider(os.path.join(path, "db"))),
+                               ("binary log", LogDataProvider(os.path.join(path, "weight.log")))):
+            fill_database(provider, users, days=365)
+
+            # one weigh-in: clear last on the previous morning, save the new one, commit
+            rounds = 50
+            start = time.time()
+            for i in xrange(rounds):
+                previous = provider.last_morning(WeightRecord({'user': 'Alex'}))
+                previous.last = False
+                provider.save(previous)
+                provider.save(WeightRecord({'year': 2020, 'month': 1, 'day': 1 + i % 28, 'user': 'Alex',
+                                            'w': 77.0, 'morning': True, 'last': True,
+                                            'time': previous.time + 1}))
+                provider.commit()
+            write = (time.time() - start) / rounds
+
+            start = time.time()
+            if name == "blitzdb":
+                scanned = sum(1 for _ in provider.db.filter(WeightRecord, {}))
+            else:
+                scanned = sum(1 for _ in provider.iter_raw())
+            scan = time.time() - start
+            print "{:<40} {:>10.3f} ms per weigh-in write, full scan {:.3f}s ({} records)".format(
+                "storage: " + name, write * 1000, scan, scanned)
+    finally:
+        shutil.rmtree(path)
+
+
+# bytes this process handed to write() so far, None where /proc is not there
+def written_bytes():
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except IOError:
+        return None
+
+
+class FailingFile:
+    # log file whose next write fails half way, like a full disk
+    def __init__(self, f):
+        self.f = f
+
+    def write(self, data):
+        self.f.write(data[:len(data) // 2])
+        self.f.flush()
+        raise IOError("No space left on device")
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+
+class RecordingFitbit:
+    def __init__(self):
+        self.logged = []
+
+    def log_weight(self, user, weight, day=None):
+        self.logged.append((user, weight, day))
+
+
+def bench_commit():
+    import shutil
+    from dataprovider import DataProvider, CachedDataProvider, WeightRecord
+    from weightlog import LogDataProvider
+    from weightprocessor import WeightProcessor, WeightProcessorConfiguration
+
+    fsyncs = [0]
+    real_fsync = os.fsync
+
+    def counting_fsync(fd):
+        fsyncs[0] += 1
+        real_fsync(fd)
+
+    def weigh_in(provider, i, unit):
+        previous = provider.last_morning(WeightRecord({'user': 'Alex'}))
+        record = WeightRecord({'year': 2020, 'month': 1 + i // 28 % 12, 'day': 1 + i % 28, 'user': 'Alex',
+                               'w': 77.0, 'morning': True, 'last': True, 'time': previous.time + 1})
+        if unit:
+            provider.begin()
+        previous.last = False
+        provider.save(previous)
+        provider.save(record)
+        provider.commit()
+
+    users = ("Alex", "Olya", "Platon")
+    path = tempfile.mkdtemp(suffix="_weight_commit")
+    os.fsync = counting_fsync
+    try:
+        for name, factory in (("blitzdb", lambda p: DataProvider(p)),
+                              ("indexed cache", lambda p: CachedDataProvider(p)),
+                              ("binary log", lambda p: LogDataProvider(p + ".log"))):
+            for unit in (False, True):
+                provider = factory(os.path.join(path, "{}-{}".format(name.replace(" ", "-"), unit)))
+                fill_database(provider, users, days=365)
+                rounds = 50
+                fsyncs[0] = 0
+                written = written_bytes()
+                start = time.time()
+                for i in xrange(rounds):
+                    weigh_in(provider, i, unit)
+                elapsed = time.time() - start
+                if written is not None:
+                    written = "{:.0f} bytes".format((written_bytes() - written) / float(rounds))
+                print "{:<40} {:>10.3f} ms per weigh-in, {} written, {:.1f} fsyncs".format(
+                    "commit: {} {}".format(name, "unit of work" if unit else "save, save, commit"),
+                    elapsed * 1000 / rounds, written or "?", fsyncs[0] / float(rounds))
+
+        # bulk import: one unit per record, synced every <group> units
+        for group in (1, 100, 1000):
+            log = LogDataProvider(os.path.join(path, "import-{}.log".format(group)))
+            log.group_commit(group)
+            start = time.time()
+            for i in xrange(3000):
+                log.begin()
+                log.save(WeightRecord({'year': 2015, 'month': 1, 'day': 1, 'user': users[i % 3], 'w': 70.0,
+                                       'morning': False, 'last': False, 'time': i}))
+                log.commit()
+            log.close()
+            report("commit: import, group of {}".format(group), 3000, time.time() - start, "records")
+
+        # a failed write leaves neither a partial record nor a cleared last flag behind
+        log = LogDataProvider(os.path.join(path, "failing.log"))
+        fill_database(log, users, days=30)
+        size = os.path.getsize(log.path)
+        previous = log.last_morning(WeightRecord({'user': 'Alex'}))
+        log.file = FailingFile(log.file)
+        try:
+            weigh_in(log, 0, True)
+        except IOError:
+            pass
+        log.file = log.file.f
+        assert os.path.getsize(log.path) == size
+        assert previous.last and log.last_morning(WeightRecord({'user': 'Alex'})) is previous
+
+        # and the morning of a failed write never goes to fitbit, the retried one does
+        fitbit = RecordingFitbit()
+        weight_processor = WeightProcessor(log, WeightProcessorConfiguration(30, 2, 5, (0, 23)),
+                                           StaticUsers({"Alex": {'weight': 50}}), fitbit)
+        log.file = FailingFile(log.file)
+        try:
+            weight_processor.process(WeightRecord({'year': 2012, 'month': 1, 'day': 31, 'w': 50.1}))
+        except IOError:
+            pass
+        log.file = log.file.f
+        assert os.path.getsize(log.path) == size and fitbit.logged == []
+        weight_processor.process(WeightRecord({'year': 2012, 'month': 1, 'day': 31, 'w': 50.1}))
+        assert fitbit.logged == [('Alex', 50.1, '2012-01-31')]
+        log.close()
+        assert LogDataProvider(log.path).count == log.count
+        print "{:<40} failed write rolled back, log, index and fitbit unchanged".format("commit: rollback")
+    finally:
+        os.fsync = real_fsync
+        shutil.rmtree(path)
+
+
+# the aggregates of one user computed from the whole morning list, as a reader without them would
+def scan_aggregates(mornings):
+    from aggregates import SHORT_WINDOW, LONG_WINDOW, TREND_ALPHA, week_key
+    from userindex import day_number
+
+    days = [day_number(r) for r in mornings]
+    trend = None
+    trends = []
+    for i, r in enumerate(mornings):
+        trend = r.w if trend is None else trend + (1 - (1 - TREND_ALPHA) ** max(days[i] - days[i - 1], 1)) * (r.w - trend)
+        trends.append(trend)
+    short = [r.w for d, r in zip(days, mornings) if d > days[-1] - SHORT_WINDOW]
+    long = [r.w for d, r in zip(days, mornings) if d > days[-1] - LONG_WINDOW]
+    weeks = {}
+    for d, r in zip(days, mornings):
+        weeks.setdefault(week_key(d), []).append(r.w)
+    return trend, sum(short) / len(short), sum(long) / len(long), \
+        dict((k, (len(v), min(v), sum(v) / len(v), max(v))) for k, v in weeks.items())
+
+
+def bench_aggregates():
+    import shutil
+    from aggregates import Aggregates
+    from weightlog import LogDataProvider
+
+    users = ("Alex", "Olya", "Platon")
+    path = tempfile.mkdtemp(suffix="_aggregates")
+    try:
+        data = LogDataProvider(os.path.join(path, "weight.log"))
+        fill_database(data, users, days=5 * 365)
+        mornings = dict((user, data.all_mornings(user)) for user in users)
+        count = sum(len(m) for m in mornings.values())
+
+        aggregates = Aggregates()
+        start = time.time()
+        for user in users:
+            for record in mornings[user]:
+                aggregates.add(record)
+        report("aggregates: incremental add", count, time.time() - start, "records")
+
+        # what every weigh-in would cost without them: the user's mornings scanned again
+        rounds = 20
+        start = time.time()
+        for _ in xrange(rounds):
+            for user in users:
+                expected = scan_aggregates(data.all_mornings(user))
+        scan = (time.time() - start) / (rounds * len(users))
+        start = time.time()
+        for _ in xrange(rounds * 100):
+            for user in users:
+                aggregates.user(user).summary(weeks=8, months=12)
+        read = (time.time() - start) / (rounds * 100 * len(users))
+        print "{:<40} {:>10.3f} ms scanning {} mornings, {:.3f} ms reading the aggregates".format(
+            "aggregates: per weigh-in", scan * 1000, len(mornings[users[-1]]), read * 1000)
+
+        trend, short, long, weeks = expected
+        user = aggregates.user(users[-1])
+        assert abs(user.trend - trend) < 1e-6 and abs(user.average(7) - short) < 1e-6
+        assert abs(user.average(30) - long) < 1e-6
+        for key, (n, low, mean, high) in weeks.items():
+            bucket = user.weeks.buckets[key]
+            assert (bucket[0], bucket[1], bucket[3]) == (n, low, high) and abs(bucket[2] / n - mean) < 1e-6
+
+        # one pass rebuild from the history, then saved and loaded again without rebuilding
+        aggregates_path = os.path.join(path, "aggregates.json")
+        rebuilt = Aggregates(aggregates_path)
+        start = time.time()
+        rebuilt.rebuild(users, data)
+        report("aggregates: rebuild + save", count, time.time() - start, "records")
+        loaded = Aggregates(aggregates_path)
+        start = time.time()
+        loaded.load(users, data)
+        report("aggregates: load", count, time.time() - start, "records")
+        for user in users:
+            a = aggregates.user(user).summary()
+            b = loaded.user(user).summary()
+            assert all(abs(a[k] - b[k]) < 1e-9 for k in ('trend', 'average_7', 'average_30', 'rate_per_week'))
+            assert [list(x) for x in a['weeks']] == [list(x) for x in b['weeks']]
+        print "{:<40} file of {} bytes".format("aggregates: persisted", os.path.getsize(aggregates_path))
+
+        # every morning of the history as it comes in: the state written every time, or journaled
+        ordered = sorted((r for user in users for r in mornings[user]), key=lambda r: r.time)
+        rewritten = Aggregates(os.path.join(path, "rewritten.json"))
+        start = time.time()
+        for record in ordered[:1000]:
+            rewritten.add(record)
+            rewritten.save()
+        report("aggregates: update, state rewritten", 1000, time.time() - start, "mornings")
+        journaled = Aggregates(os.path.join(path, "journaled.json"))
+        start = time.time()
+        for record in ordered:
+            journaled.update(record)
+        report("aggregates: update, journaled", len(ordered), time.time() - start, "mornings")
+        replayed = Aggregates(journaled.path)
+        replayed.load(users, data)
+        assert replayed.journaled == journaled.journaled > 0
+        for user in users:
+            a = aggregates.user(user).summary()
+            b = replayed.user(user).summary()
+            assert all(abs(a[k] - b[k]) < 1e-9 for k in ('trend', 'average_7', 'average_30', 'rate_per_week'))
+            assert [list(x) for x in a['weeks']] == [list(x) for x in b['weeks']]
+    finally:
+        shutil.rmtree(path)
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+class HoldTimingLock:
+    # a lock remembering the longest time it was held
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.acquired = None
+        self.longest = 0.0
+
+    def __enter__(self):
+        self.lock.acquire()
+        self.acquired = time.time()
+
+    def __exit__(self, *args):
+        self.longest = max(self.longest, time.time() - self.acquired)
+        self.lock.release()
+
+
+def bench_compaction():
+    import json
+    import shutil
+    from compaction import Compactor
+    from dataprovider import DataProvider, CachedDataProvider, WeightRecord
+
+    users = ("Alex", "Olya", "Platon")
+    path = tempfile.mkdtemp(suffix="_compaction")
+    try:
+        db_path = os.path.join(path, "db")
+        fill_database(DataProvider(db_path), users, days=5 * 365)
+
+        def measure(label):
+            provider = DataProvider(db_path)
+            start = time.time()
+            count = sum(1 for _ in provider.db.filter(WeightRecord, {}))
+            scan = time.time() - start
+            per_weigh_in = time_queries(provider, users, 3)
+            print "{:<40} {} records, {:.1f} MB, full scan {:.3f}s, {:.3f} ms per weigh-in queries".format(
+                "compaction: " + label, count, directory_size(db_path) / 1e6, scan, per_weigh_in * 1000)
+            return dict((user, [(r.time, r.w) for r in provider.all_mornings(user)]) for user in users), \
+                dict((user, provider.last(user).time) for user in users)
+
+        mornings, last = measure("before")
+        # as the scale runs it: the indexed provider, the lock shared with the weigh-ins
+        data = CachedDataProvider(db_path)
+        lock = HoldTimingLock()
+        compactor = Compactor(data, os.path.join(path, "compaction.json"), os.path.join(path, "unassigned.jsonl"),
+                              budget=0.05, lock=lock)
+        passes = 0
+        longest = 0.0
+        done = False
+        while not done:
+            start = time.time()
+            done = compactor.run_pass()
+            longest = max(longest, time.time() - start)
+            passes += 1
+        print "{:<40} {} passes (longest {:.3f}s, lock held {:.3f}s at most), {} records into {} summaries, " \
+              "{} unassigned archived".format("compaction: 0.05s budget", passes, longest, lock.longest,
+                                              compactor.compacted, compactor.summaries, compactor.unassigned)
+        assert measure("after") == (mornings, last)
+        assert Compactor(data, os.path.join(path, "compaction.json")).run_pass()
+
+        # a month whose unit of work fails is done again without archiving its readings twice
+        retry_path = os.path.join(path, "retry")
+        data = CachedDataProvider(retry_path)
+        fill_database(data, users, days=200)
+        unassigned = sum(1 for _ in data.db.filter(WeightRecord, {'user': 'User'}))
+        archive_path = os.path.join(path, "retry.jsonl")
+        compactor = Compactor(data, archive_path=archive_path, budget=1000)
+
+        def failing_write(records, deleted=()):
+            del data.write_batch
+            raise IOError("No space left on device")
+
+        data.write_batch = failing_write
+        try:
+            compactor.run_pass()
+        except IOError:
+            pass
+        assert compactor.run_pass()
+        with open(archive_path, 'rb') as f:
+            pks = [json.loads(line)['pk'] for line in f]
+        assert len(pks) == len(set(pks)) == unassigned
+        assert not any(True for _ in data.db.filter(WeightRecord, {'user': 'User'}))
+        print "{:<40} {} unassigned archived once".format("compaction: failed unit retried", len(pks))
+    finally:
+        shutil.rmtree(path)
+
+
+class FitbitStandIn:
+    # local http server standing in for the fitbit body weight endpoint, with configurable
+    # latency and a failure for every <fail_every>-th request (0 never fails)
+    def __init__(self, latency=0.0, fail_every=0):
+        import BaseHTTPServer
+        import SocketServer
+
+        stand_in = self
+        self.latency = latency
+        self.fail_every = fail_every
+        self.requests = 0
+        self.weights = {}
+        self.posts = 0
+        # answer 429 to one of every <limit_every> requests
+        self.limit_every = 0
+        self.limited = 0
+        self.lock = threading.Lock()
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                self.respond(stand_in.handle_get(self.path))
+
+            def do_POST(self):
+                import urlparse
+                body = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+                self.respond(stand_in.handle_post(self.path, dict(urlparse.parse_qsl(body))))
+
+            def respond(self, result):
+                status, payload = result
+                self.send_response(status)
+                if status == 429:
+                    self.send_header('Retry-After', '0.05')
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.url = "http://127.0.0.1:{}".format(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def failing(self):
+        with self.lock:
+            self.requests += 1
+            if self.limit_every and self.requests % self.limit_every == 0:
+                self.limited += 1
+                return 429
+            if self.fail_every and self.requests % self.fail_every == 0:
+                return 500
+            return None
+
+    # /user/<user>/body/log/weight/date/<start>/<end>.json
+    def handle_get(self, path):
+        import json
+        time.sleep(self.latency)
+        status = self.failing()
+        if status:
+            return status, '{"errors": []}'
+        parts = path.split('/')
+        user, start, end = parts[2], parts[7], parts[8][:-len('.json')]
+        with self.lock:
+            logs = [{'date': day, 'weight': weight} for (u, day), weight in sorted(self.weights.items())
+                    if u == user and start <= day <= end]
+        return 200, json.dumps({'weight': logs})
+
+    def handle_post(self, path, form):
+        time.sleep(self.latency)
+        status = self.failing()
+        if status:
+            return status, '{"errors": []}'
+        user = path.split('/')[2]
+        with self.lock:
+            self.posts += 1
+            self.weights[(user, form['date'])] = float(form['weight'])
+        return 201, '{"weightLog": {}}'
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class StandInConnector:
+    # same interface as FitbitConnector, talking to the stand-in over plain http
+    def __init__(self, url):
+        self.url = url
+
+    def has_keys(self, user):
+        return True
+
+    def upload_weight(self, user, weight, day=None):
+        import urllib
+        import urllib2
+        data = urllib.urlencode({'weight': weight * 2.2046, 'date': day})
+        urllib2.urlopen("{}/user/{}/body.json".format(self.url, user), data, timeout=5).read()
+
+    def weight_logs(self, user, start, end):
+        import json
+        import urllib2
+        url = "{}/user/{}/body/log/weight/date/{}/{}.json".format(self.url, user, start, end)
+        response = json.loads(urllib2.urlopen(url, timeout=5).read())
+        return dict((log['date'], log['weight'] / 2.2046) for log in response['weight'])
+
+
+class Morning:
+    def __init__(self, day, w):
+        self.year, self.month, self.day = day.year, day.month, day.day
+        self.w = w
+
+
+class MorningHistory:
+    # the part of DataProvider the backfill reads
+    def __init__(self, mornings):
+        self.mornings = mornings
+
+    def all_mornings(self, user):
+        return self.mornings.get(user, [])
+
+
+class InterruptingConnector(StandInConnector):
+    # stops the run after <uploads> uploads, like a crash or ctrl-c
+    def __init__(self, url, uploads):
+        StandInConnector.__init__(self, url)
+        self.uploads = uploads
+
+    def upload_weight(self, user, weight, day=None):
+        if self.uploads == 0:
+            raise KeyboardInterrupt()
+        self.uploads -= 1
+        StandInConnector.upload_weight(self, user, weight, day)
+
+
+def bench_backfill():
+    from datetime import date, timedelta
+    from fitbitbackfill import Backfill, RateLimiter
+
+    rnd = random.Random(1)
+    first = date(2013, 1, 1)
+    history = {}
+    for user in ("Alex", "Olya"):
+        history[user] = [Morning(first + timedelta(days=i), round(60 + rnd.uniform(-1, 1), 1))
+                         for i in xrange(3 * 365) if rnd.random() < 0.8]
+    stand_in = FitbitStandIn()
+    # fitbit already has every third morning
+    for user, mornings in history.items():
+        for m in mornings[::3]:
+            stand_in.weights[(user, "{:04d}-{:02d}-{:02d}".format(m.year, m.month, m.day))] = m.w * 2.2046
+    missing = sum(len(m) for m in history.values()) - len(stand_in.weights)
+    stand_in.limit_every = 97
+    path = tempfile.mktemp(suffix="_backfill.json")
+    try:
+        data = MorningHistory(history)
+        start = time.time()
+        try:
+            Backfill(InterruptingConnector(stand_in.url, 250), data, path,
+                     limiter=RateLimiter(10000, 1.0)).run(sorted(history))
+        except KeyboardInterrupt:
+            pass
+        job = Backfill(StandInConnector(stand_in.url), data, path, limiter=RateLimiter(10000, 1.0))
+        job.run(sorted(history))
+        elapsed = time.time() - start
+        print "{:<40} {} missing days synced in {:.2f}s, {} pages, {} rate limited".format(
+            "backfill: 3 years, 2 users, resumed", missing, elapsed, job.fetched, stand_in.limited)
+        assert stand_in.posts == missing, (stand_in.posts, missing)
+
+        # pacing alone, with a fake clock: 150 requests per hour
+        clock = [0.0]
+
+        def sleep(seconds):
+            clock[0] += seconds
+
+        limiter = RateLimiter(150, 3600.0, lambda: clock[0], sleep)
+        for _ in xrange(missing + 2 * 36):
+            limiter.acquire()
+        print "    at 150 requests/hour the same sync takes {:.1f} hours".format(clock[0] / 3600)
+    finally:
+        stand_in.close()
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def bench_fitbit():
+    from fitbitqueue import FitbitUploader, UploadQueue
+
+    weigh_ins = [("Alex", "2016-01-{:02d}".format(1 + i % 28), 77 + i / 10.0) for i in xrange(40)]
+    stand_in = FitbitStandIn(latency=0.05, fail_every=3)
+    path = tempfile.mktemp(suffix="_fitbit_queue.json")
+    try:
+        connector = StandInConnector(stand_in.url)
+        start = time.time()
+        lost = 0
+        for user, day, weight in weigh_ins[:10]:
+            try:
+                connector.upload_weight(user, weight, day)
+            except Exception:
+                lost += 1
+        blocked = (time.time() - start) / 10
+        print "{:<40} {:>10.3f} ms blocking per weigh-in, {} of 10 lost".format(
+            "fitbit: synchronous upload", blocked * 1000, lost)
+
+        uploader = FitbitUploader(connector, UploadQueue(path), retry_delay=0.01, max_retry_delay=0.1)
+        uploader.start()
+        start = time.time()
+        for user, day, weight in weigh_ins:
+            uploader.log_weight(user, weight, day)
+        blocked = (time.time() - start) / len(weigh_ins)
+        assert uploader.wait_empty(30)
+        drained = time.time() - start
+        uploader.stop()
+        print "{:<40} {:>10.3f} ms blocking per weigh-in, drained in {:.2f}s".format(
+            "fitbit: queued upload", blocked * 1000, drained)
+        print "    {} weigh-ins, {} uploads, {} failures, stand-in has {} days".format(
+            len(weigh_ins), uploader.uploaded, uploader.failures, len(stand_in.weights))
+        assert len(stand_in.weights) == 28
+
+        # nothing gets through, then the process restarts and the next one delivers the queue
+        stand_in.weights.clear()
+        stand_in.fail_every = 1
+        uploader = FitbitUploader(connector, UploadQueue(path), retry_delay=0.01, max_retry_delay=0.1)
+        uploader.start()
+        for user, day, weight in weigh_ins[:5]:
+            uploader.log_weight(user, weight, day)
+        time.sleep(0.3)
+        uploader.stop()
+        stand_in.fail_every = 0
+        uploader = FitbitUploader(connector, UploadQueue(path), retry_delay=0.01, max_retry_delay=0.1)
+        uploader.start()
+        assert uploader.wait_empty(30)
+        uploader.stop()
+        print "    after restart delivered {} of 5 queued while failing".format(len(stand_in.weights))
+        assert len(stand_in.weights) == 5
+    finally:
+        stand_in.close()
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def headless_display():
+    os.environ["SDL_VIDEODRIVER"] = "dummy"
+    from display import Display
+    return Display(None)
+
+
+class GraphRecord:
+    def __init__(self, w):
+        self.w = w
+
+
+# draws like the renderer before the graph cache, kept as a baseline
+def legacy_render_graph(display, all_mornings):
+    import pygame
+    from display import WHITE, GRAY, SILVER, YELLOW
+
+    mn = 1000
+    mx = 0
+    count = sum(1 for r in all_mornings)
+    for r in all_mornings:
+        mn = min(mn, r.w)
+        mx = max(mx, r.w)
+    mx += 1
+    mn -= 1
+    display.display.blit(display.font_graph.render(str(mx), 1, WHITE), (10, 145))
+    display.display.blit(display.font_graph.render(str(mn), 1, WHITE), (10, 220))
+    x_step = 280.0 / count
+    x = 40
+    x0 = None
+    y0 = None
+    w = 0
+    for r in all_mornings:
+        w = r.w
+        x += x_step
+        y = 240 - (240 - 145) / (mx - mn) * (r.w - mn)
+        if y0 is not None:
+            pygame.draw.line(display.display, GRAY, (x, 145), (x, 240))
+            pygame.draw.line(display.display, SILVER, (x0, y0), (x, y))
+        x0 = x
+        y0 = y
+    display.display.blit(display.font_graph.render(str(w), 1, YELLOW), (10, y0 - 8))
+    pygame.display.update()
+
+
+def bench_graph():
+    display = headless_display()
+    rnd = random.Random(1)
+    for days in (30, 365, 5 * 365):
+        history = [GraphRecord(round(77 + rnd.uniform(-2, 2), 1)) for _ in xrange(days)]
+        weigh_ins = 50
+
+        start = time.time()
+        for i in xrange(weigh_ins):
+            legacy_render_graph(display, history + [GraphRecord(77.0 + i % 5 / 10.0)] * (i + 1))
+        legacy = (time.time() - start) / weigh_ins
+
+        display.graph.caches.clear()
+        display.render_graph(history, "Alex")
+        start = time.time()
+        for i in xrange(weigh_ins):
+            # the screen shows the weight on top, the graph band stays as it was
+            display.render_graph(history + [GraphRecord(77.0 + i % 5 / 10.0)] * (i + 1), "Alex")
+        cached = (time.time() - start) / weigh_ins
+
+        print "{:<40} legacy {:>8.3f} ms, cached {:>8.3f} ms per weigh-in".format(
+            "graph: {} mornings".format(days), legacy * 1000, cached * 1000)
+
+
+def legacy_render(display, weight_text, weight_color, user_text):
+    import pygame
+    from display import BLACK, WHITE
+
+    display.display.fill(BLACK)
+    display.display.blit(display.font_user.render(user_text, 1, WHITE), (60, 10))
+    display.display.blit(display.font.render(weight_text, 1, weight_color), (60, 30))
+    pygame.display.update()
+
+
+def bench_live():
+    from display import SILVER
+
+    display = headless_display()
+    display.preload_glyphs((SILVER,))
+    rnd = random.Random(1)
+    frames = 500
+    # a live readout at 10-20 Hz: mostly the last digit moves, the user rarely changes
+    weights = [str(round(77.9 + rnd.gauss(0, 0.15), 1)) for _ in xrange(frames)]
+    users = ["Alex" if i < frames * 0.8 else "Olya" for i in xrange(frames)]
+
+    for name, render in (("full redraw", lambda w, u: legacy_render(display, w, SILVER, u)),
+                         ("glyph cache + dirty rects", lambda w, u: display.render(w, SILVER, u))):
+        display.clear()
+        start = time.time()
+        cpu = time.clock()
+        for weight, user in zip(weights, users):
+            render(weight, user)
+        cpu = (time.clock() - cpu) / frames
+        elapsed = time.time() - start
+        print "{:<40} {:>10.0f} frames/s, {:.3f} ms cpu per frame".format(
+            "live: " + name, frames / elapsed, cpu * 1000)
+
+
+class SlowDisplay:
+    # rendering on the pi's framebuffer, artificially slow
+    def __init__(self, delay):
+        self.delay = delay
+        self.renders = 0
+
+    def render(self, weight_text, weight_color, user_text):
+        self.renders += 1
+        time.sleep(self.delay)
+
+    def clear(self):
+        time.sleep(self.delay)
+
+
+# sends reports at <rate> per second without blocking, what doesn't fit in the socket is lost
+# like an overflowing l2cap buffer
+def feed_at_rate(sock, reports, rate):
+    import errno
+    lost = 0
+    start = time.time()
+    for i, data in enumerate(reports):
+        delay = start + i / float(rate) - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        try:
+            sock.send(data, socket.MSG_DONTWAIT)
+        except socket.error as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+            lost += 1
+    sock.close()
+    return lost
+
+
+def bench_pipeline():
+    from pipeline import Pipeline, LiveDisplay
+
+    render_delay = 0.03
+    persist_delay = 0.3
+    rate = 1000
+    reports = calibration_reports(SAMPLE_CALIBRATION) + sample_reports(3000)
+
+    losses = {}
+    for mode in ("single thread", "pipeline"):
+        board_side, feeder_side = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        feeder_side.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        result = {}
+        feeder = threading.Thread(target=lambda: result.setdefault('lost', feed_at_rate(feeder_side, reports, rate)))
+        screen = SlowDisplay(render_delay)
+        measurements = 0
+
+        if mode == "single thread":
+            processor = EventProcessor(StubWeightProcessor(), screen, HistogramEstimator(), None, 0)
+            board = Wiiboard(processor, SocketTransport(board_side))
+            board.connect("00:00:00:00:00:00")
+            feeder.start()
+            while board.is_connected():
+                processor.reset()
+                board.receive()
+                if processor.done:
+                    measurements += 1
+                    time.sleep(persist_delay)
+            dropped = 0
+        else:
+            live = LiveDisplay()
+            processor = EventProcessor(StubWeightProcessor(), live, HistogramEstimator(), None, 0)
+            pipeline = Pipeline(processor)
+            board = Wiiboard(pipeline, SocketTransport(board_side))
+            board.connect("00:00:00:00:00:00")
+            feeder.start()
+            pipeline.start()
+            while True:
+                live.flush(screen)
+                try:
+                    weight = pipeline.next_measurement(0.01)
+                except Queue.Empty:
+                    continue
+                if weight is None:
+                    break
+                measurements += 1
+                time.sleep(persist_delay)
+            pipeline.stop()
+            dropped = pipeline.dropped
+        feeder.join()
+        board_side.close()
+        print "{:<40} sent {} lost on the link {} dropped {} decoded {}, {} measurements, {} renders".format(
+            "pipeline: " + mode, len(reports), result['lost'], dropped, board.stats.decoded,
+            measurements, screen.renders)
+        # losses depend on how the threads are scheduled here, the pipeline only has to keep well
+        # ahead of the single thread, which loses most of the reports while it draws and saves
+        losses[mode] = result['lost'] + dropped
+    assert losses["pipeline"] * 10 < losses["single thread"]
+
+    # the receive thread dies: stop() must not wait for a handshake nobody answers
+    processor = EventProcessor(StubWeightProcessor(), LiveDisplay(), HistogramEstimator(), None, 0)
+    pipeline = Pipeline(processor)
+    board = Wiiboard(pipeline, FailingTransport(reports, 500))
+    board.connect("00:00:00:00:00:00")
+    pipeline.start()
+    while pipeline.next_measurement(1.0) is not None:
+        pass
+    start = time.time()
+    pipeline.stop(1.0)
+    elapsed = time.time() - start
+    print "{:<40} stopped in {:.3f}s".format("pipeline: after a receive failure", elapsed)
+    assert elapsed < 0.5 and board.status == "Disconnected"
+
+
+class FailingTransport(CyclingTransport):
+    # replays <reports> until <count> were received, then fails with something that is not an IOError
+    def recv_into(self, buf, nbytes):
+        if self.position >= self.count:
+            raise ValueError("replay failed")
+        return CyclingTransport.recv_into(self, buf, nbytes)
+
+
+class OffTransport(SocketTransport):
+    # a board that doesn't answer: every connect fails after <seconds>
+    def __init__(self, seconds):
+        SocketTransport.__init__(self, None)
+        self.seconds = seconds
+        self.attempts = 0
+
+    def connect(self, address):
+        self.attempts += 1
+        time.sleep(self.seconds)
+        return False
+
+
+def feed_all(sock, reports):
+    for data in reports:
+        sock.send(data)
+    sock.close()
+
+
+def bench_boards():
+    import shutil
+    from boardmanager import BoardManager, SerializedWeightProcessor
+    from weightlog import LogDataProvider
+    from weightprocessor import WeightProcessor, WeightProcessorConfiguration
+
+    db_path = tempfile.mkdtemp(suffix="_boards")
+    try:
+        data = LogDataProvider(os.path.join(db_path, "weight.log"))
+        fill_database(data, ("Alex", "Olya"), days=365)
+        weight_processor = WeightProcessor(data, WeightProcessorConfiguration(30, 2, 5, None),
+                                           StaticUsers({"Alex": {'weight': 77}, "Olya": {'weight': 53}}))
+        for count in (1, 2, 4):
+            writer = SerializedWeightProcessor(weight_processor)
+            writer.start()
+            manager = BoardManager(writer, reconnect=False)
+            feeders = []
+            for n in xrange(count):
+                board_side, feeder_side = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+                reports = calibration_reports(SAMPLE_CALIBRATION) + sample_reports(3000, seed=n + 1)
+                feeders.append(threading.Thread(target=feed_all, args=(feeder_side, reports)))
+                processor = EventProcessor(writer, None, HistogramEstimator(), StabilityDetector(100, 0.15, 0.1), 0)
+                board = Wiiboard(processor, SocketTransport(board_side))
+                board.connect("00:00:00:00:00:0{}".format(n))
+                manager.add("board{}".format(n), board, processor)
+            start = time.time()
+            for feeder in feeders:
+                feeder.start()
+            manager.run(until_disconnected=True)
+            elapsed = time.time() - start
+            writer.stop()
+            for feeder in feeders:
+                feeder.join()
+            received = sum(m.board.stats.received for m in manager.boards)
+            report("boards: {} board event loop".format(count), received, elapsed)
+            print "    measurements per board {}, saved {}, calibrated {}".format(
+                [m.measurements for m in manager.boards], writer.processed,
+                all(m.board.calibrated for m in manager.boards))
+            assert writer.processed == sum(m.measurements for m in manager.boards) == 3 * count
+
+        # a board that is off takes a whole page timeout per connect, the other one is read meanwhile
+        writer = SerializedWeightProcessor(weight_processor)
+        writer.start()
+        manager = BoardManager(writer, min_delay=0.01)
+        off = Wiiboard(EventProcessor(writer, None, HistogramEstimator(), None, 0), OffTransport(1.0))
+        manager.add("off", off, off.processor, "00:00:00:00:00:09")
+        board_side, feeder_side = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        feeder = threading.Thread(target=feed_all, args=(feeder_side, calibration_reports(SAMPLE_CALIBRATION) +
+                                                         sample_reports(3000)))
+        processor = EventProcessor(writer, None, HistogramEstimator(), StabilityDetector(100, 0.15, 0.1), 0)
+        board = Wiiboard(processor, SocketTransport(board_side))
+        board.connect("00:00:00:00:00:00")
+        on = manager.add("on", board, processor)
+        feeder.start()
+        longest = 0
+        start = time.time()
+        while board.is_connected():
+            started = time.time()
+            manager.poll()
+            longest = max(longest, time.time() - started)
+        elapsed = time.time() - start
+        manager.stop()
+        manager.run()
+        writer.stop()
+        feeder.join()
+        report("boards: next to a board that is off", board.stats.received, elapsed)
+        print "    longest round {:.3f}s, measurements {}, connect attempts {}".format(
+            longest, on.measurements, off.transport.attempts)
+        assert longest < 0.5 and on.measurements == 3 and off.transport.attempts >= 1
+    finally:
+        shutil.rmtree(db_path)
+
+
+def replay(processor, path):
+    from wiiboard import ReplayWiiboard
+
+    holder = []
+    timing = TimingProcessor(processor, lambda: holder[0].transport.timestamps[holder[0].transport.position - 1])
+    board = ReplayWiiboard(timing, path, OPTIONS['realtime'])
+    holder.append(board)
+    board.connect(board.discover())
+    return board, timing
+
+
+def bench_replay():
+    path, temporary = replay_capture()
+    try:
+        processor = EventProcessor(StubWeightProcessor(), None, HistogramEstimator(),
+                                   StabilityDetector(100, 0.15, 0.1), 0)
+        board, timing = replay(processor, path)
+        start = time.time()
+        weights = []
+        while board.is_connected():
+            processor.reset()
+            board.receive()
+            if processor.done:
+                weights.append(processor.weight)
+        report("replay: decode + measure", board.stats.received, time.time() - start)
+        print "    {} measurements {}, time to final weight {}".format(
+            len(weights), weights, ", ".join("{:.2f}s".format(t) for t in timing.times))
+    finally:
+        if temporary:
+            os.remove(path)
+
+
+class StaticUsers:
+    # the part of the scale's UserProvider WeightProcessor uses
+    def __init__(self, users):
+        self.users = users
+
+    def all(self):
+        return self.users
+
+    def weight(self, name):
+        return self.users[name]['weight']
+
+    def update_weight(self, name, weight):
+        self.users[name]['weight'] = weight
+
+
+# the whole weigh-in: replayed board -> measurement -> database -> screen
+def bench_e2e():
+    import shutil
+    from datetime import datetime
+    from dataprovider import WeightRecord
+    from weightlog import LogDataProvider
+    from weightprocessor import WeightProcessor, WeightProcessorConfiguration
+    from display import WHITE
+    from eventprocessor import safe_text
+
+    display = headless_display()
+    path, temporary = replay_capture()
+    db_path = tempfile.mkdtemp(suffix="_e2e")
+    try:
+        data = LogDataProvider(os.path.join(db_path, "weight.log"))
+        fill_database(data, ("Alex", "Olya"), days=365)
+        weight_processor = WeightProcessor(data, WeightProcessorConfiguration(30, 2, 5, None),
+                                           StaticUsers({"Alex": {'weight': 77}, "Olya": {'weight': 53}}))
+        processor = EventProcessor(weight_processor, display, HistogramEstimator(),
+                                   StabilityDetector(100, 0.15, 0.1), 100)
+        board, timing = replay(processor, path)
+
+        persist = []
+        render = []
+        start = time.time()
+        while board.is_connected():
+            processor.reset()
+            board.receive()
+            if not processor.done:
+                continue
+            weight = processor.weight
+            record = WeightRecord({'year': datetime.today().year, 'month': datetime.today().month,
+                                   'day': datetime.today().day, 'w': weight})
+            user = weight_processor.get_user_by_weight(weight)
+            display.render(str(weight), WHITE, safe_text(user))
+            t = time.time()
+            weight_processor.process(record)
+            persist.append(time.time() - t)
+            t = time.time()
+            display.render_graph(data.all_mornings(record.user), record.user)
+            render.append(time.time() - t)
+        elapsed = time.time() - start
+
+        def average_ms(values):
+            return sum(values) / max(len(values), 1) * 1000
+
+        report("e2e: replayed weigh-ins", board.stats.decoded, elapsed)
+        print "    {} measurements, time to final {:.2f}s, process + commit {:.2f} ms, graph {:.2f} ms".format(
+            len(persist), sum(timing.times) / max(len(timing.times), 1), average_ms(persist), average_ms(render))
+    finally:
+        shutil.rmtree(db_path)
+        if temporary:
+            os.remove(path)
+
+
+class LagProcessor:
+    # how late each weight report reaches the processor against the pace it was recorded at
+    def __init__(self, processor):
+        self.processor = processor
+        self.board = None
+        self.lags = []
+
+    @property
+    def done(self):
+        return self.processor.done
+
+    def init_board(self, board):
+        self.board = board
+        self.processor.init_board(board)
+
+    def mass(self, event):
+        transport = self.board.transport
+        due = transport.started + transport.timestamps[transport.position - 1] - transport.timestamps[0]
+        self.lags.append(time.time() - due)
+        self.processor.mass(event)
+
+
+def api_client(port, paths, stop, counts):
+    import httplib
+
+    n = 0
+    while not stop.is_set():
+        connection = httplib.HTTPConnection("127.0.0.1", port, timeout=5)
+        connection.request("GET", paths[n % len(paths)], headers={'Accept-Encoding': 'gzip'})
+        response = connection.getresponse()
+        response.read()
+        connection.close()
+        n += 1
+    counts.append(n)
+
+
+def bench_api():
+    import httplib
+    import json
+    import shutil
+    from datetime import datetime
+    from aggregates import Aggregates
+    from dataprovider import WeightRecord
+    from historyapi import HistoryApi, HistoryServer
+    from weightlog import LogDataProvider
+    from weightprocessor import WeightProcessor, WeightProcessorConfiguration
+    from wiiboard import ReplayWiiboard
+
+    users = ("Alex", "Olya")
+    db_path = tempfile.mkdtemp(suffix="_api")
+    fd, capture = tempfile.mkstemp(suffix=".cap")
+    os.close(fd)
+    write_capture(capture, calibration_reports(SAMPLE_CALIBRATION) + sample_reports(1000))
+    server = None
+    try:
+        data = LogDataProvider(os.path.join(db_path, "weight.log"))
+        fill_database(data, users, days=5 * 365)
+        aggregates = Aggregates()
+        aggregates.rebuild(users, data)
+        server = HistoryServer(HistoryApi(data, aggregates), 0)
+        server.start()
+
+        def get(path, headers={}):
+            connection = httplib.HTTPConnection("127.0.0.1", server.port)
+            connection.request("GET", path, headers=headers)
+            response = connection.getresponse()
+            return response.status, dict(response.getheaders()), response.read()
+
+        # every morning once through the pages, a date range, 304 and gzip
+        records = []
+        path = "/users/Alex/history?limit=500"
+        while path is not None:
+            status, headers, body = get(path)
+            page = json.loads(body)
+            records.extend(page['records'])
+            path = "/users/Alex/history?limit=500&cursor=" + page['next_cursor'] if page['next_cursor'] else None
+        assert len(records) == len(data.all_mornings("Alex"))
+        # records of the same time split over pages
+        for i in xrange(5):
+            data.save(WeightRecord({'year': 2015, 'month': 1, 'day': 1, 'user': 'Ties', 'w': 60.0 + i,
+                                    'morning': True, 'last': i == 4, 'time': 1420099200000}))
+        data.commit()
+        weights = []
+        path = "/users/Ties/history?limit=2"
+        while path is not None:
+            page = json.loads(get(path)[2])
+            weights.extend(r['w'] for r in page['records'])
+            path = "/users/Ties/history?limit=2&cursor=" + page['next_cursor'] if page['next_cursor'] else None
+        assert sorted(weights) == [60.0, 61.0, 62.0, 63.0, 64.0]
+        status, headers, body = get("/users/Alex/history?from=2013-02-01&to=2013-02-28&limit=1000")
+        assert len(json.loads(body)['records']) == 28
+        assert get("/users/Alex/latest", {'If-None-Match': headers['etag']})[0] == 304
+        status, headers, body = get("/users/Alex/aggregates", {'Accept-Encoding': 'gzip'})
+        assert headers.get('content-encoding') == 'gzip'
+        assert get("/users/Nobody/latest")[0] == 404
+
+        paths = ["/users", "/users/Alex/latest", "/users/Olya/aggregates", "/users/Alex/history?limit=100",
+                 "/users/Olya/history?from=2014-01-01&to=2014-03-31"]
+        for clients in (0, 4):
+            weight_processor = WeightProcessor(data, WeightProcessorConfiguration(30, 2, 5, None),
+                                               StaticUsers({"Alex": {'weight': 50}, "Olya": {'weight': 65}}),
+                                               aggregates=aggregates)
+            processor = LagProcessor(EventProcessor(weight_processor, None, HistogramEstimator(),
+                                                    StabilityDetector(100, 0.15, 0.1), 0))
+            board = ReplayWiiboard(processor, capture, True)
+            board.connect(board.discover())
+            stop = threading.Event()
+            counts = []
+            threads = [threading.Thread(target=api_client, args=(server.port, paths, stop, counts))
+                       for _ in xrange(clients)]
+            for thread in threads:
+                thread.start()
+            start = time.time()
+            while board.is_connected():
+                processor.processor.reset()
+                board.receive()
+                if processor.done:
+                    weight_processor.process(WeightRecord({'year': datetime.today().year,
+                                                           'month': datetime.today().month,
+                                                           'day': datetime.today().day,
+                                                           'w': processor.processor.weight}))
+            elapsed = time.time() - start
+            stop.set()
+            for thread in threads:
+                thread.join()
+            lags = sorted(processor.lags)
+            print "{:<40} {:>8.0f} requests/s, report lag p99 {:.1f} ms, max {:.1f} ms ({} reports)".format(
+                "api: replay with {} clients".format(clients), sum(counts) / elapsed,
+                lags[int(len(lags) * 0.99)] * 1000, lags[-1] * 1000, len(lags))
+        print "    {} requests, {} answered from the cache".format(server.server.api.requests,
+                                                                 server.server.api.cache_hits)
+    finally:
+        if server is not None:
+            server.stop()
+        shutil.rmtree(db_path)
+        os.remove(capture)
+
+
+def bench_profiler():
+    import shutil
+    import profiler
+    from datetime import datetime
+    from dataprovider import WeightRecord
+    from weightlog import LogDataProvider
+    from weightprocessor import WeightProcessor, WeightProcessorConfiguration
+
+    reports = calibration_reports(SAMPLE_CALIBRATION) + sample_reports(30000)
+    fd, path = tempfile.mkstemp(suffix=".cap")
+    os.close(fd)
+    db_path = tempfile.mkdtemp(suffix="_profiler")
+    try:
+        write_capture(path, reports)
+
+        # receive + decode + measure with nothing traced, traced, and traced while sampling stacks
+        for mode in ("off", "trace", "trace + sampler"):
+            trace = profiler.enable_trace() if mode != "off" else None
+            processor = EventProcessor(StubWeightProcessor(), None, HistogramEstimator(),
+                                       StabilityDetector(100, 0.15, 0.1), 0)
+            board = Wiiboard(processor, CaptureTransport(path))
+            if trace is not None:
+                profiler.trace_stages(trace, board=board, processor=processor)
+            board.connect("00:00:00:00:00:00")
+            sampler = None
+            if mode == "trace + sampler":
+                result = []
+                sampler = threading.Thread(target=lambda: result.append(profiler.sample_stacks(2.0)))
+                sampler.start()
+            start = time.time()
+            while board.is_connected():
+                processor.reset()
+                board.receive()
+            report("profiler: replay, " + mode, board.stats.received, time.time() - start)
+            if sampler is not None:
+                sampler.join()
+                counts, samples = result[0]
+                top = sorted(counts.items(), key=lambda item: -item[1])[0]
+                print "    {} samples, {} stacks, top: {} ({})".format(samples, len(counts), top[0], top[1])
+                assert any("wiiboard.py:receive" in stack for stack in counts)
+            profiler._trace = None
+
+        # stage trace of a few weigh-ins through database and screen
+        display = headless_display()
+        data = LogDataProvider(os.path.join(db_path, "weight.log"))
+        fill_database(data, ("Alex", "Olya"), days=365)
+        trace = profiler.enable_trace()
+        weight_processor = WeightProcessor(data, WeightProcessorConfiguration(30, 2, 5, None),
+                                           StaticUsers({"Alex": {'weight': 77}, "Olya": {'weight': 53}}))
+        processor = EventProcessor(weight_processor, None, HistogramEstimator(), StabilityDetector(100, 0.15, 0.1), 0)
+        board = Wiiboard(processor, CaptureTransport(path))
+        profiler.trace_stages(trace, board=board, processor=processor, weight_processor=weight_processor,
+                              data=data, display=display)
+        board.connect("00:00:00:00:00:00")
+        while board.is_connected():
+            processor.reset()
+            board.receive()
+            if processor.done:
+                record = WeightRecord({'year': datetime.today().year, 'month': datetime.today().month,
+                                       'day': datetime.today().day, 'w': processor.weight})
+                weight_processor.process(record)
+                display.render_graph(data.all_mornings(record.user), record.user)
+                trace.finish(processor.weight)
+        print "    " + trace.render().replace("\n", "\n    ").rstrip()
+        assert len(trace.measurements) == 10
+
+        # two boards weighing at once from one event loop: every measurement gets the stages of
+        # its own board, and receive is only the handling of the reports, not the wait for them
+        from boardmanager import BoardManager, SerializedWeightProcessor
+        writer = SerializedWeightProcessor(weight_processor, lambda name, record: trace.finish(record.w))
+        writer.start()
+        manager = BoardManager(writer, reconnect=False)
+        feeders = []
+        for n in xrange(2):
+            board_side, feeder_side = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            reports = calibration_reports(SAMPLE_CALIBRATION) + sample_reports(3000, seed=n + 1)
+            feeders.append(threading.Thread(target=feed_all, args=(feeder_side, reports)))
+            processor = EventProcessor(writer, None, HistogramEstimator(), StabilityDetector(100, 0.15, 0.1), 0)
+            board = Wiiboard(processor, SocketTransport(board_side))
+            profiler.trace_stages(trace, board=board, processor=processor)
+            board.connect("00:00:00:00:00:0{}".format(n))
+            manager.add("board{}".format(n), board, processor)
+        trace.measurements.clear()
+        for feeder in feeders:
+            feeder.start()
+        manager.run(until_disconnected=True)
+        writer.stop()
+        for feeder in feeders:
+            feeder.join()
+        measurements = list(trace.measurements)
+        assert len(measurements) == 6
+        for started, finished, weight, stages in measurements:
+            assert stages.get('mass') and stages.get('process'), stages
+            assert stages.get('receive', 0.0) < finished - started
+        print "    2 boards: {} measurements, receive {:.2f}ms of {:.0f}ms each on average".format(
+            len(measurements), sum(m[3].get('receive', 0.0) for m in measurements) / len(measurements) * 1000,
+            sum(m[1] - m[0] for m in measurements) / len(measurements) * 1000)
+    finally:
+        profiler._trace = None
+        os.remove(path)
+        shutil.rmtree(db_path)
+
+
+class HistoryRecord:
+    def __init__(self, day, w):
+        self.year, self.month, self.day = day.year, day.month, day.day
+        self.w = w
+
+
+class UserHistory:
+    # the DataProvider queries UserIndex.train uses
+    def __init__(self, records):
+        self.records = records
+
+    def all_mornings(self, user):
+        return list(self.records.get(user, ()))
+
+    def last(self, user):
+        records = self.records.get(user)
+        return records[-1] if records else None
+
+
+# (user, start kg, kg per day, day to day stddev): a dieting and a steady adult 3 kg apart, a
+# noisy one in between, a growing kid and a second adult
+HOUSEHOLD = (("Alex", 80.0, -0.01, 0.4), ("Lena", 75.0, 0.0, 0.4), ("Ivan", 78.0, 0.0, 1.2),
+             ("Platon", 25.0, 0.01, 0.3), ("Olya", 55.0, 0.002, 0.5))
+
+
+def household_history(days, seed=1):
+    from datetime import date, timedelta
+
+    rnd = random.Random(seed)
+    start = date(2014, 1, 1)
+    weighins = []
+    for day in xrange(days):
+        for user, weight, trend, stddev in HOUSEHOLD:
+            if rnd.random() < 0.8:
+                weighins.append((user, HistoryRecord(start + timedelta(days=day),
+                                                     round(weight + trend * day + rnd.gauss(0, stddev), 1))))
+    return weighins
+
+
+# the old lookup: first user whose last weight is within max_weight_diff, in dict order
+def legacy_user(weights, w, max_weight_diff):
+    for user in weights:
+        if weights[user] - max_weight_diff <= w <= weights[user] + max_weight_diff:
+            return user
+    return None
+
+
+def bench_users():
+    from userindex import UserIndex
+
+    max_weight_diff = 5
+    weighins = household_history(2 * 365)
+    half = len(weighins) / 2
+    history = collections.defaultdict(list)
+    for user, record in weighins[:half]:
+        history[user].append(record)
+    seeds = dict((user, {'weight': weight}) for user, weight, _, _ in HOUSEHOLD)
+    index = UserIndex(max_weight_diff)
+    index.train(StaticUsers(seeds), UserHistory(history))
+    weights = dict((user, records[-1].w) for user, records in history.items())
+
+    correct = [0, 0]
+    confidences = []
+    for user, record in weighins[half:]:
+        found, confidence = index.identify(record.w)
+        correct[0] += found == user
+        confidences.append(confidence)
+        correct[1] += legacy_user(weights, record.w, max_weight_diff) == user
+        index.add(user, record)
+        weights[user] = record.w
+    tested = len(weighins) - half
+    print "{:<40} {:.1%} correct, mean confidence {:.2f}".format(
+        "users: history index", correct[0] / float(tested), sum(confidences) / len(confidences))
+    print "{:<40} {:.1%} correct".format("users: last weight window", correct[1] / float(tested))
+
+    # lookup cost against household size: users 0.1 kg apart, probes near a random user
+    rounds = 20000
+    rnd = random.Random(1)
+    for count in (len(HOUSEHOLD), 100, 1000):
+        flat = collections.OrderedDict(("user{}".format(i), 20 + 0.1 * i) for i in xrange(count))
+        users = dict((name, {'weight': weight}) for name, weight in flat.items())
+        probes = [20 + 0.1 * rnd.randint(0, count - 1) + rnd.uniform(-0.02, 0.02) for _ in xrange(rounds)]
+        big = UserIndex(0.04)
+        big.train(StaticUsers(users), UserHistory({}))
+        start = time.time()
+        for w in probes:
+            big.identify(w)
+        report("users: index lookup, {} users".format(count), rounds, time.time() - start, "lookups")
+        start = time.time()
+        for w in probes:
+            legacy_user(flat, w, 0.04)
+        report("users: linear scan, {} users".format(count), rounds, time.time() - start, "lookups")
+
+    # the index the scale keeps up to date is the one a restart trains from the database
+    import shutil
+    from dataprovider import WeightRecord
+    from weightlog import LogDataProvider
+    from weightprocessor import WeightProcessor, WeightProcessorConfiguration
+
+    directory = tempfile.mkdtemp(suffix="_users")
+    try:
+        data = LogDataProvider(os.path.join(directory, "weight.log"))
+        fill_database(data, ("Alex", "Olya"), days=60)
+        users = StaticUsers({"Alex": {'weight': 50}, "Olya": {'weight': 65}})
+        configuration = WeightProcessorConfiguration(30, 2, max_weight_diff, (0, 23))
+        running = WeightProcessor(data, configuration, users)
+        for day in xrange(1, 29):
+            # a morning each, a regular weigh-in later that day and now and then one too far off
+            for w in (50 + rnd.uniform(-1, 1), 65 + rnd.uniform(-1, 1), 50.5, 53 if day % 5 == 0 else 65.5):
+                running.process(WeightRecord({'year': 2012, 'month': 3, 'day': day, 'w': round(w, 1)}))
+        restarted = WeightProcessor(data, configuration, users)
+        for user in ("Alex", "Olya"):
+            before = running.users.models[user]
+            after = restarted.users.models[user]
+            assert before.count() == after.count()
+            assert abs(before.predict() - after.predict()) < 1e-6 and abs(before.stddev() - after.stddev()) < 1e-6
+        assert running.users.entries[1] == restarted.users.entries[1]
+        print "{:<40} same models before and after a restart".format("users: runtime index")
+        data.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+BENCHMARKS = {
+    'aggregates': bench_aggregates,
+    'api': bench_api,
+    'archive': bench_archive,
+    'backfill': bench_backfill,
+    'boards': bench_boards,
+    'commit': bench_commit,
+    'compaction': bench_compaction,
+    'db': bench_db,
+    'decode': bench_decode,
+    'e2e': bench_e2e,
+    'estimator': bench_estimator,
+    'fitbit': bench_fitbit,
+    'graph': bench_graph,
+    'idle': bench_idle,
+    'live': bench_live,
+    'metrics': bench_metrics,
+    'pipeline': bench_pipeline,
+    'profiler': bench_profiler,
+    'receive': bench_receive,
+    'reconnect': bench_reconnect,
+    'replay': bench_replay,
+    'settle': bench_settle,
+    'storage': bench_storage,
+    'tare': bench_tare,
+    'users': bench_users,
+}
+
+
+OPTIONS = {'capture': None, 'realtime': False}
+
+
+def main():
+    from optparse import OptionParser
+
+    parser = OptionParser(usage="%prog [--capture FILE] [--realtime] [benchmark ...]")
+    parser.add_option("--capture", help="replay this capture instead of generated reports")
+    parser.add_option("--realtime", action="store_true", default=False,
+                      help="replay at the recorded pace")
+    options, names = parser.parse_args()
+    OPTIONS['capture'] = options.capture
+    OPTIONS['realtime'] = options.realtime
+
+    logging.basicConfig(level=logging.CRITICAL)
+    names = names or sorted(BENCHMARKS)
+    for name in names:
+        try:
+            BENCHMARKS[name]()
+        except ImportError as e:
+            print "{}: skipped, {}".format(name, e)
+
+
+if __name__ == "__main__":
+    main()
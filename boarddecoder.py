@@ -0,0 +1,197 @@
+import struct
+import time
+
+TOP_RIGHT = 0
+BOTTOM_RIGHT = 1
+TOP_LEFT = 2
+BOTTOM_LEFT = 3
+
+# calibration points of the board in kg: calibration[0] is 0kg, [1] is 17kg, [2] is 34kg
+CALIBRATION_STEP_KG = 17
+
+# high dummy value so events with it don't register
+DUMMY_CALIBRATION = 10000
+
+# 0x32 report: a1 32 BB BB TR TR BR BR TL TL BL BL ..., everything big endian
+EXTENSION_REPORT = struct.Struct(">H4H")
+EXTENSION_REPORT_OFFSET = 2
+
+# tare tracking: idle reports (total below TARE_IDLE_WEIGHT kg) pull each sensor's zero towards
+# its reading with weight TARE_ALPHA. the board feeds one in IDLE_TARE_EVERY (8) idle reports,
+# ~12 per second, so 0.01 is a ~8 s time constant.
+# a sensor further than TARE_MAX_OFFSET kg from the factory zero is left alone (something on it)
+TARE_ALPHA = 0.01
+TARE_IDLE_WEIGHT = 5.0
+TARE_MAX_OFFSET = 5.0
+
+# tracked reports (~1 minute) between two drift rate estimates, which are averaged with weight
+# DRIFT_SMOOTHING as a single minute moves the zero by less than a raw step
+DRIFT_REPORTS = 750
+DRIFT_SMOOTHING = 0.2
+
+# calibration block: 8 (first read) or 4 (second read) big endian sensor words
+CALIBRATION_WORD = struct.Struct(">H")
+
+
+class BoardEvent:
+    def __init__(self, top_left, top_right, bottom_left, bottom_right,
+                 button_pressed, button_released):
+        self.topLeft = top_left
+        self.topRight = top_right
+        self.bottomLeft = bottom_left
+        self.bottomRight = bottom_right
+        self.buttonPressed = button_pressed
+        self.buttonReleased = button_released
+        # convenience value
+        self.totalWeight = top_left + top_right + bottom_left + bottom_right
+
+
+def dummy_calibration():
+    return [[DUMMY_CALIBRATION] * 4 for _ in xrange(3)]
+
+
+def unpack_calibration_words(data, count):
+    return [CALIBRATION_WORD.unpack_from(data, i * 2)[0] for i in xrange(count)]
+
+
+class CalibrationTable:
+    # Per sensor linear pieces precomputed from the 0/17/34 kg calibration points, so
+    # converting a raw word to kg is a compare and a multiply-add:
+    #   raw < zero          -> 0
+    #   zero <= raw < mid   -> (raw - zero) * low_slope
+    #   raw >= mid          -> 17 + (raw - mid) * high_slope
+    def __init__(self, calibration):
+        self.zero = [0] * 4
+        self.mid = [0] * 4
+        self.low_slope = [0.0] * 4
+        self.high_slope = [0.0] * 4
+        self.update(calibration)
+
+    def update(self, calibration):
+        for pos in xrange(4):
+            c0 = calibration[0][pos]
+            c1 = calibration[1][pos]
+            c2 = calibration[2][pos]
+            self.zero[pos] = c0
+            self.mid[pos] = c1
+            self.low_slope[pos] = CALIBRATION_STEP_KG / float(c1 - c0) if c1 != c0 else 0.0
+            self.high_slope[pos] = CALIBRATION_STEP_KG / float(c2 - c1) if c2 != c1 else 0.0
+
+    def mass(self, raw, pos):
+        if raw < self.zero[pos]:
+            return 0.0
+        if raw < self.mid[pos]:
+            return (raw - self.zero[pos]) * self.low_slope[pos]
+        return CALIBRATION_STEP_KG + (raw - self.mid[pos]) * self.high_slope[pos]
+
+
+class TareTracker:
+    # Zero offset of every sensor in raw units, an exponentially weighted average of how far the
+    # idle readings are from the factory zero. The decoder subtracts it before converting to kg.
+    # O(1) per idle report, the clock is only read once per DRIFT_REPORTS for the drift rate.
+    def __init__(self, alpha=TARE_ALPHA, idle_weight=TARE_IDLE_WEIGHT, max_offset=TARE_MAX_OFFSET,
+                 clock=time.time):
+        self.alpha = alpha
+        self.idle_weight = idle_weight
+        self.max_offset = max_offset
+        self.clock = clock
+        # sensor order of the report: top right, bottom right, top left, bottom left
+        self.offsets = [0.0] * 4
+        self.zero = [0] * 4
+        self.max_raw = [0.0] * 4
+        self.kg_per_raw = [0.0] * 4
+        self.idle_reports = 0
+        self.drift_start = None
+        # kg per hour, total of the four sensors
+        self.drift_rate = 0.0
+
+    def update_calibration(self, table):
+        for i, pos in enumerate((TOP_RIGHT, BOTTOM_RIGHT, TOP_LEFT, BOTTOM_LEFT)):
+            self.zero[i] = table.zero[pos]
+            self.kg_per_raw[i] = table.low_slope[pos]
+            self.max_raw[i] = self.max_offset / table.low_slope[pos] if table.low_slope[pos] else 0.0
+
+    # raw words as received, before the offsets are taken off
+    def update(self, raw_tr, raw_br, raw_tl, raw_bl):
+        alpha = self.alpha
+        offsets = self.offsets
+        zero = self.zero
+        max_raw = self.max_raw
+        for i, raw in ((0, raw_tr), (1, raw_br), (2, raw_tl), (3, raw_bl)):
+            deviation = raw - zero[i]
+            if -max_raw[i] <= deviation <= max_raw[i]:
+                offsets[i] += alpha * (deviation - offsets[i])
+        self.idle_reports += 1
+        if self.idle_reports % DRIFT_REPORTS == 0:
+            self.measure_drift()
+
+    def measure_drift(self):
+        now = self.clock()
+        total = self.total_offset()
+        if self.drift_start is not None and now > self.drift_start[0]:
+            rate = (total - self.drift_start[1]) / (now - self.drift_start[0]) * 3600
+            self.drift_rate += DRIFT_SMOOTHING * (rate - self.drift_rate)
+        self.drift_start = (now, total)
+
+    # offsets in kg, report order (top right, bottom right, top left, bottom left)
+    def offsets_kg(self):
+        return [offset * scale for offset, scale in zip(self.offsets, self.kg_per_raw)]
+
+    def total_offset(self):
+        return sum(self.offsets_kg())
+
+
+class BoardDecoder:
+    def __init__(self, calibration=None, tare=None):
+        self.table = CalibrationTable(calibration or dummy_calibration())
+        self.tare = tare
+        self._bind()
+
+    def update_calibration(self, calibration):
+        self.table.update(calibration)
+        self._bind()
+
+    def set_tare(self, tare):
+        self.tare = tare
+        self._bind()
+
+    # flatten table into locals-friendly tuples, decode() is called ~100 times per second
+    def _bind(self):
+        t = self.table
+        self._tr = (t.zero[TOP_RIGHT], t.mid[TOP_RIGHT], t.low_slope[TOP_RIGHT], t.high_slope[TOP_RIGHT])
+        self._br = (t.zero[BOTTOM_RIGHT], t.mid[BOTTOM_RIGHT], t.low_slope[BOTTOM_RIGHT],
+                    t.high_slope[BOTTOM_RIGHT])
+        self._tl = (t.zero[TOP_LEFT], t.mid[TOP_LEFT], t.low_slope[TOP_LEFT], t.high_slope[TOP_LEFT])
+        self._bl = (t.zero[BOTTOM_LEFT], t.mid[BOTTOM_LEFT], t.low_slope[BOTTOM_LEFT],
+                    t.high_slope[BOTTOM_LEFT])
+        if self.tare is not None:
+            self.tare.update_calibration(t)
+
+    # data is the raw report (str, bytearray or memoryview), offset points at the button word.
+    # returns (buttons, top_left, top_right, bottom_left, bottom_right) with masses in kg
+    def decode(self, data, offset=EXTENSION_REPORT_OFFSET):
+        buttons, raw_tr, raw_br, raw_tl, raw_bl = EXTENSION_REPORT.unpack_from(data, offset)
+        tare = self.tare
+        if tare is None:
+            return buttons, _mass(raw_tl, self._tl), _mass(raw_tr, self._tr), \
+                _mass(raw_bl, self._bl), _mass(raw_br, self._br)
+        o_tr, o_br, o_tl, o_bl = tare.offsets
+        tl = _mass(raw_tl - o_tl, self._tl)
+        tr = _mass(raw_tr - o_tr, self._tr)
+        bl = _mass(raw_bl - o_bl, self._bl)
+        br = _mass(raw_br - o_br, self._br)
+        if tl + tr + bl + br < tare.idle_weight:
+            tare.update(raw_tr, raw_br, raw_tl, raw_bl)
+        return buttons, tl, tr, bl, br
+
+    def decode_raw(self, data, offset=EXTENSION_REPORT_OFFSET):
+        return EXTENSION_REPORT.unpack_from(data, offset)
+
+
+def _mass(raw, piece):
+    zero, mid, low_slope, high_slope = piece
+    if raw < mid:
+        if raw < zero:
+            return 0.0
+        return (raw - zero) * low_slope
+    return CALIBRATION_STEP_KG + (raw - mid) * high_slope
@@ -0,0 +1,222 @@
+import Queue
+import logging
+import profiler
+import select
+import threading
+import time
+
+from datetime import datetime
+from boardsupervisor import MIN_RECONNECT_DELAY, MAX_RECONNECT_DELAY
+from eventprocessor import weight_correction
+
+# longest wait for reports, stop() and reconnects are looked at in between
+SELECT_TIMEOUT = 0.1
+
+
+class SerializedWeightProcessor:
+    # One WeightProcessor shared by all boards. Finished weights are queued and processed one at
+    # a time by a writer thread, so saving a weight never holds up the event loop. User lookups
+    # of the live display don't take the lock: the UserIndex publishes every update as a new
+    # snapshot, so a lookup never waits for a save. on_processed(board name, record) runs after
+    # each weight was processed, in the writer thread.
+    def __init__(self, weight_processor, on_processed=None):
+        self.weight_processor = weight_processor
+        self.on_processed = on_processed
+        self.trace = profiler.trace()
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue()
+        self.thread = None
+        self.processed = 0
+        self.failed = 0
+
+    def get_user_by_weight(self, w):
+        return self.weight_processor.get_user_by_weight(w)
+
+    def submit(self, name, weight):
+        self.queue.put((name, weight))
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="weight-writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        from dataprovider import WeightRecord
+
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            name, weight = item
+            if self.trace is not None:
+                self.trace.activate(name)
+            today = datetime.today()
+            record = WeightRecord({'year': today.year, 'month': today.month, 'day': today.day, 'w': weight})
+            try:
+                with self.lock:
+                    self.weight_processor.process(record)
+                self.processed += 1
+            except Exception:
+                logging.exception("Could not save {} kg from board {}".format(weight, name))
+                self.failed += 1
+                continue
+            if self.on_processed is not None:
+                self.on_processed(name, record)
+
+    # waits until everything submitted so far was processed
+    def stop(self, timeout=None):
+        self.queue.put(None)
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+
+class ManagedBoard:
+    # a board with its own events processor (calibration, tare, estimator and session state are
+    # all per board) and its reconnect backoff. While connecting the board belongs to the
+    # connector thread, the event loop doesn't touch it
+    def __init__(self, name, board, processor, address):
+        self.name = name
+        self.board = board
+        self.processor = processor
+        self.address = address
+        self.next_connect = 0
+        self.delay = MIN_RECONNECT_DELAY
+        self.measurements = 0
+        self.connecting = False
+
+
+class BoardManager:
+    # Drives several boards from one thread: the receive sockets are non-blocking and multiplexed
+    # with select(), every readable board gets receive_pending(). A finished measurement goes to
+    # the shared SerializedWeightProcessor and the board's processor is reset for the next one.
+    # Boards that are not connected (never were, or the link dropped) are retried with the same
+    # exponential backoff as BoardSupervisor. The bluetooth connects block for the whole page
+    # timeout when a board is off, so they run in a connector thread, one board after the other,
+    # and the loop takes the board back on its next round. The connected boards are read all the
+    # while. With reconnect=False a board that is not connected stays that way (replays, tests).
+    def __init__(self, writer, min_delay=MIN_RECONNECT_DELAY, max_delay=MAX_RECONNECT_DELAY, reconnect=True):
+        self.writer = writer
+        self.reconnect = reconnect
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.boards = []
+        self.stopped = False
+        # boards to connect, and boards back from the connector (connected or not)
+        self.requests = Queue.Queue()
+        self.results = Queue.Queue()
+        self.connector = None
+        self.lock = threading.Lock()
+        self.trace = profiler.trace()
+
+    # processor is the board's events processor, already given to the Wiiboard
+    def add(self, name, board, processor, address=None):
+        managed = ManagedBoard(name, board, processor, address)
+        self.boards.append(managed)
+        if board.is_connected():
+            self.prepare(managed)
+        return managed
+
+    def prepare(self, managed):
+        managed.board.transport.setblocking(False)
+        managed.delay = self.min_delay
+        managed.processor.reset()
+
+    # hands a board that is due to the connector thread
+    def request_connect(self, managed):
+        if (managed.address or managed.board.address) is None:
+            return
+        if self.connector is None:
+            self.connector = threading.Thread(target=self.connect_loop, name="board-connector")
+            self.connector.daemon = True
+            self.connector.start()
+        managed.connecting = True
+        self.requests.put(managed)
+
+    def connect_loop(self):
+        while True:
+            managed = self.requests.get()
+            if managed is None:
+                return
+            board = managed.board
+            address = managed.address or board.address
+            if board.address is None:
+                board.try_connect(address)
+            else:
+                board.reconnect(address)
+            with self.lock:
+                if self.stopped:
+                    # run() has finished with the boards, this one is closed here
+                    if board.is_connected():
+                        board.status = "Disconnected"
+                    board.disconnect()
+                    continue
+                self.results.put(managed)
+
+    # takes back the boards the connector is done with
+    def take_connected(self, now):
+        while True:
+            try:
+                managed = self.results.get_nowait()
+            except Queue.Empty:
+                return
+            managed.connecting = False
+            if managed.board.is_connected():
+                logging.info("Board {} connected".format(managed.name))
+                self.prepare(managed)
+            else:
+                managed.next_connect = now + managed.delay
+                managed.delay = min(managed.delay * 2, self.max_delay)
+
+    # one round: takes back connected boards, hands the due ones to the connector, waits up to
+    # <timeout> for reports and handles them. Returns the number of reports handled
+    def poll(self, timeout=SELECT_TIMEOUT):
+        now = time.time()
+        self.take_connected(now)
+        connected = {}
+        for managed in self.boards:
+            if managed.connecting:
+                continue
+            if managed.board.is_connected():
+                connected[managed.board.fileno()] = managed
+            elif self.reconnect and managed.next_connect <= now:
+                self.request_connect(managed)
+        if not connected:
+            time.sleep(timeout)
+            return 0
+        readable, _, _ = select.select(connected.keys(), [], [], timeout)
+        handled = 0
+        for fd in readable:
+            managed = connected[fd]
+            if self.trace is not None:
+                self.trace.activate(managed.name)
+            handled += managed.board.receive_pending()
+            if managed.processor.done:
+                managed.measurements += 1
+                self.writer.submit(managed.name, managed.processor.weight + weight_correction(managed.board))
+                managed.processor.reset()
+                managed.board.set_light(False)
+            if not managed.board.is_connected():
+                logging.info("Board {} disconnected".format(managed.name))
+                managed.next_connect = time.time() + managed.delay
+        return handled
+
+    # until stop(), or with <until_disconnected> until no board is connected any more
+    def run(self, until_disconnected=False):
+        while not self.stopped:
+            self.poll()
+            if until_disconnected and not any(m.board.is_connected() for m in self.boards):
+                break
+        with self.lock:
+            self.stopped = True
+        self.requests.put(None)
+        self.take_connected(time.time())
+        for managed in self.boards:
+            if managed.connecting:
+                continue
+            # nobody else receives on these boards, they are closed right away
+            if managed.board.is_connected():
+                managed.board.status = "Disconnected"
+            managed.board.disconnect()
+
+    def stop(self):
+        self.stopped = True
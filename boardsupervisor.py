@@ -0,0 +1,66 @@
+import logging
+import time
+
+from wiiboard import save_address
+
+# first retry after a lost link comes quickly, the board usually answers right after waking up
+MIN_RECONNECT_DELAY = 0.1
+
+# a board that stays off (batteries out, out of range) is retried this often at most
+MAX_RECONNECT_DELAY = 30.0
+
+
+class BoardSupervisor:
+    # Brings the board back after the link drops (board went to sleep, out of range, socket
+    # error): reconnects to the last address with exponential backoff. The board keeps the
+    # calibration it already read when the address is the same, so reports are decoded right
+    # after the reporting mode is armed again.
+    def __init__(self, board, address_path=None, min_delay=MIN_RECONNECT_DELAY,
+                 max_delay=MAX_RECONNECT_DELAY, sleep=time.sleep):
+        self.board = board
+        self.address_path = address_path
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.sleep = sleep
+        self.stopped = False
+        self.reconnects = 0
+        self.failures = 0
+
+    # blocks until the board is connected again, False if stopped before that
+    def reconnect(self):
+        address = self.board.address
+        if address is None:
+            return False
+        delay = self.min_delay
+        lost = time.time()
+        logging.info("Link to the board lost, reconnecting to {}".format(address))
+        while not self.stopped:
+            if self.board.reconnect(address):
+                self.reconnects += 1
+                logging.info("Board reconnected after {:.2f}s".format(time.time() - lost))
+                if self.address_path is not None:
+                    save_address(self.address_path, address)
+                return True
+            self.failures += 1
+            self.sleep(delay)
+            delay = min(delay * 2, self.max_delay)
+        return False
+
+    # receives until stopped, reconnecting whenever the link drops. for the single threaded
+    # loop, which needs to act on every finished measurement, see supervise()
+    def run(self):
+        while not self.stopped:
+            self.board.receive()
+            if not self.supervise():
+                return
+
+    # after receive() returned: reconnects if the link was lost, False once stopped
+    def supervise(self):
+        if self.stopped:
+            return False
+        if self.board.is_connected():
+            return True
+        return self.reconnect()
+
+    def stop(self):
+        self.stopped = True
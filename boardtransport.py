@@ -0,0 +1,193 @@
+import logging
+import struct
+import time
+
+# biggest input report of the board is 23 bytes, keep some slack like the original recv(25)
+PACKET_SIZE = 25
+
+RECEIVE_PSM = 0x13
+CONTROL_PSM = 0x11
+
+# capture file: sequence of (timestamp, direction, length) headers followed by the raw report
+CAPTURE_HEADER = struct.Struct("<dBH")
+CAPTURE_IN = 0
+CAPTURE_OUT = 1
+
+
+def discover_devices(duration):
+    import bluetooth
+    return bluetooth.discover_devices(duration=duration, lookup_names=True)
+
+
+class PacketRing:
+    # Fixed set of preallocated packet buffers reused round robin. recv_into writes straight
+    # into a slot and consumers get the matching memoryview, so nothing is allocated per packet.
+    # A slot stays valid until the ring wraps around, which gives later stages some room to
+    # hold on to a packet while the next ones are being received.
+    def __init__(self, slots=64, slot_size=PACKET_SIZE):
+        self.slot_size = slot_size
+        self.buffers = [bytearray(slot_size) for _ in xrange(slots)]
+        self.views = [memoryview(b) for b in self.buffers]
+        self.slots = slots
+        self.position = 0
+
+    def next_slot(self):
+        slot = self.position
+        self.position = (slot + 1) % self.slots
+        return slot
+
+
+class ReceiveStats:
+    def __init__(self):
+        self.received = 0
+        self.decoded = 0
+        self.dropped = 0
+        # weight reports of an empty board skipped before decoding
+        self.idle = 0
+        self.bytes = 0
+        self.started = None
+        self.finished = None
+
+    def reset(self):
+        self.__init__()
+
+    def packets_per_second(self):
+        if self.started is None or self.finished is None or self.finished <= self.started:
+            return 0.0
+        return self.received / (self.finished - self.started)
+
+    def __str__(self):
+        return "received {} decoded {} idle {} dropped {} ({:.0f} packets/s)".format(
+            self.received, self.decoded, self.idle, self.dropped, self.packets_per_second())
+
+
+class SocketTransport:
+    # any pair of connected packet sockets, e.g. socket.socketpair(AF_UNIX, SOCK_SEQPACKET)
+    def __init__(self, receive_socket, control_socket=None):
+        self.receive_socket = receive_socket
+        self.control_socket = control_socket
+
+    def connect(self, address):
+        return True
+
+    def recv_into(self, buf, nbytes):
+        return self.receive_socket.recv_into(buf, nbytes)
+
+    def fileno(self):
+        return self.receive_socket.fileno()
+
+    # False for an event loop: recv_into raises EAGAIN instead of waiting
+    def setblocking(self, blocking):
+        self.receive_socket.setblocking(blocking)
+
+    def send(self, data):
+        if self.control_socket is not None:
+            self.control_socket.send(data)
+
+    def close(self):
+        for s in (self.receive_socket, self.control_socket):
+            try:
+                if s is not None:
+                    s.close()
+            except:
+                pass
+
+
+class L2capTransport(SocketTransport):
+    def __init__(self):
+        import bluetooth
+        try:
+            SocketTransport.__init__(self, bluetooth.BluetoothSocket(bluetooth.L2CAP),
+                                     bluetooth.BluetoothSocket(bluetooth.L2CAP))
+        except ValueError:
+            raise Exception("Error: Bluetooth not found")
+        # pybluez sockets don't implement recv_into on every version
+        self._native_recv_into = hasattr(self.receive_socket, 'recv_into')
+
+    def connect(self, address):
+        self.receive_socket.connect((address, RECEIVE_PSM))
+        self.control_socket.connect((address, CONTROL_PSM))
+        return self.receive_socket is not None and self.control_socket is not None
+
+    def recv_into(self, buf, nbytes):
+        if self._native_recv_into:
+            return self.receive_socket.recv_into(buf, nbytes)
+        data = self.receive_socket.recv(nbytes)
+        size = len(data)
+        buf[:size] = data
+        return size
+
+
+class CaptureWriter:
+    def __init__(self, path):
+        self.file = open(path, 'ab')
+
+    def write(self, data, direction=CAPTURE_IN, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        else:
+            data = str(data)
+        self.file.write(CAPTURE_HEADER.pack(timestamp, direction, len(data)))
+        self.file.write(data)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def read_capture(path):
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(CAPTURE_HEADER.size)
+            if len(header) < CAPTURE_HEADER.size:
+                return
+            timestamp, direction, size = CAPTURE_HEADER.unpack(header)
+            data = f.read(size)
+            if len(data) < size:
+                logging.warning("Truncated capture record in {}".format(path))
+                return
+            yield timestamp, direction, data
+
+
+class CaptureTransport:
+    # replays the incoming reports of a capture file, outgoing commands are discarded.
+    # recv_into returns 0 at the end of the capture, the same as a closed socket.
+    # with realtime the reports come at the pace they were recorded, otherwise as fast as possible
+    def __init__(self, path, realtime=False):
+        records = [(timestamp, data) for timestamp, direction, data in read_capture(path)
+                   if direction == CAPTURE_IN]
+        self.timestamps = [timestamp for timestamp, _ in records]
+        self.packets = [data for _, data in records]
+        self.realtime = realtime
+        self.started = None
+        self.position = 0
+        self.sent = 0
+
+    def connect(self, address):
+        return True
+
+    def recv_into(self, buf, nbytes):
+        if self.position >= len(self.packets):
+            return 0
+        if self.realtime:
+            now = time.time()
+            if self.started is None:
+                self.started = now - (self.timestamps[self.position] - self.timestamps[0])
+            delay = self.started + (self.timestamps[self.position] - self.timestamps[0]) - now
+            if delay > 0:
+                time.sleep(delay)
+        data = self.packets[self.position]
+        self.position += 1
+        size = min(len(data), nbytes)
+        buf[:size] = data[:size]
+        return size
+
+    def send(self, data):
+        self.sent += 1
+
+    def close(self):
+        pass
@@ -0,0 +1,250 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from datetime import date, timedelta
+from atomicfile import write_atomic
+
+# regular records older than this many days are rolled into daily summaries
+COMPACT_AFTER_DAYS = 90
+
+# seconds one pass may take, checked before every slice of days
+PASS_BUDGET = 0.5
+
+# days of a month compacted in one unit of work, holding the lock
+SLICE_DAYS = 7
+
+# seconds between two passes of the background thread
+PASS_INTERVAL = 600
+
+# readings nobody matched are stored under this user
+UNASSIGNED_USER = 'User'
+
+
+def month_after(year, month):
+    if month == 12:
+        return year + 1, 1
+    return year, month + 1
+
+
+def day_key(record):
+    return record.year, record.month, record.day
+
+
+def summarize(user, day, records, summary=None):
+    if summary is None:
+        summary = {'year': day[0], 'month': day[1], 'day': day[2], 'user': user,
+                   'morning': False, 'last': False, 'summary': True, 'count': 0, 'min': None, 'max': None, 'w': 0.0}
+    total = summary['w'] * summary['count']
+    for record in records:
+        w = record.w
+        total += w
+        summary['count'] += 1
+        summary['min'] = w if summary['min'] is None else min(summary['min'], w)
+        summary['max'] = w if summary['max'] is None else max(summary['max'], w)
+    summary['w'] = round(total / summary['count'], 2)
+    return summary
+
+
+class Compactor:
+    # Rolls the regular (non-morning) records older than <after_days> into one summary record per
+    # user and day (w is the mean, plus count, min and max) and drops the readings nobody matched,
+    # appending them to <archive_path> as JSON lines first when one is given. Morning records and
+    # anything flagged last are never touched, so the morning line and "last" stay as they were.
+    #
+    # Works a month at a time, oldest first, the month kept in the checkpoint. A month is read
+    # without <lock> from the provider's index of regular records (CachedDataProvider), only a
+    # provider without one is queried holding it. The month is then compacted SLICE_DAYS days at
+    # a time, each slice in one unit of work under <lock> (summaries saved and originals deleted
+    # together), so threads sharing the data provider wait for one slice at most. The budget is
+    # checked before every slice: a pass stops when it is used up and the next one reads the month
+    # again, where the days already done have nothing left to compact. The month holding the
+    # cutoff is looked at again by every pass. The archive is written before each unit, a line
+    # per record keyed by its pk, so a slice whose unit failed doesn't archive the same readings
+    # again.
+    def __init__(self, data, checkpoint_path=None, archive_path=None, after_days=COMPACT_AFTER_DAYS,
+                 budget=PASS_BUDGET, lock=None, clock=time.time):
+        self.data = data
+        self.checkpoint_path = checkpoint_path
+        self.archive_path = archive_path
+        self.after_days = after_days
+        self.budget = budget
+        self.lock = lock or threading.Lock()
+        self.clock = clock
+        self.month = None
+        self.compacted = 0
+        self.summaries = 0
+        self.unassigned = 0
+        self.stopped = threading.Event()
+        self.thread = None
+        # pks of the archived readings, read from the archive on first use
+        self.archived = None
+        if checkpoint_path is not None and os.path.exists(checkpoint_path):
+            try:
+                with open(checkpoint_path, 'rb') as f:
+                    self.month = tuple(json.load(f)['month'])
+            except (ValueError, KeyError):
+                logging.error("Compaction checkpoint {} is corrupted, starting over".format(checkpoint_path))
+
+    # the provider's RecordIndex when it keeps the regular records
+    def index(self):
+        records = getattr(self.data, 'records', None)
+        if records is not None and records.regular is not None:
+            return records
+        return None
+
+    # only without a checkpoint, once per database
+    def first_month(self):
+        from dataprovider import WeightRecord
+        index = self.index()
+        if index is not None:
+            months = index.regular_months()
+            return months[0] if months else None
+        first = None
+        with self.lock:
+            for record in self.data.db.filter(WeightRecord, {'morning': False}):
+                if first is None or (record.year, record.month) < first:
+                    first = (record.year, record.month)
+        return first
+
+    def month_records(self, month):
+        from dataprovider import WeightRecord
+        index = self.index()
+        if index is not None:
+            return index.regular_records(*month)
+        with self.lock:
+            return list(self.data.db.filter(WeightRecord, {'morning': False, 'year': month[0], 'month': month[1]}))
+
+    # one pass, returns True when everything old enough is compacted
+    def run_pass(self, today=None):
+        deadline = self.clock() + self.budget
+        cutoff = (today or date.today()) - timedelta(days=self.after_days)
+        last_month = (cutoff.year, cutoff.month)
+        if self.month is None:
+            self.month = self.first_month()
+            if self.month is None:
+                return True
+            self.save_checkpoint()
+        while True:
+            if not self.compact_month(self.month, (cutoff.year, cutoff.month, cutoff.day), deadline):
+                return False
+            if self.month >= last_month:
+                self.save_checkpoint()
+                return True
+            self.month = month_after(*self.month)
+            self.save_checkpoint()
+            if self.clock() >= deadline:
+                return False
+
+    # False when the deadline came before the month was done
+    def compact_month(self, month, cutoff, deadline):
+        days = {}
+        for record in self.month_records(month):
+            if day_key(record) >= cutoff or getattr(record, 'last', False):
+                continue
+            user = getattr(record, 'user', UNASSIGNED_USER)
+            entry = days.setdefault((user, day_key(record)), [None, []])
+            if getattr(record, 'summary', False):
+                entry[0] = record
+            else:
+                entry[1].append(record)
+        pending = sorted(set(day for (_, day), (_, originals) in days.items() if originals))
+        for first in xrange(0, len(pending), SLICE_DAYS):
+            if self.clock() >= deadline:
+                return False
+            selected = set(pending[first:first + SLICE_DAYS])
+            entries = sorted((key, entry) for key, entry in days.items() if key[1] in selected and entry[1])
+            if self.archive_path is not None:
+                self.archive([r for (name, _), (_, originals) in entries if name == UNASSIGNED_USER
+                              for r in originals])
+            with self.lock:
+                self.compact_days(entries)
+        return True
+
+    # [((user, day), (summary or None, originals))] in one unit of work
+    def compact_days(self, entries):
+        from dataprovider import WeightRecord
+
+        compacted = summaries = unassigned = 0
+        # the stored summaries changed so far, with their fields as they are stored
+        changed = []
+        try:
+            with self.data.unit_of_work():
+                for (user, day), (summary, originals) in entries:
+                    for record in originals:
+                        self.data.delete(record)
+                    compacted += len(originals)
+                    if user == UNASSIGNED_USER:
+                        unassigned += len(originals)
+                        continue
+                    if summary is None:
+                        summary = WeightRecord(summarize(user, day, originals))
+                        summaries += 1
+                    else:
+                        stored = dict((k, getattr(summary, k)) for k in ('count', 'min', 'max', 'w'))
+                        changed.append((summary, stored))
+                        for name, value in summarize(user, day, originals, dict(stored)).items():
+                            setattr(summary, name, value)
+                    self.data.save(summary)
+        except:
+            # the index hands out the same summaries again, they must not keep the failed update
+            for summary, stored in changed:
+                for name, value in stored.items():
+                    setattr(summary, name, value)
+            raise
+        self.compacted += compacted
+        self.summaries += summaries
+        self.unassigned += unassigned
+
+    # appends the readings not archived yet, durably before they are deleted
+    def archive(self, records):
+        archived = self.archived_pks()
+        records = [r for r in records if r.pk not in archived]
+        if not records:
+            return
+        with open(self.archive_path, 'ab') as f:
+            for record in records:
+                f.write(json.dumps({'pk': record.pk, 'year': record.year, 'month': record.month,
+                                    'day': record.day, 'w': record.w, 'time': getattr(record, 'time', None)}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        archived.update(r.pk for r in records)
+
+    def archived_pks(self):
+        if self.archived is None:
+            self.archived = set()
+            if os.path.exists(self.archive_path):
+                with open(self.archive_path, 'rb') as f:
+                    for line in f:
+                        try:
+                            self.archived.add(json.loads(line).get('pk'))
+                        except ValueError:
+                            # a line cut short by a crash, its readings are written again
+                            pass
+        return self.archived
+
+    def save_checkpoint(self):
+        if self.checkpoint_path is not None:
+            write_atomic(self.checkpoint_path, json.dumps({'month': list(self.month)}))
+
+    def start(self, interval=PASS_INTERVAL):
+        self.thread = threading.Thread(target=self.loop, args=(interval,), name="compaction")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def loop(self, interval):
+        while not self.stopped.is_set():
+            try:
+                done = self.run_pass()
+                logging.debug("Compaction: {} records into {} summaries, {} unassigned dropped".format(
+                    self.compacted, self.summaries, self.unassigned))
+            except Exception:
+                logging.exception("Compaction pass failed")
+                done = True
+            # right on with the next pass while there is a backlog
+            self.stopped.wait(interval if done else 1)
+
+    def stop(self):
+        self.stopped.set()
@@ -1,3 +1,8 @@
+import bisect
+import metrics
+import time
+
+from contextlib import contextmanager
 from blitzdb import FileBackend, Document
 
 
@@ -12,8 +17,140 @@ class WeightRecord(Document):
     pass
 
 
-class DataProvider:
+class UnitOfWork:
+    # Records saved during one measurement. Records already stored only ever change their last
+    # flag, the flag they have in storage is kept to put it back on rollback. Deleted records
+    # (compaction) are left as they are in memory.
+    def __init__(self):
+        self.records = []
+        self.stored_last = {}
+        self.deleted = []
+
+    def add(self, record, stored_last):
+        if id(record) not in self.stored_last:
+            self.records.append(record)
+            self.stored_last[id(record)] = stored_last
+
+    def restore(self):
+        for record in self.records:
+            last = self.stored_last[id(record)]
+            if last is None:
+                # never stored, whatever key the failed write gave it is gone
+                record.pk = None
+            else:
+                record.last = last
+
+
+class Transactional:
+    # begin() .. commit() collects the saves in between and writes them as one atomic batch
+    # (write_batch of the provider), rollback() or a failed write puts the saved records back as
+    # they are stored. Queries between begin() and commit() don't see the pending saves.
+    # With group_commit(n) the units of n commits are written together (bulk imports), flush()
+    # writes what is pending. Without begin() save() and commit() work as they always did.
+    # version counts the writes, readers elsewhere (the query API) use it to tell what changed.
+    # With metrics commit() and the batch writes are timed here, a metrics.Timed proxy around the
+    # provider doesn't see the commit of unit_of_work().
+    def __init__(self):
+        self.work = None
+        self.pending = []
+        self.group_size = 1
+        self.batches = 0
+        self.version = 0
+        self.latency = None
+        if metrics.enabled():
+            self.latency = metrics.histogram("scale_db_seconds", "Database call latency",
+                                             metrics.LATENCY_BUCKETS, 'method')
+
+    def timed(self, name, func, *args):
+        if self.latency is None:
+            return func(*args)
+        start = time.time()
+        try:
+            return func(*args)
+        finally:
+            self.latency.observe(time.time() - start, name)
+
+    def begin(self):
+        if self.work is not None:
+            raise Exception("A unit of work is already open")
+        self.work = UnitOfWork()
+
+    # True if the record was queued in the open unit of work
+    def queue(self, record):
+        if self.work is None:
+            return False
+        stored_last = None
+        if getattr(record, 'pk', None) is not None:
+            stored_last = self.stored_last(record)
+        self.work.add(record, stored_last)
+        return True
+
+    def delete(self, record):
+        if self.work is not None:
+            self.work.deleted.append(record)
+            return
+        self.timed('write_batch', self.write_batch, [], [record])
+        self.version += 1
+
+    def commit(self):
+        self.timed('commit', self._commit)
+
+    def _commit(self):
+        if self.work is None:
+            self.sync()
+            return
+        work = self.work
+        self.work = None
+        self.pending.append(work)
+        if len(self.pending) >= self.group_size:
+            self.flush()
+
+    def flush(self):
+        pending = self.pending
+        self.pending = []
+        records = []
+        deleted = []
+        seen = set()
+        for work in pending:
+            for record in work.records:
+                if id(record) not in seen:
+                    seen.add(id(record))
+                    records.append(record)
+            deleted.extend(work.deleted)
+        if not records and not deleted:
+            return
+        try:
+            self.timed('write_batch', self.write_batch, records, deleted)
+        except:
+            for work in reversed(pending):
+                work.restore()
+            raise
+        self.batches += 1
+        self.version += 1
+
+    def rollback(self):
+        if self.work is not None:
+            self.work.restore()
+            self.work = None
+
+    @contextmanager
+    def unit_of_work(self):
+        self.begin()
+        try:
+            yield
+        except:
+            self.rollback()
+            raise
+        self.commit()
+
+    def group_commit(self, size):
+        self.flush()
+        self.group_size = size
+
+
+class DataProvider(Transactional):
     def __init__(self, db_path):
+        Transactional.__init__(self)
         self.db = FileBackend(db_path)
 
     def last(self, user):
@@ -39,7 +176,149 @@ class DataProvider:
             'year': data.year, 'month': data.month, 'day': data.day, 'user': data.user, 'morning': True}))
 
     def save(self, record):
+        if self.queue(record):
+            return
         record.save(self.db)
+        self.version += 1
 
-    def commit(self):
+    def sync(self):
         self.db.commit()
+
+    def stored_last(self, record):
+        return getattr(self.db.get(WeightRecord, {'pk': record.pk}), 'last', False)
+
+    # saves, deletes and one index commit, blitzdb drops the index changes again if any of them fails.
+    # Atomic but not durable: blitzdb writes its blobs and index without fsync, a power cut right
+    # after the commit can still lose the batch. Only the binary log (weightlog) is fsynced
+    def write_batch(self, records, deleted=()):
+        try:
+            for record in records:
+                record.save(self.db)
+            for record in deleted:
+                self.db.delete(record)
+            self.db.commit()
+        except:
+            self.db.rollback()
+            raise
+
+
+def date_key(record):
+    return record.year, record.month, record.day
+
+
+class RecordIndex:
+    # per-user indexes answering the DataProvider queries without touching the storage. With
+    # regular=True the regular records are kept as well, per (year, month), for the compaction
+    def __init__(self, regular=False):
+        self.last_records = {}
+        self.last_mornings = {}
+        self.mornings_by_date = {}
+        self.mornings = {}
+        self.morning_times = {}
+        self.regular = {} if regular else None
+
+    def last(self, user):
+        return self.last_records.get(user)
+
+    def all_mornings(self, user):
+        return list(self.mornings.get(user, ()))
+
+    def last_morning(self, data):
+        return self.last_mornings.get(data.user)
+
+    def today_morning(self, data):
+        return self.mornings_by_date.get((data.user,) + date_key(data))
+
+    def add(self, record):
+        user = getattr(record, 'user', None)
+        morning = getattr(record, 'morning', False)
+        last = getattr(record, 'last', False)
+
+        if last:
+            self.last_records[user] = record
+            if morning:
+                self.last_mornings[user] = record
+        else:
+            if self.last_records.get(user) is record:
+                del self.last_records[user]
+            if self.last_mornings.get(user) is record:
+                del self.last_mornings[user]
+
+        if morning:
+            self.mornings_by_date.setdefault((user,) + date_key(record), record)
+            self.insert_morning(user, record)
+        elif self.regular is not None:
+            records = self.regular.setdefault((record.year, record.month), [])
+            if all(r is not record for r in records):
+                records.append(record)
+
+    def remove(self, record):
+        records = self.regular.get((record.year, record.month), [])
+        if any(r is record for r in records):
+            # a new list, readers in other threads keep the one they have
+            records = [r for r in records if r is not record]
+            if records:
+                self.regular[(record.year, record.month)] = records
+            else:
+                del self.regular[(record.year, record.month)]
+
+    # months with regular records, oldest first
+    def regular_months(self):
+        return sorted(self.regular.keys())
+
+    def regular_records(self, year, month):
+        return list(self.regular.get((year, month), ()))
+
+    def insert_morning(self, user, record):
+        mornings = self.mornings.setdefault(user, [])
+        times = self.morning_times.setdefault(user, [])
+        position = bisect.bisect_left(times, record.time)
+        # re-saving a known record (e.g. clearing its last flag) must not add it twice
+        for i in xrange(position, len(times)):
+            if times[i] != record.time:
+                break
+            if mornings[i] is record:
+                return
+        position = bisect.bisect_right(times, record.time)
+        times.insert(position, record.time)
+        mornings.insert(position, record)
+
+
+class CachedDataProvider(DataProvider):
+    # Same queries as DataProvider, answered from per-user indexes built from one full read
+    # of the collection. Indexes are kept up to date by save(), the database stays the
+    # storage and the source of truth on the next start.
+    def __init__(self, db_path):
+        DataProvider.__init__(self, db_path)
+        self.records = RecordIndex(regular=True)
+        for record in self.db.filter(WeightRecord, {}):
+            self.records.add(record)
+
+    def last(self, user):
+        return self.records.last(user)
+
+    def all_mornings(self, user):
+        return self.records.all_mornings(user)
+
+    def last_morning(self, data):
+        return self.records.last_morning(data)
+
+    def today_morning(self, data):
+        return self.records.today_morning(data)
+
+    def save(self, record):
+        if self.queue(record):
+            return
+        DataProvider.save(self, record)
+        self.records.add(record)
+
+    def stored_last(self, record):
+        return self.records.last(getattr(record, 'user', None)) is record
+
+    # only regular records are ever deleted (compaction)
+    def write_batch(self, records, deleted=()):
+        DataProvider.write_batch(self, records, deleted)
+        for record in deleted:
+            self.records.remove(record)
+        for record in records:
+            self.records.add(record)
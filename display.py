@@ -0,0 +1,297 @@
+import pygame
+
+SCREEN_WIDTH = 320
+SCREEN_HEIGHT = 240
+
+BLACK = (0, 0, 0)
+WHITE = (255, 255, 255)
+RED = (255, 0, 0)
+GREEN = (0, 255, 0)
+SILVER = (180, 180, 180)
+GRAY = (20, 20, 20)
+YELLOW = (255, 255, 0)
+
+WEIGHT_FONT_SIZE = 100
+USER_FONT_SIZE = 30
+GRAPH_FONT_SIZE = 16
+
+USER_POSITION = (60, 10)
+WEIGHT_POSITION = (60, 30)
+
+# pre-rendered weight glyphs, other characters are rendered and cached on first use
+WEIGHT_GLYPHS = "0123456789.-"
+
+# morning graph: labels left of GRAPH_LEFT, plot between GRAPH_TOP and the bottom of the screen.
+# the band starts a bit higher so the label of the last weight fits when it is the maximum
+GRAPH_BAND_TOP = 135
+GRAPH_TOP = 145
+GRAPH_LEFT = 40
+GRAPH_WIDTH = SCREEN_WIDTH - GRAPH_LEFT
+GRAPH_LABEL_X = 10
+
+# with columns closer than this the grid lines would merge, the plot gets a gray background instead
+MIN_GRID_PITCH = 3
+
+
+class Display:
+    def __init__(self, font_path):
+        self.display = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT), 0, 32)
+        pygame.font.init()
+        self.font = pygame.font.Font(font_path, WEIGHT_FONT_SIZE)
+        self.font_user = pygame.font.Font(font_path, USER_FONT_SIZE)
+        self.font_graph = pygame.font.Font(font_path, GRAPH_FONT_SIZE)
+        self.graph = GraphRenderer(self.font_graph)
+        self.graph_on_screen = None
+        self.glyphs = {}
+        self.user_surfaces = {}
+        self.weight_layout = []
+        self.user_text = None
+        self.user_rect = None
+        self.clear()
+
+    def glyph(self, char, color):
+        key = (char, color)
+        surface = self.glyphs.get(key)
+        if surface is None:
+            surface = self.font.render(char, 1, color)
+            self.glyphs[key] = surface
+        return surface
+
+    def preload_glyphs(self, colors):
+        for color in colors:
+            for char in WEIGHT_GLYPHS:
+                self.glyph(char, color)
+
+    def user_surface(self, text):
+        surface = self.user_surfaces.get(text)
+        if surface is None:
+            if len(self.user_surfaces) > 64:
+                self.user_surfaces.clear()
+            surface = self.font_user.render(text, 1, WHITE)
+            self.user_surfaces[text] = surface
+        return surface
+
+    # Weight is composed from cached glyphs and only glyphs that differ from what is on the
+    # screen are redrawn; only the changed rects are sent to the display
+    def render(self, weight_text, weight_color, user_text):
+        dirty = []
+        if user_text != self.user_text:
+            if self.user_rect is not None:
+                self.display.fill(BLACK, self.user_rect)
+                dirty.append(self.user_rect)
+            self.user_rect = self.display.blit(self.user_surface(user_text), USER_POSITION)
+            self.user_text = user_text
+            dirty.append(self.user_rect)
+
+        x, y = WEIGHT_POSITION
+        layout = []
+        for char in weight_text:
+            surface = self.glyph(char, weight_color)
+            layout.append((char, weight_color, pygame.Rect(x, y, surface.get_width(), surface.get_height())))
+            x += surface.get_width()
+
+        old = self.weight_layout
+        changed = []
+        for i in xrange(max(len(old), len(layout))):
+            previous = old[i] if i < len(old) else None
+            current = layout[i] if i < len(layout) else None
+            if previous == current:
+                continue
+            if previous is not None:
+                self.display.fill(BLACK, previous[2])
+                dirty.append(previous[2])
+            if current is not None:
+                changed.append(current)
+        for char, color, rect in changed:
+            self.display.blit(self.glyph(char, color), rect)
+            dirty.append(rect)
+        self.weight_layout = layout
+
+        if dirty:
+            if any(rect.bottom > GRAPH_BAND_TOP for rect in dirty):
+                # glyphs reach into the graph band, it has to be copied again
+                self.graph_on_screen = None
+            pygame.display.update(dirty)
+
+    def render_graph(self, all_mornings, user=None):
+        if not all_mornings:
+            return
+        dirty = self.graph.render(user, [r.w for r in all_mornings])
+        if self.graph_on_screen != (user,):
+            # screen shows something else there, the whole band has to be copied
+            dirty = [self.graph.surface.get_rect()]
+        rects = []
+        for rect in dirty:
+            screen_rect = rect.move(0, GRAPH_BAND_TOP)
+            self.display.blit(self.graph.surface, screen_rect, rect)
+            rects.append(screen_rect)
+        self.graph_on_screen = (user,)
+        pygame.display.update(rects)
+
+    def clear(self):
+        self.display.fill(BLACK)
+        self.graph_on_screen = None
+        self.weight_layout = []
+        self.user_text = None
+        self.user_rect = None
+        pygame.display.update()
+
+
+# (first, low, high, last) of consecutive buckets of values, buckets are as small as possible
+# while keeping at most <width> of them. appending a value changes only the last bucket or
+# adds a new one, unless the bucket size has to grow
+def graph_columns(values, width):
+    size = bucket_size(len(values), width)
+    result = []
+    for i in xrange(0, len(values), size):
+        bucket = values[i:i + size]
+        result.append((bucket[0], min(bucket), max(bucket), bucket[-1]))
+    return result
+
+
+def bucket_size(count, width):
+    return max(1, (count + width - 1) // width)
+
+
+class GraphCache:
+    def __init__(self):
+        self.surface = pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT - GRAPH_BAND_TOP))
+        self.layout = None
+        self.geometry = []
+        self.labels = None
+
+
+class GraphRenderer:
+    # Keeps a rendered graph band per user. A new record is drawn by recomputing the column
+    # geometry (cheap, no drawing) and redrawing only the columns that changed; the whole band
+    # is redrawn only when the vertical scale or the number of columns changes.
+    def __init__(self, font):
+        self.font = font
+        self.caches = {}
+        self.texts = {}
+        self.surface = None
+
+    def text(self, value, color):
+        key = (value, color)
+        surface = self.texts.get(key)
+        if surface is None:
+            if len(self.texts) > 256:
+                self.texts.clear()
+            surface = self.font.render(value, 1, color)
+            self.texts[key] = surface
+        return surface
+
+    def y(self, w, mn, mx):
+        return int(SCREEN_HEIGHT - (SCREEN_HEIGHT - GRAPH_TOP) * (w - mn) / float(mx - mn)) - GRAPH_BAND_TOP
+
+    # records are spread over the width while they fit, after that every pixel column is a bucket
+    def pitch(self, count):
+        return (GRAPH_WIDTH - 1) / float(min(count, GRAPH_WIDTH))
+
+    def geometry(self, values, mn, mx):
+        columns = graph_columns(values, GRAPH_WIDTH)
+        pitch = self.pitch(len(values))
+        return [(GRAPH_LEFT + int((i + 1) * pitch),
+                 self.y(first, mn, mx), self.y(low, mn, mx), self.y(high, mn, mx), self.y(last, mn, mx))
+                for i, (first, low, high, last) in enumerate(columns)]
+
+    # renders the band for <user> into its cached surface, returns the changed rects (band coordinates)
+    def render(self, user, values):
+        mx = max(values) + 1
+        mn = min(values) - 1
+        cache = self.caches.get(user)
+        if cache is None:
+            cache = self.caches[user] = GraphCache()
+        self.surface = cache.surface
+
+        geometry = self.geometry(values, mn, mx)
+        layout = (mn, mx, self.pitch(len(values)), bucket_size(len(values), GRAPH_WIDTH))
+        changed = self.changed_columns(cache, geometry)
+        if cache.layout != layout or changed is None:
+            self.draw_all(cache, geometry)
+            cache.layout = layout
+            dirty = [cache.surface.get_rect()]
+        else:
+            dirty = self.draw_changed(cache, geometry, changed)
+        cache.geometry = geometry
+
+        labels = (mx, mn, values[-1], geometry[-1][4])
+        if cache.labels != labels:
+            dirty.append(self.draw_labels(cache.surface, labels))
+            cache.labels = labels
+        return dirty
+
+    def plot_rect(self, surface):
+        return pygame.Rect(GRAPH_LEFT, GRAPH_TOP - GRAPH_BAND_TOP, GRAPH_WIDTH, surface.get_height())
+
+    def draw_all(self, cache, geometry):
+        surface = cache.surface
+        surface.fill(BLACK)
+        grid = self.grid_lines(geometry)
+        if not grid:
+            surface.fill(GRAY, self.plot_rect(surface))
+        top = GRAPH_TOP - GRAPH_BAND_TOP
+        bottom = surface.get_height()
+        if grid:
+            for x, _, _, _, _ in geometry:
+                pygame.draw.line(surface, GRAY, (x, top), (x, bottom))
+        points = []
+        for x, first, low, high, last in geometry:
+            points.extend(((x, first), (x, low), (x, high), (x, last)))
+        if len(points) > 1:
+            pygame.draw.lines(surface, SILVER, False, points)
+
+    # columns to redraw, None when redrawing everything is cheaper
+    def changed_columns(self, cache, geometry):
+        old = cache.geometry
+        if len(geometry) < len(old):
+            return None
+        changed = set()
+        for i in xrange(len(geometry)):
+            if i >= len(old) or geometry[i] != old[i]:
+                # the segment into the next column starts here
+                changed.add(i)
+                changed.add(i + 1)
+        if len(changed) > len(geometry) // 4 + 2:
+            return None
+        return changed
+
+    def draw_changed(self, cache, geometry, changed):
+        surface = cache.surface
+        grid = self.grid_lines(geometry)
+        top = GRAPH_TOP - GRAPH_BAND_TOP
+        bottom = surface.get_height()
+        dirty = []
+        for i in sorted(changed):
+            if i >= len(geometry):
+                continue
+            x, first, low, high, last = geometry[i]
+            left = geometry[i - 1][0] + 1 if i > 0 else GRAPH_LEFT
+            rect = pygame.Rect(left, top, x - left + 1, bottom - top)
+            surface.set_clip(rect)
+            if grid:
+                surface.fill(BLACK, rect)
+                pygame.draw.line(surface, GRAY, (x, top), (x, bottom))
+            else:
+                surface.fill(GRAY, rect)
+            points = [(x, first), (x, low), (x, high), (x, last)]
+            if i > 0:
+                points.insert(0, (geometry[i - 1][0], geometry[i - 1][4]))
+            pygame.draw.lines(surface, SILVER, False, points)
+            surface.set_clip(None)
+            dirty.append(rect)
+        return dirty
+
+    def grid_lines(self, geometry):
+        return (GRAPH_WIDTH - 1) / float(len(geometry)) >= MIN_GRID_PITCH
+
+    def draw_labels(self, surface, labels):
+        mx, mn, last, y_last = labels
+        rect = pygame.Rect(0, 0, GRAPH_LEFT, surface.get_height())
+        surface.set_clip(rect)
+        surface.fill(BLACK, rect)
+        surface.blit(self.text(str(mx), WHITE), (GRAPH_LABEL_X, GRAPH_TOP - GRAPH_BAND_TOP))
+        surface.blit(self.text(str(mn), WHITE), (GRAPH_LABEL_X, SCREEN_HEIGHT - 20 - GRAPH_BAND_TOP))
+        surface.blit(self.text(str(last), YELLOW), (GRAPH_LABEL_X, y_last - 8))
+        surface.set_clip(None)
+        return rect
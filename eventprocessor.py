@@ -0,0 +1,132 @@
+import logging
+import metrics
+import profiler
+import time as time_
+
+from weightestimator import create_estimator
+
+# weight below this value means nobody is on the board
+MIN_WEIGHT = 10
+
+LIVE_WEIGHT_COLOR = (180, 180, 180)
+
+# how often the live weight is redrawn during a measurement
+RENDER_INTERVAL_MS = 500
+
+# kg added to the weights of a board read with the factory zero, which reads about this much low.
+# Not added when the board's decoder tracks the zero (TareTracker)
+UNTRACKED_CORRECTION = 2
+
+
+# correction for the weights of <board>, shown and saved the same way
+def weight_correction(board):
+    decoder = getattr(board, 'decoder', None)
+    if decoder is not None and decoder.tare is not None:
+        return 0
+    return UNTRACKED_CORRECTION
+
+
+class EventProcessor:
+    # Measurement state machine fed with board events:
+    #   idle -> measured (somebody stepped on) -> done (stepped off, or weight settled)
+    # When a stability detector is given the measurement is finished as soon as the weight
+    # settles. Samples are then ignored until the user steps off, so the same stand doesn't
+    # start a new measurement.
+    def __init__(self, weight_processor, display=None, estimator=None, detector=None,
+                 render_interval=RENDER_INTERVAL_MS):
+        self.weight_processor = weight_processor
+        self.display = display
+        self.measured = False
+        self.done = False
+        self.settled = False
+        self.waiting_step_off = False
+        self.estimator = estimator or create_estimator('histogram')
+        self.detector = detector
+        self.render_interval = render_interval
+        self.board = None
+        self.last_render = 0
+        self.started = None
+        self.samples = None
+        self.time_to_stable = None
+        self.trace = profiler.trace()
+        if metrics.enabled():
+            self.samples = metrics.histogram("scale_measurement_samples", "Samples per measurement",
+                                             metrics.COUNT_BUCKETS)
+            self.time_to_stable = metrics.histogram("scale_time_to_stable_seconds",
+                                                    "Time from stepping on until the weight settled",
+                                                    metrics.STABLE_BUCKETS)
+
+    def init_board(self, board):
+        self.board = board
+
+    def reset(self):
+        if self.settled:
+            self.waiting_step_off = True
+        self.measured = False
+        self.done = False
+        self.settled = False
+        self.estimator.reset()
+        if self.detector is not None:
+            self.detector.reset()
+        self.last_render = 0
+
+    def mass(self, event):
+        if event.totalWeight > MIN_WEIGHT:
+            if self.waiting_step_off:
+                return
+            tnow = int(round(time_.time() * 1000))
+            if self.display is not None and (tnow - self.last_render) > self.render_interval:
+                weight = self.weight + weight_correction(self.board)
+                user = self.weight_processor.get_user_by_weight(weight)
+                self.display.render(str(weight), LIVE_WEIGHT_COLOR, safe_text(user))
+                self.last_render = int(round(time_.time() * 1000))
+            self.estimator.add(event.totalWeight)
+            if not self.measured:
+                if self.display is not None:
+                    self.display.clear()
+                self.board.set_light(True)
+                logging.debug("Starting measurement.")
+                self.measured = True
+                self.started = time_.time()
+                if self.trace is not None:
+                    self.trace.begin()
+            if self.detector is not None and self.detector.add(event.totalWeight):
+                logging.debug("Weight settled after %d samples", self.estimator.count())
+                self.settled = True
+                self.finish()
+                if self.time_to_stable is not None:
+                    self.time_to_stable.observe(time_.time() - self.started)
+        elif self.measured:
+            self.finish()
+        elif self.waiting_step_off:
+            logging.debug("Stepped off after settled measurement")
+            self.waiting_step_off = False
+
+    def finish(self):
+        self.done = True
+        if self.samples is not None:
+            self.samples.observe(self.estimator.count())
+
+    @property
+    def weight(self):
+        return self.estimator.weight
+
+    # zero offset of each sensor in kg (top right, bottom right, top left, bottom left) as
+    # tracked by the board's decoder, None without tare tracking
+    @property
+    def tare_offsets(self):
+        tare = self.board.decoder.tare if self.board is not None else None
+        return tare.offsets_kg() if tare is not None else None
+
+    # kg per hour the zero moved lately, None without tare tracking
+    @property
+    def drift_rate(self):
+        tare = self.board.decoder.tare if self.board is not None else None
+        return tare.drift_rate if tare is not None else None
+
+
+def safe_text(value):
+    result = str(value)
+    if value is None:
+        result = ""
+    return result
@@ -0,0 +1,150 @@
+import json
+import logging
+import os
+import time
+
+from datetime import date, timedelta
+from atomicfile import write_atomic
+
+# fitbit allows 150 requests per hour and user
+REQUESTS_PER_HOUR = 150
+
+# longest date range of a single weight log request
+PAGE_DAYS = 31
+
+# uploads between two checkpoint saves
+BATCH_SIZE = 10
+
+
+def parse_day(value):
+    year, month, day = value.split('-')
+    return date(int(year), int(month), int(day))
+
+
+# seconds to wait before retrying a rate limited request, None if it isn't a rate limit error
+def retry_after(error):
+    seconds = getattr(error, 'retry_after_secs', None)
+    if seconds is None and getattr(error, 'code', None) == 429:
+        headers = getattr(error, 'headers', None) or {}
+        seconds = headers.get('Retry-After', 60)
+    if seconds is None:
+        return None
+    return float(seconds)
+
+
+class RateLimiter:
+    # token bucket: bursts of up to <requests> and <requests> per <period> seconds on average
+    def __init__(self, requests, period=3600.0, clock=time.time, sleep=time.sleep):
+        self.capacity = float(requests)
+        self.rate = requests / float(period)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self.waited = 0.0
+
+    def acquire(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            delay = (1 - self.tokens) / self.rate
+            self.pause(delay)
+            self.tokens = 1.0
+            self.updated = self.clock()
+        self.tokens -= 1
+
+    def pause(self, seconds):
+        self.waited += seconds
+        self.sleep(seconds)
+
+    # the server said we are over the limit, nothing is left in the bucket
+    def exhausted(self, seconds):
+        self.tokens = 0.0
+        self.pause(seconds)
+        self.updated = self.clock()
+
+
+class Backfill:
+    # Pushes past morning weights to fitbit: for each user the local mornings are compared with
+    # the weights fitbit already has, fetched in PAGE_DAYS pages, and only the missing days are
+    # uploaded. Progress is checkpointed per user, so an interrupted run continues where it stopped.
+    def __init__(self, connector, data_provider, checkpoint_path, requests_per_hour=REQUESTS_PER_HOUR,
+                 page_days=PAGE_DAYS, batch_size=BATCH_SIZE, limiter=None):
+        self.connector = connector
+        self.data = data_provider
+        self.checkpoint_path = checkpoint_path
+        self.page_days = page_days
+        self.batch_size = batch_size
+        self.limiter = limiter or RateLimiter(requests_per_hour)
+        self.checkpoints = {}
+        if os.path.exists(checkpoint_path):
+            with open(checkpoint_path, 'rb') as f:
+                self.checkpoints = json.load(f)
+        self.fetched = 0
+        self.uploaded = 0
+        self.present = 0
+
+    def save_checkpoint(self, user, day):
+        self.checkpoints[user] = day.strftime("%Y-%m-%d")
+        write_atomic(self.checkpoint_path, json.dumps(self.checkpoints))
+
+    def call(self, func, *args):
+        while True:
+            self.limiter.acquire()
+            try:
+                return func(*args)
+            except Exception as e:
+                seconds = retry_after(e)
+                if seconds is None:
+                    raise
+                logging.warning("Fitbit rate limit reached, waiting {} s".format(seconds))
+                self.limiter.exhausted(seconds)
+
+    def local_mornings(self, user):
+        done = self.checkpoints.get(user)
+        done = parse_day(done) if done else None
+        mornings = {}
+        for record in self.data.all_mornings(user):
+            day = date(record.year, record.month, record.day)
+            if done is None or day > done:
+                mornings[day] = record.w
+        return mornings
+
+    def run(self, users):
+        for user in users:
+            if not self.connector.has_keys(user):
+                logging.debug("Backfill - {} doesn't have fitbit keys, skipping".format(user))
+                continue
+            self.run_user(user)
+
+    def run_user(self, user):
+        mornings = self.local_mornings(user)
+        if not mornings:
+            return
+        days = sorted(mornings)
+        logging.info("Backfill - {} mornings to check for {}".format(len(days), user))
+
+        index = 0
+        while index < len(days):
+            page_start = days[index]
+            page_end = page_start + timedelta(days=self.page_days - 1)
+            remote = self.call(self.connector.weight_logs, user,
+                               page_start.strftime("%Y-%m-%d"), page_end.strftime("%Y-%m-%d"))
+            self.fetched += 1
+
+            pending = 0
+            while index < len(days) and days[index] <= page_end:
+                day = days[index]
+                name = day.strftime("%Y-%m-%d")
+                if name in remote:
+                    self.present += 1
+                else:
+                    self.call(self.connector.upload_weight, user, mornings[day], name)
+                    self.uploaded += 1
+                    pending += 1
+                    if pending >= self.batch_size:
+                        self.save_checkpoint(user, day)
+                        pending = 0
+                index += 1
+            self.save_checkpoint(user, days[index - 1])
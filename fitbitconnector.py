@@ -0,0 +1,65 @@
+import logging
+
+from datetime import datetime
+
+POUNDS_PER_KG = 2.2046
+
+
+class FitbitConnector:
+    def __init__(self, client_id, client_key, user_provider):
+        self.client_id = client_id
+        self.client_key = client_key
+        self.user_provider = user_provider
+        # one authenticated client (and its http session) per user, created on first use
+        self.clients = {}
+
+    def has_keys(self, user):
+        return self.user_provider.fitbit_user_id(user) is not None \
+               and self.user_provider.fitbit_user_secret(user) is not None
+
+    def client(self, user):
+        authd_client = self.clients.get(user)
+        if authd_client is None:
+            # the fitbit/oauth/requests stack is only loaded with the first upload
+            import fitbit
+            authd_client = fitbit.Fitbit(self.client_id, self.client_key,
+                                         resource_owner_key=self.user_provider.fitbit_user_id(user),
+                                         resource_owner_secret=self.user_provider.fitbit_user_secret(user))
+            self.clients[user] = authd_client
+        return authd_client
+
+    # raises on any failure, callers decide whether to retry
+    def upload_weight(self, user, weight, day=None):
+        logging.debug("Fitbit - saving {} for {}".format(weight, user))
+        if day is None:
+            day = datetime.today().strftime("%Y-%m-%d")
+        # making conversion to pounds
+        fitbit_data = {'weight': weight * POUNDS_PER_KG, 'date': day}
+        try:
+            self.client(user)._COLLECTION_RESOURCE('body', data=fitbit_data)
+        except:
+            # drop the client, its session may be the reason of the failure
+            self.clients.pop(user, None)
+            raise
+
+    # weights logged on fitbit between start and end (inclusive, at most 31 days), as
+    # {"YYYY-MM-DD": kg}. when there are several logs for a day the last one wins
+    def weight_logs(self, user, start, end):
+        authd_client = self.client(user)
+        url = "{0}/{1}/user/-/body/log/weight/date/{2}/{3}.json".format(
+            authd_client.API_ENDPOINT, authd_client.API_VERSION, start, end)
+        try:
+            response = authd_client.make_request(url)
+        except:
+            self.clients.pop(user, None)
+            raise
+        return dict((log['date'], log['weight'] / POUNDS_PER_KG) for log in response.get('weight', []))
+
+    def log_weight(self, user, weight, day=None):
+        if not self.has_keys(user):
+            logging.warning("{} doesn't have fitbit keys. Weight will not be saved in fitbit cloud".format(user))
+            return
+        try:
+            self.upload_weight(user, weight, day)
+        except:
+            logging.error("Problem with FitBit request for update body weight")
@@ -0,0 +1,153 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from datetime import datetime
+from atomicfile import write_atomic
+
+RETRY_DELAY = 30
+MAX_RETRY_DELAY = 6 * 3600
+
+
+class UploadQueue:
+    # Pending uploads persisted as a small JSON file, rewritten on every change. There is at
+    # most one entry per user and day: a newer weight for the same day replaces the pending one.
+    def __init__(self, path):
+        self.path = path
+        self.entries = []
+        if os.path.exists(path):
+            try:
+                with open(path, 'rb') as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                logging.error("Upload queue {} is corrupted, starting empty".format(path))
+
+    def save(self):
+        write_atomic(self.path, json.dumps(self.entries))
+
+    def find(self, user, day):
+        for entry in self.entries:
+            if entry['user'] == user and entry['date'] == day:
+                return entry
+        return None
+
+    def put(self, user, day, weight):
+        entry = self.find(user, day)
+        if entry is None:
+            entry = {'user': user, 'date': day}
+            self.entries.append(entry)
+        entry['weight'] = weight
+        entry['attempts'] = 0
+        entry['next_try'] = 0
+        self.save()
+
+    def due(self, now):
+        return [dict(entry) for entry in self.entries if entry['next_try'] <= now]
+
+    def next_try(self):
+        if not self.entries:
+            return None
+        return min(entry['next_try'] for entry in self.entries)
+
+    # entries handed out by due() are copies, a weight queued meanwhile must not be dropped
+    def done(self, uploaded):
+        entry = self.find(uploaded['user'], uploaded['date'])
+        if entry is not None and entry['weight'] == uploaded['weight']:
+            self.entries.remove(entry)
+            self.save()
+
+    def failed(self, uploaded, now, retry_delay, max_retry_delay):
+        entry = self.find(uploaded['user'], uploaded['date'])
+        if entry is not None and entry['weight'] == uploaded['weight']:
+            entry['next_try'] = now + min(retry_delay * (2 ** entry['attempts']), max_retry_delay)
+            entry['attempts'] += 1
+            self.save()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class FitbitUploader:
+    # Drop-in for FitbitConnector.log_weight that only queues the weight. A background thread
+    # uploads queued weights through the connector and retries failures with exponential
+    # backoff; the queue is on disk, so pending weights survive restarts.
+    def __init__(self, connector, queue, retry_delay=RETRY_DELAY, max_retry_delay=MAX_RETRY_DELAY):
+        self.connector = connector
+        self.queue = queue
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.condition = threading.Condition()
+        self.running = False
+        self.uploading = False
+        self.uploaded = 0
+        self.failures = 0
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="fitbit-upload")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def log_weight(self, user, weight, day=None):
+        if not self.connector.has_keys(user):
+            logging.warning("{} doesn't have fitbit keys. Weight will not be saved in fitbit cloud".format(user))
+            return
+        if day is None:
+            day = datetime.today().strftime("%Y-%m-%d")
+        with self.condition:
+            self.queue.put(user, day, weight)
+            self.condition.notify_all()
+
+    # waits until nothing is left to upload, returns False on timeout
+    def wait_empty(self, timeout):
+        deadline = time.time() + timeout
+        with self.condition:
+            while len(self.queue) or self.uploading:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running:
+                    now = time.time()
+                    batch = self.queue.due(now)
+                    if batch:
+                        break
+                    next_try = self.queue.next_try()
+                    self.condition.wait(None if next_try is None else max(next_try - now, 0.001))
+                if not self.running:
+                    return
+                self.uploading = True
+
+            for entry in batch:
+                try:
+                    self.connector.upload_weight(entry['user'], entry['weight'], entry['date'])
+                    result = True
+                except Exception as e:
+                    logging.error("Problem with FitBit request for update body weight: {}".format(e))
+                    result = False
+                with self.condition:
+                    if result:
+                        self.uploaded += 1
+                        self.queue.done(entry)
+                    else:
+                        self.failures += 1
+                        self.queue.failed(entry, time.time(), self.retry_delay, self.max_retry_delay)
+
+            with self.condition:
+                self.uploading = False
+                self.condition.notify_all()
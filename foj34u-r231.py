@@ -1,18 +1,33 @@
 #!/usr/bin/env python
 
-import logging
 import time
-import time as time_
-import collections
-import pygame, sys, os
-import bluetooth
+
+# boot to ready latency is counted from here
+STARTED = time.time()
+
+import Queue
+import logging
+import threading
+import sys, os
 import RPi.GPIO as GPIO
-import fitbit as fitbit
 
 from datetime import datetime
-from pygame.locals import *
 from weightprocessor import WeightProcessor, WeightProcessorConfiguration
-from dataprovider import DataProvider, WeightRecord
+from wiiboard import Wiiboard, load_address, save_address
+from boardtransport import CaptureWriter
+from rawarchive import SensorArchive
+from boarddecoder import TareTracker
+from weightestimator import create_estimator, StabilityDetector
+from eventprocessor import EventProcessor, safe_text, weight_correction, LIVE_WEIGHT_COLOR
+from fitbitconnector import FitbitConnector
+from fitbitqueue import FitbitUploader, UploadQueue
+from fitbitbackfill import Backfill
+from pipeline import Pipeline, LiveDisplay
+from startup import StartupTimer, Background
+from boardsupervisor import BoardSupervisor
+from aggregates import Aggregates
+import metrics
+import profiler
 
 
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
@@ -32,6 +47,12 @@ USERS = {"Alex": {'weight': 77,
 FITBIT_CLIENT_ID = os.environ.get('FITBIT_CLIENT_ID')
 FITBIT_CLIENT_SECRET = os.environ.get('FITBIT_CLIENT_SECRET')
 
+# weights waiting for upload to fitbit, uploads are done in background and retried until they succeed
+FITBIT_QUEUE_PATH = HOME + "/fitbit_queue.json"
+
+# progress of the fitbit history backfill, delete it to check the whole history again
+FITBIT_BACKFILL_CHECKPOINT_PATH = HOME + "/fitbit_backfill.json"
+
 # initial possible diff in weights for users to define them based on USERS map
 # for example if you have here 2 and 77 for alex in the map, we will consider that
 # user is alex if we will have 77 - 2 < value < 77 + 2
@@ -47,53 +68,108 @@ MAX_WEIGHT_DIFF_BETWEEN_MORNING_CHECKS = 2
 # time limits for morning values (24 hours period). None if check should not be performed
 MORNING_HOURS = (5, 11)
 
-# path for database file
-DB_PATH = HOME + "/weight_db"
-
-CONTINUOUS_REPORTING = "04"  # Easier as string with leading zero
+# how the weight is estimated from the measurement samples: 'histogram' keeps a fixed size
+# 0.1 kg histogram updated per sample, 'counter' keeps all samples and counts them on each read
+WEIGHT_ESTIMATOR = 'histogram'
 
-COMMAND_LIGHT = 11
-COMMAND_REPORTING = 12
-COMMAND_REQUEST_STATUS = 15
-COMMAND_REGISTER = 16
-COMMAND_READ_REGISTER = 17
+# finish the measurement as soon as the weight settles instead of waiting for the user to step off.
+# settled means: over the last STABLE_WINDOW samples (~100 per second) the standard deviation is
+# below STABLE_MAX_STDDEV kg and the two halves of the window differ by less than STABLE_MAX_DRIFT kg.
+# None for STABLE_WINDOW disables early finish
+STABLE_WINDOW = 100
+STABLE_MAX_STDDEV = 0.15
+STABLE_MAX_DRIFT = 0.1
 
-# input is Wii device to host
-INPUT_STATUS = 20
-INPUT_READ_DATA = 21
+# path for database file
+DB_PATH = HOME + "/weight_db"
 
-EXTENSION_8BYTES = 32
-# end "hex" values
+# answer history queries from in-memory per-user indexes loaded once at start instead of
+# scanning the database files on every weigh-in
+DB_CACHE = True
 
-BUTTON_DOWN_MASK = 8
+# storage for weight records: 'blitzdb' (DB_PATH directory) or 'log' (append-only binary log
+# at DB_LOG_PATH, migrate an existing database with: python weightlog.py migrate DB_PATH DB_LOG_PATH)
+DB_BACKEND = 'blitzdb'
+DB_LOG_PATH = HOME + "/weight.log"
 
-TOP_RIGHT = 0
-BOTTOM_RIGHT = 1
-TOP_LEFT = 2
-BOTTOM_LEFT = 3
+# per user moving averages, trend weight, weekly/monthly min/mean/max and rate of change of the
+# morning weights, updated with every morning and rebuilt from the database when out of date
+AGGREGATES_PATH = HOME + "/weight_aggregates.json"
 
-BLUETOOTH_NAME = "Nintendo RVL-WBC-01"
+# read-only JSON API over the history, newest morning weights and aggregates on
+# http://127.0.0.1:HISTORY_API_PORT/users (see historyapi.py), served from memory by its own thread.
+# Needs the in-memory indexes (DB_CACHE or the 'log' backend), None to disable
+HISTORY_API_PORT = None
 
 os.environ["SDL_FBDEV"] = "/dev/fb1"
 
-SCREEN_WIDTH = 320
-SCREEN_HEIGHT = 240
+WEIGHT_FONT_PATH = HOME + "/OpenSans-Bold.ttf"
 
-BLACK = (0, 0, 0)
-WHITE = (255, 255, 255)
-RED = (255, 0, 0)
-GREEN = (0, 255, 0)
-SILVER = (180, 180, 180)
-GRAY = (20, 20, 20)
-YELLOW = (255, 255, 0)
+# live weight refresh during a measurement, only changed digits are redrawn
+LIVE_RENDER_INTERVAL_MS = 100
 
-WEIGHT_FONT_PATH = HOME + "/OpenSans-Bold.ttf"
-WEIGHT_FONT_SIZE = 100
-USER_FONT_SIZE = 30
-GRAPH_FONT_SIZE = 16
+# read the board in its own thread and measure in another one, so drawing and saving a weight
+# never stop the bluetooth reads. PIPELINE_QUEUE_SIZE events (~100 per second) can wait between them
+PIPELINE = True
+PIPELINE_QUEUE_SIZE = 200
 
 LOG_FILE = HOME + "/scale.log"
 
+# record every report of the board (calibration included) with timestamps to this file, None to
+# disable. benchmark.py --capture <file> replays it
+CAPTURE_PATH = None
+
+# track the zero of every sensor from the reports sent while nobody is on the board and take it
+# off in decoding, instead of trusting the factory calibration. False to use it as read
+TARE_TRACKING = True
+
+# the board sends ~100 reports per second even when nobody is on it. Those are dropped right
+# after unpacking anyway; with IDLE_REPORTING the board is also asked to report only on change
+# after ~30 s of empty board, and switched back to continuous on step on
+IDLE_REPORTING = False
+
+# keep the raw sensor words of every weighing in this directory (one file per day, see
+# rawarchive.py for the format and 'python rawarchive.py stats' for the analysis), None to disable
+RAW_ARCHIVE_PATH = None
+
+# address of the last connected board. The next start connects to it directly and only runs the
+# discovery scan when that fails. None to always discover
+BOARD_ADDRESS_PATH = HOME + "/board_address"
+
+# counters and latency histograms of the hot paths (packets, decoding, measurements, database,
+# screen, fitbit) in Prometheus text format, rewritten every 15 seconds to METRICS_PATH and,
+# with METRICS_PORT, served on http://127.0.0.1:METRICS_PORT/metrics. Costs nothing when False
+METRICS = False
+METRICS_PATH = HOME + "/scale.prom"
+METRICS_PORT = None
+
+# the board is power cycled through GPIO 4 at start, held low for this long
+GPIO_RESET_SECONDS = 3
+
+# regular (not morning) records older than this many days are rolled into one summary record per
+# user and day (count, min, max, mean) by a background thread, a bounded slice at a time; readings
+# nobody matched are dropped, appended to UNASSIGNED_ARCHIVE_PATH first unless that is None.
+# Only for the blitzdb backend, None to keep everything
+COMPACT_AFTER_DAYS = 90
+COMPACTION_CHECKPOINT_PATH = HOME + "/compaction.json"
+UNASSIGNED_ARCHIVE_PATH = HOME + "/unassigned_weights.jsonl"
+
+# on demand profiling of the running scale: 'kill -USR2 <pid>' or, with PROFILE_PORT,
+# http://127.0.0.1:PROFILE_PORT/profile?seconds=N samples the stacks of all threads for
+# PROFILE_SECONDS (or N) and writes a collapsed stack file for flamegraph.pl plus the time spent
+# per stage (receive, decode, mass, process, commit, fitbit, render_graph) of the last measurements
+# to PROFILE_PATH. Only a few timestamps per measurement until triggered, nothing at all when False
+PROFILING = False
+PROFILE_PATH = HOME + "/profiles"
+PROFILE_SECONDS = 10
+PROFILE_PORT = None
+
+# several boards sharing this host and database, e.g. [("bathroom", "00:1F:..."), ("gym", "00:22:...")].
+# Each gets its own calibration, tare and measurement, all of them are read by one event loop
+# (boardmanager.py) and their weights saved one after the other. The screen shows the last
+# saved weight. None for the single board set up above
+BOARDS = None
+
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 
 logging.basicConfig(filename=LOG_FILE,
@@ -101,65 +177,11 @@ logging.basicConfig(filename=LOG_FILE,
                     datefmt='%m/%d/%Y %I:%M:%S %p',
                     level=logging.DEBUG)
 
+# created by main(), pygame is only loaded when the screen is needed
+display = None
 
-class Display:
-    def __init__(self):
-        self.display = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT), 0, 32)
-        pygame.font.init()
-        self.font = pygame.font.Font(WEIGHT_FONT_PATH, WEIGHT_FONT_SIZE)
-        self.font_user = pygame.font.Font(WEIGHT_FONT_PATH, USER_FONT_SIZE)
-        self.font_graph = pygame.font.Font(WEIGHT_FONT_PATH, GRAPH_FONT_SIZE)
-        self.clear()
-
-    def render(self, weight_text, weight_color, user_text):
-        self.display.fill(BLACK)
-        self.display.blit(self.font_user.render(user_text, 1, WHITE), (60, 10))
-        self.display.blit(self.font.render(weight_text, 1, weight_color), (60, 30))
-        pygame.display.update()
-
-    def render_graph(self, all_mornings):
-        mn = 1000
-        mx = 0
-
-        if all_mornings:
-            count = sum(1 for r in all_mornings)
-            for r in all_mornings:
-                if r.w <= mn:
-                    mn = r.w
-                if r.w >= mx:
-                    mx = r.w
-
-            mx += 1
-            mn -= 1
-
-            self.display.blit(self.font_graph.render(str(mx), 1, WHITE), (10, 145))
-            self.display.blit(self.font_graph.render(str(mn), 1, WHITE), (10, 220))
-
-            x_step = 280 / count
-            x = 40
-            x0 = None
-            y0 = None
-            w = 0
-            pygame.draw.line(self.display, GRAY, (x + x_step, 145), (x + x_step, 240))
-            for r in all_mornings:
-                w = r.w
-                x += x_step
-                y = 240 - (240 - 145) / (mx - mn) * (r.w - mn)
-                if y0 is not None:
-                    pygame.draw.line(self.display, GRAY, (x, 145), (x, 240))
-                    pygame.draw.line(self.display, SILVER, (x0, y0), (x, y))
-                x0 = x
-                y0 = y
-
-            self.display.blit(self.font_graph.render(str(w), 1, YELLOW), (10, y0 - 8))
-            pygame.display.update()
-
-    def clear(self):
-        self.display.fill(BLACK)
-        pygame.display.update()
-
-
-display = Display()
+# held for database work, compaction runs next to the measurements
+db_lock = threading.Lock()
 
 
 class UserProvider:
@@ -191,364 +213,322 @@ class UserProvider:
         USERS[name]['weight'] = weight
 
 
-class FitbitConnector:
-    def __init__(self, client_id, client_key, user_provider):
-        self.client_id = client_id
-        self.client_key = client_key
-        self.user_provider = user_provider
-
-    def log_weight(self, user, weight):
-        fitbit_user_id = self.user_provider.fitbit_user_id(user)
-        fitbit_user_secret = self.user_provider.fitbit_user_secret(user)
-
-        if fitbit_user_id is None or fitbit_user_secret is None:
-            logging.warning("{} doesn't have fitbit keys. Weight will not be saved in fitbit cloud".format(user))
-        else:
-            logging.debug("Fitbit - saving {} for {}".format(weight, user))
-            authd_client = fitbit.Fitbit(self.client_id, self.client_key, resource_owner_key=fitbit_user_id,
-                                         resource_owner_secret=fitbit_user_secret)
-            # making conversion to pounds
-            fitbit_data = {'weight': weight * 2.2046, 'date': datetime.today().strftime("%Y-%m-%d")}
-
-            try:
-                authd_client._COLLECTION_RESOURCE('body', data=fitbit_data)
-            except:
-                logging.error("Problem with FitBit request for update body weight")
-
-
-
-class EventProcessor:
-    def __init__(self, weight_processor):
-        self.weight_processor = weight_processor
-        self.measured = False
-        self.done = False
-        self.events = []
-        self.board = None
-        self.last_render = 0
-
-    def init_board(self, board):
-        self.board = board
-
-    def reset(self):
-        self.measured = False
-        self.done = False
-        self.events = []
-        self.last_render = 0
-
-    def mass(self, event):
-        if event.totalWeight > 10:
-            tnow = int(round(time_.time() * 1000))
-            if (tnow - self.last_render) > 500:
-                corrected_weight = self.weight + 2
-                user = self.weight_processor.get_user_by_weight(corrected_weight)
-                display.render(str(corrected_weight), SILVER, safe_text(user))
-                self.last_render = int(round(time_.time() * 1000))
-            self.events.append(event.totalWeight)
-            if not self.measured:
-                display.clear()
-                self.board.set_light(True)
-                logging.debug("Starting measurement.")
-                self.measured = True
-        elif self.measured:
-            self.done = True
-
-    @property
-    def weight(self):
-        if not self.events:
-            return 0
-        histogram = collections.Counter(round(num, 1) for num in self.events)
-        return histogram.most_common(1)[0][0]
-
-
-class BoardEvent:
-    def __init__(self, top_left, top_right, bottom_left, bottom_right,
-                 button_pressed, button_released):
-        self.topLeft = top_left
-        self.topRight = top_right
-        self.bottomLeft = bottom_left
-        self.bottomRight = bottom_right
-        self.buttonPressed = button_pressed
-        self.buttonReleased = button_released
-        # convenience value
-        self.totalWeight = top_left + top_right + bottom_left + bottom_right
-
-
-class Wiiboard:
-    def __init__(self, events_processor):
-        # Sockets and status
-        self.receive_socket = None
-        self.control_socket = None
-
-        events_processor.init_board(self)
-
-        self.processor = events_processor
-        self.calibration = []
-        self.calibrationRequested = False
-        self.LED = False
-        self.address = None
-        self.buttonDown = False
-        for i in xrange(3):
-            self.calibration.append([])
-            for j in xrange(4):
-                # high dummy value so events with it don't register
-                self.calibration[i].append(10000)
-
-        self.status = "Disconnected"
-        self.lastEvent = BoardEvent(0, 0, 0, 0, False, False)
-
-        try:
-            self.receive_socket = bluetooth.BluetoothSocket(bluetooth.L2CAP)
-            self.control_socket = bluetooth.BluetoothSocket(bluetooth.L2CAP)
-        except ValueError:
-            raise Exception("Error: Bluetooth not found")
-
-    def is_connected(self):
-        return self.status == "Connected"
-
-    # Connect to the Wiiboard at bluetooth address <address>
-    def connect(self, address):
-        if address is None:
-            logging.debug("Non existent address")
-            return
-        self.receive_socket.connect((address, 0x13))
-        self.control_socket.connect((address, 0x11))
-        if self.receive_socket and self.control_socket:
-            logging.debug("Connected to Wiiboard at address " + address)
-            self.status = "Connected"
-            self.address = address
-            self.calibrate()
-            use_ext = ["00", COMMAND_REGISTER, "04", "A4", "00", "40", "00"]
-            self.send(use_ext)
-            self.set_reporting_type()
-            logging.debug("Wiiboard connected")
+def create_data_provider():
+    if DB_BACKEND == 'log':
+        from weightlog import LogDataProvider
+        return LogDataProvider(DB_LOG_PATH)
+    from dataprovider import DataProvider, CachedDataProvider
+    if DB_CACHE:
+        return CachedDataProvider(DB_PATH)
+    return DataProvider(DB_PATH)
+
+
+def create_display():
+    from display import Display, WHITE
+    screen = Display(WEIGHT_FONT_PATH)
+    screen.preload_glyphs((WHITE, LIVE_WEIGHT_COLOR))
+    if metrics.enabled():
+        screen = metrics.timed(screen, ("render", "render_graph", "clear"),
+                               "scale_render_seconds", "Screen update time")
+    return screen
+
+
+def start_metrics(board, pipeline, fitbit_uploader, aggregates):
+    stats = board.stats
+    metrics.collect("scale_packets_received_total", "Reports received from the board", "counter",
+                    lambda: stats.received)
+    metrics.collect("scale_packets_decoded_total", "Weight reports decoded", "counter", lambda: stats.decoded)
+    metrics.collect("scale_packets_idle_total", "Empty board reports skipped before decoding", "counter",
+                    lambda: stats.idle)
+    metrics.collect("scale_packets_dropped_total", "Malformed reports dropped", "counter", lambda: stats.dropped)
+    if pipeline is not None:
+        metrics.collect("scale_events_dropped_total", "Events dropped on a full pipeline queue", "counter",
+                        lambda: pipeline.dropped)
+    tare = board.decoder.tare
+    if tare is not None:
+        metrics.collect("scale_tare_offset_kg", "Tracked zero offset of the four sensors", "gauge",
+                        tare.total_offset)
+        metrics.collect("scale_tare_drift_kg_per_hour", "How fast the zero moves", "gauge",
+                        lambda: tare.drift_rate)
+    metrics.collect("scale_fitbit_uploaded_total", "Weights uploaded to fitbit", "counter",
+                    lambda: fitbit_uploader.uploaded)
+    metrics.collect("scale_trend_weight_kg", "Smoothed morning weight", "gauge",
+                    lambda: dict((name, user.trend) for name, user in aggregates.users.items()), 'user')
+    metrics.collect("scale_average_7d_weight_kg", "Mean morning weight of the last 7 days", "gauge",
+                    lambda: dict((name, user.average(7)) for name, user in aggregates.users.items()), 'user')
+    metrics.collect("scale_weight_rate_kg_per_week", "Change of the trend weight", "gauge",
+                    lambda: dict((name, user.rate()) for name, user in aggregates.users.items()), 'user')
+    exporter = metrics.Exporter(METRICS_PATH, METRICS_PORT)
+    exporter.start()
+    return exporter
+
+
+# database open, indexes loaded and users trained from the history
+def warm_up_database(timer, user_provider, fitbit_uploader, aggregates):
+    with timer.phase("database"):
+        data_provider = create_data_provider()
+        aggregates.load(user_provider.all(), data_provider)
+        trace = profiler.trace()
+        if trace is not None:
+            profiler.trace_stages(trace, data=data_provider)
+        if metrics.enabled():
+            data_provider = metrics.timed(data_provider,
+                                          ("last", "all_mornings", "last_morning", "today_morning", "save"),
+                                          "scale_db_seconds", "Database call latency")
+        configuration = WeightProcessorConfiguration(MAX_PAUSE_BETWEEN_MORNING_CHECKS_IN_DAYS,
+                                                     MAX_WEIGHT_DIFF_BETWEEN_MORNING_CHECKS,
+                                                     USERS_MAX_W_DIFF,
+                                                     MORNING_HOURS)
+        weight_processor = WeightProcessor(data_provider,
+                                           configuration,
+                                           user_provider,
+                                           fitbit_uploader,
+                                           aggregates)
+        if trace is not None:
+            profiler.trace_stages(trace, weight_processor=weight_processor)
+    return data_provider, weight_processor
+
+
+def start_history_api(data_provider, aggregates):
+    from historyapi import HistoryApi, HistoryServer
+    if getattr(data_provider, 'records', None) is None:
+        logging.error("History API needs DB_CACHE or the 'log' backend, not started")
+        return None
+    server = HistoryServer(HistoryApi(data_provider, aggregates), HISTORY_API_PORT)
+    server.start()
+    return server
+
+
+def start_profiler():
+    trace = profiler.enable_trace()
+    job = profiler.Profiler(PROFILE_PATH, PROFILE_SECONDS)
+    job.install_signal()
+    if PROFILE_PORT is not None:
+        job.serve(PROFILE_PORT)
+    return trace
+
+
+def start_compaction(data_provider, lock):
+    if COMPACT_AFTER_DAYS is None or DB_BACKEND == 'log':
+        return None
+    from compaction import Compactor
+    compactor = Compactor(data_provider, COMPACTION_CHECKPOINT_PATH, UNASSIGNED_ARCHIVE_PATH,
+                          COMPACT_AFTER_DAYS, lock=lock)
+    compactor.start()
+    return compactor
+
+
+def reset_board_power(timer):
+    with timer.phase("gpio reset"):
+        GPIO.setwarnings(False)
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setup(4, GPIO.OUT)
+        GPIO.output(4, GPIO.LOW)
+        time.sleep(GPIO_RESET_SECONDS)
+        GPIO.cleanup()
+
+
+# power cycle, then the address from the command line, the cached one, or a discovery scan
+def start_board(timer, board):
+    reset_board_power(timer)
+
+    with timer.phase("board connect"):
+        if len(sys.argv) > 1:
+            board.connect(sys.argv[1])  # The wii board must be in sync mode at this time
         else:
-            logging.debug(
-                "Could not connect to Wiiboard at address " + address)
-
-    def receive(self):
-        while self.status == "Connected" and not self.processor.done:
-            data = self.receive_socket.recv(25)
-            in_type = int(data.encode("hex")[2:4])
-            if in_type == INPUT_STATUS:
-                self.set_reporting_type()
-            elif in_type == INPUT_READ_DATA:
-                if self.calibrationRequested:
-                    packet_length = (
-                        int(str(data[4]).encode("hex"), 16) / 16 + 1)
-                    self.parse_calibration_response(data[7:(7 + packet_length)])
-
-                    if packet_length < 16:
-                        self.calibrationRequested = False
-            elif in_type == EXTENSION_8BYTES:
-                self.processor.mass(self.create_board_event(data[2:12]))
-            else:
-                logging.debug("ACK to data write received")
-
-    def disconnect(self):
-        if self.status == "Connected":
-            self.status = "Disconnecting"
-            while self.status == "Disconnecting":
-                self.wait(100)
-
-        try:
-            self.receive_socket.close()
-        except:
-            pass
-
-        try:
-            self.control_socket.close()
-        except:
-            pass
-
-        logging.debug("WiiBoard disconnected")
-
-    # Try to discover a Wiiboard
-    def discover(self):
-        logging.debug("Press the red sync button on the board now")
-        address = None
-        bluetooth_devices = bluetooth.discover_devices(
-            duration=6, lookup_names=True)
-        for bluetooth_device in bluetooth_devices:
-            if bluetooth_device[1] == BLUETOOTH_NAME:
-                address = bluetooth_device[0]
-                logging.debug("Found Wiiboard at address " + address)
-        if address is None:
-            logging.debug("No Wiiboards discovered.")
-        return address
-
-    def create_board_event(self, data):
-        button_bytes = data[0:2]
-        data = data[2:12]
-        button_pressed = False
-        button_released = False
-
-        state = (int(button_bytes[0].encode("hex"), 16) << 8) | int(
-            button_bytes[1].encode("hex"), 16)
-        if state == BUTTON_DOWN_MASK:
-            button_pressed = True
-            if not self.buttonDown:
-                logging.debug("Button pressed")
-                self.buttonDown = True
-
-        if not button_pressed:
-            if self.lastEvent.buttonPressed:
-                button_released = True
-                self.buttonDown = False
-                logging.debug("Button released")
-
-        raw_tr = (int(data[0].encode("hex"), 16) << 8) + \
-                 int(data[1].encode("hex"), 16)
-        raw_br = (int(data[2].encode("hex"), 16) << 8) + \
-                 int(data[3].encode("hex"), 16)
-        raw_tl = (int(data[4].encode("hex"), 16) << 8) + \
-                 int(data[5].encode("hex"), 16)
-        raw_bl = (int(data[6].encode("hex"), 16) << 8) + \
-                 int(data[7].encode("hex"), 16)
-
-        return BoardEvent(self.calc_mass(raw_tl, TOP_LEFT),
-                          self.calc_mass(raw_tr, TOP_RIGHT),
-                          self.calc_mass(raw_bl, BOTTOM_LEFT),
-                          self.calc_mass(raw_br, BOTTOM_RIGHT),
-                          button_pressed, button_released)
-
-    def calc_mass(self, raw, pos):
-        val = 0.0
-        # calibration[0] is calibration values for 0kg
-        # calibration[1] is calibration values for 17kg
-        # calibration[2] is calibration values for 34kg
-        if raw < self.calibration[0][pos]:
-            return val
-        elif raw < self.calibration[1][pos]:
-            val = 17 * \
-                  ((raw - self.calibration[0][pos]) /
-                   float((self.calibration[1][pos] - self.calibration[0][pos])))
-        elif raw > self.calibration[1][pos]:
-            val = 17 + 17 * \
-                       ((raw - self.calibration[1][pos]) /
-                        float((self.calibration[2][pos] - self.calibration[1][pos])))
-
-        return val
-
-    def get_last_event(self):
-        return self.lastEvent
-
-    def get_led(self):
-        return self.LED
-
-    def parse_calibration_response(self, data):
-        index = 0
-        if len(data) == 16:
-            for i in xrange(2):
-                for j in xrange(4):
-                    self.calibration[i][j] = (int(data[index].encode("hex"), 16) << 8) + int(
-                        data[index + 1].encode("hex"), 16)
-                    index += 2
-        elif len(data) < 16:
-            for i in xrange(4):
-                self.calibration[2][i] = (int(data[index].encode("hex"), 16) << 8) + int(
-                    data[index + 1].encode("hex"), 16)
-                index += 2
-
-    # Send <data> to the Wiiboard
-    # <data> should be an array of strings, each string representing a single hex byte
-    def send(self, data):
-        if self.status != "Connected":
-            return
-        data[0] = "52"
-
-        send_data = ""
-        for byte in data:
-            byte = str(byte)
-            send_data += byte.decode("hex")
-
-        self.control_socket.send(send_data)
-
-    # Turns the power button LED on if light is True, off if False
-    # The board must be connected in order to set the light
-    def set_light(self, light):
-        if light:
-            val = "10"
-        else:
-            val = "00"
-
-        message = ["00", COMMAND_LIGHT, val]
-        self.send(message)
-        self.LED = light
-
-    def calibrate(self):
-        message = ["00", COMMAND_READ_REGISTER,
-                   "04", "A4", "00", "24", "00", "18"]
-        self.send(message)
-        self.calibrationRequested = True
+            address = load_address(BOARD_ADDRESS_PATH) if BOARD_ADDRESS_PATH is not None else None
+            if address is None or not board.try_connect(address):
+                logging.debug("Discovering board...")
+                address = board.discover()
+                logging.debug("Trying to connect...")
+                board.connect(address)  # The wii board must be in sync mode at this time
+        if board.is_connected() and BOARD_ADDRESS_PATH is not None:
+            save_address(BOARD_ADDRESS_PATH, board.address)
+        board.set_light(False)
 
-    def set_reporting_type(self):
-        data = ["00", COMMAND_REPORTING, CONTINUOUS_REPORTING, EXTENSION_8BYTES]
-        self.send(data)
 
-    def wait(self, millis):
-        time.sleep(millis / 1000.0)
+# uploads morning weights fitbit doesn't have yet, run with "backfill" as the only argument
+def backfill():
+    user_provider = UserProvider(USERS)
+    job = Backfill(FitbitConnector(FITBIT_CLIENT_ID, FITBIT_CLIENT_SECRET, user_provider),
+                   create_data_provider(),
+                   FITBIT_BACKFILL_CHECKPOINT_PATH)
+    job.run(user_provider.all())
+    logging.info("Backfill done: {} pages fetched, {} days uploaded, {} already on fitbit".format(
+        job.fetched, job.uploaded, job.present))
 
 
 def main():
-    GPIO.setwarnings(False)
-    GPIO.setmode(GPIO.BCM)
-    GPIO.setup(4, GPIO.OUT)
-    GPIO.output(4, GPIO.LOW)
-    time.sleep(3)
-    GPIO.cleanup()
-
-    data_provider = DataProvider(DB_PATH)
-
-    configuration = WeightProcessorConfiguration(MAX_PAUSE_BETWEEN_MORNING_CHECKS_IN_DAYS,
-                                                 MAX_WEIGHT_DIFF_BETWEEN_MORNING_CHECKS,
-                                                 USERS_MAX_W_DIFF,
-                                                 MORNING_HOURS)
+    global display
+    timer = StartupTimer(STARTED)
+    if METRICS:
+        metrics.enable()
+    trace = start_profiler() if PROFILING else None
 
     user_provider = UserProvider(USERS)
-    weight_processor = WeightProcessor(data_provider,
-                                       configuration,
-                                       user_provider,
-                                       FitbitConnector(FITBIT_CLIENT_ID, FITBIT_CLIENT_SECRET, user_provider))
-
-    events_processor = EventProcessor(weight_processor)
-    board = Wiiboard(events_processor)
-
-    if len(sys.argv) == 1:
-        logging.debug("Discovering board...")
-        address = board.discover()
-    else:
-        address = sys.argv[1]
-
-    logging.debug("Trying to connect...")
-    board.connect(address)  # The wii board must be in sync mode at this time
-    board.set_light(False)
-
-    while 1 == 1:
+    connector = FitbitConnector(FITBIT_CLIENT_ID, FITBIT_CLIENT_SECRET, user_provider)
+    if metrics.enabled():
+        connector = metrics.timed(connector, ("upload_weight", "weight_logs"), "scale_fitbit_seconds",
+                                  "Fitbit call latency", "scale_fitbit_failures_total")
+    fitbit_uploader = FitbitUploader(connector, UploadQueue(FITBIT_QUEUE_PATH))
+    fitbit_uploader.start()
+    if trace is not None:
+        profiler.trace_stages(trace, fitbit=fitbit_uploader)
+
+    detector = None
+    if STABLE_WINDOW is not None:
+        detector = StabilityDetector(STABLE_WINDOW, STABLE_MAX_STDDEV, STABLE_MAX_DRIFT)
+    live_display = LiveDisplay() if PIPELINE else None
+    # weight processor and screen are handed over below, nothing is measured before that
+    events_processor = EventProcessor(None, live_display, create_estimator(WEIGHT_ESTIMATOR), detector,
+                                      LIVE_RENDER_INTERVAL_MS)
+    pipeline = Pipeline(events_processor, PIPELINE_QUEUE_SIZE) if PIPELINE else None
+    capture = CaptureWriter(CAPTURE_PATH) if CAPTURE_PATH is not None else None
+    archive = SensorArchive(RAW_ARCHIVE_PATH) if RAW_ARCHIVE_PATH is not None else None
+    board = Wiiboard(pipeline or events_processor, capture=capture, archive=archive)
+    board.idle_reporting = IDLE_REPORTING
+    if TARE_TRACKING:
+        board.decoder.set_tare(TareTracker())
+    if trace is not None:
+        profiler.trace_stages(trace, board=board, processor=events_processor)
+    aggregates = Aggregates(AGGREGATES_PATH)
+    if metrics.enabled():
+        start_metrics(board, pipeline, fitbit_uploader, aggregates)
+
+    # power cycle + connect and the database warm up run next to the screen and font loading
+    board_start = Background("board-start", start_board, timer, board)
+    database = Background("database", warm_up_database, timer, user_provider, fitbit_uploader,
+                          aggregates)
+    with timer.phase("display"):
+        display = create_display()
+        if trace is not None:
+            profiler.trace_stages(trace, display=display)
+    if live_display is None:
+        events_processor.display = display
+    data_provider, weight_processor = database.result()
+    events_processor.weight_processor = weight_processor
+    if HISTORY_API_PORT is not None:
+        start_history_api(data_provider, aggregates)
+    start_compaction(data_provider, db_lock)
+    board_start.result()
+    timer.ready()
+
+    # reconnects when the board falls asleep or the link drops
+    supervisor = BoardSupervisor(board, BOARD_ADDRESS_PATH)
+    if pipeline is not None:
+        run_pipeline(pipeline, live_display, weight_processor, data_provider, board, supervisor)
+        return
+
+    while supervisor.supervise():
         events_processor.reset()
         board.receive()
+        if events_processor.done:
+            finish_measurement(events_processor.weight, weight_processor, data_provider, board)
+
+
+def finish_measurement(estimated_weight, weight_processor, data_provider, board):
+    from dataprovider import WeightRecord
+    from display import WHITE
 
-        weight = events_processor.weight + 2
+    weight = estimated_weight + weight_correction(board)
 
-        weight_record = WeightRecord({'year': datetime.today().year,
-                                      'month': datetime.today().month,
-                                      'day': datetime.today().day,
-                                      'w': weight})
+    weight_record = WeightRecord({'year': datetime.today().year,
+                                  'month': datetime.today().month,
+                                  'day': datetime.today().day,
+                                  'w': weight})
 
-        user = weight_processor.get_user_by_weight(weight)
-        display.render(str(weight), WHITE, safe_text(user))
+    user = weight_processor.get_user_by_weight(weight)
+    display.render(str(weight), WHITE, safe_text(user))
+    with db_lock:
         weight_processor.process(weight_record)
-        display.render_graph(data_provider.all_mornings(user))
+        mornings = data_provider.all_mornings(user)
+    display.render_graph(mornings, user)
+    trace = profiler.trace()
+    if trace is not None:
+        trace.finish(weight)
 
-        board.set_light(False)
-        logging.debug('Ready for next job')
+    board.set_light(False)
+    logging.debug('Ready for next job')
 
 
-def safe_text(value):
-    result = str(value)
-    if value is None:
-        result = ""
-    return result
+# render and persist stage: the board is read and measured by the pipeline threads, this
+# thread draws the latest live weight and processes finished measurements
+def run_pipeline(pipeline, live_display, weight_processor, data_provider, board, supervisor=None):
+    pipeline.start(supervisor)
+    try:
+        while True:
+            live_display.flush(display)
+            try:
+                weight = pipeline.next_measurement(LIVE_RENDER_INTERVAL_MS / 1000.0)
+            except Queue.Empty:
+                continue
+            if weight is None:
+                logging.debug("Pipeline stopped: {}".format(pipeline.stats()))
+                return
+            live_display.flush(display)
+            finish_measurement(weight, weight_processor, data_provider, board)
+    finally:
+        pipeline.stop()
+
+
+# every board of BOARDS from one event loop
+def main_boards():
+    global display
+    from boardmanager import BoardManager, SerializedWeightProcessor
+    from display import WHITE
+
+    timer = StartupTimer(STARTED)
+    trace = start_profiler() if PROFILING else None
+    user_provider = UserProvider(USERS)
+    fitbit_uploader = FitbitUploader(FitbitConnector(FITBIT_CLIENT_ID, FITBIT_CLIENT_SECRET, user_provider),
+                                     UploadQueue(FITBIT_QUEUE_PATH))
+    fitbit_uploader.start()
+    aggregates = Aggregates(AGGREGATES_PATH)
+    reset_board_power(timer)
+    with timer.phase("display"):
+        display = create_display()
+    if trace is not None:
+        profiler.trace_stages(trace, fitbit=fitbit_uploader, display=display)
+    data_provider, weight_processor = warm_up_database(timer, user_provider, fitbit_uploader, aggregates)
+    if HISTORY_API_PORT is not None:
+        start_history_api(data_provider, aggregates)
+
+    def show(name, record):
+        display.render(str(record.w), WHITE, safe_text(record.user))
+        with writer.lock:
+            mornings = data_provider.all_mornings(record.user)
+        display.render_graph(mornings, record.user)
+        if trace is not None:
+            trace.finish(record.w)
+
+    writer = SerializedWeightProcessor(weight_processor, show)
+    writer.start()
+    start_compaction(data_provider, writer.lock)
+    manager = BoardManager(writer)
+    for name, address in BOARDS:
+        detector = None
+        if STABLE_WINDOW is not None:
+            detector = StabilityDetector(STABLE_WINDOW, STABLE_MAX_STDDEV, STABLE_MAX_DRIFT)
+        processor = EventProcessor(writer, None, create_estimator(WEIGHT_ESTIMATOR), detector,
+                                   LIVE_RENDER_INTERVAL_MS)
+        board = Wiiboard(processor)
+        board.idle_reporting = IDLE_REPORTING
+        if TARE_TRACKING:
+            board.decoder.set_tare(TareTracker())
+        if trace is not None:
+            profiler.trace_stages(trace, board=board, processor=processor)
+        manager.add(name, board, processor, address)
+    timer.ready()
+    try:
+        manager.run()
+    finally:
+        writer.stop()
 
 
 if __name__ == "__main__":
-    main()
+    if sys.argv[1:] == ["backfill"]:
+        backfill()
+    elif BOARDS is not None:
+        main_boards()
+    else:
+        main()
@@ -0,0 +1,250 @@
+import bisect
+import gzip
+import json
+import logging
+import threading
+import urllib
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from cStringIO import StringIO
+from datetime import date
+from urlparse import urlparse, parse_qs
+from dataprovider import date_key
+
+# records per history page when the request doesn't say, and at most
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# responses kept per data version, a repeated request is answered without building it again
+CACHE_SIZE = 256
+
+# a client that stops sending or reading holds the (single) server thread at most this long
+REQUEST_TIMEOUT = 5
+
+# bodies shorter than this go out uncompressed
+MIN_GZIP_SIZE = 512
+
+
+class BadRequest(Exception):
+    pass
+
+
+def record_json(record):
+    return {'date': date(record.year, record.month, record.day).isoformat(),
+            'time': getattr(record, 'time', None), 'w': record.w,
+            'morning': getattr(record, 'morning', False), 'last': getattr(record, 'last', False)}
+
+
+def parse_date(value):
+    try:
+        year, month, day = [int(part) for part in value.split("-")]
+        return year, month, day
+    except ValueError:
+        raise BadRequest("Dates are YYYY-MM-DD, not {}".format(value))
+
+
+def parse_int(query, name, default, low, high):
+    try:
+        value = int(query.get(name, [default])[0])
+    except ValueError:
+        raise BadRequest("{} is not a number".format(name))
+    return max(low, min(value, high))
+
+
+def gzip_body(body):
+    out = StringIO()
+    with gzip.GzipFile(fileobj=out, mode='wb', compresslevel=6) as f:
+        f.write(body)
+    return out.getvalue()
+
+
+class History:
+    # one user's mornings as of one data version, with their times and dates for bisecting
+    def __init__(self, records):
+        self.records = records
+        self.times = [getattr(r, 'time', None) or 0 for r in records]
+        self.dates = [date_key(r) for r in records]
+
+
+class HistoryApi:
+    # Answers the queries from the live process's in-memory state: the record index of the data
+    # provider (CachedDataProvider or LogDataProvider) and the aggregates, never the database files.
+    # The ETag is the data and aggregates version, a changed version drops every cached response.
+    #
+    #   /users                              users with their newest morning
+    #   /users/<user>/history               mornings, oldest first, ?from=&to= (YYYY-MM-DD),
+    #                                       ?limit= and ?cursor= (next_cursor of the previous page)
+    #   /users/<user>/latest                newest morning, like the history the API only serves
+    #                                       mornings (regular weigh-ins of the day are left out)
+    #   /users/<user>/aggregates            trend, averages, rate, ?weeks=&months= buckets
+    def __init__(self, data, aggregates=None):
+        self.records = data.records
+        self.data = data
+        self.aggregates = aggregates
+        self.lock = threading.Lock()
+        self.cache_version = None
+        self.cache = {}
+        self.histories = {}
+        self.requests = 0
+        self.cache_hits = 0
+
+    def version(self):
+        aggregates = self.aggregates.version if self.aggregates is not None else 0
+        return '"{}.{}"'.format(self.data.version, aggregates)
+
+    # (status, etag, body, gzipped) of a GET for <path>
+    def get(self, path, gzip_ok=False):
+        etag = self.version()
+        with self.lock:
+            self.requests += 1
+            if etag != self.cache_version:
+                self.cache = {}
+                self.histories = {}
+                self.cache_version = etag
+            cached = self.cache.get((path, gzip_ok))
+            if cached is not None:
+                self.cache_hits += 1
+                return cached
+        try:
+            status, body = 200, json.dumps(self.query(path), separators=(',', ':'))
+        except BadRequest as e:
+            status, body = 400, json.dumps({'error': str(e)})
+        except KeyError as e:
+            status, body = 404, json.dumps({'error': "No {}".format(e.args[0])})
+        gzipped = gzip_ok and len(body) >= MIN_GZIP_SIZE
+        if gzipped:
+            body = gzip_body(body)
+        response = (status, etag, body, gzipped)
+        with self.lock:
+            if self.cache_version == etag:
+                if len(self.cache) >= CACHE_SIZE:
+                    self.cache.clear()
+                self.cache[(path, gzip_ok)] = response
+        return response
+
+    # the writer thread adds to the index while this runs: keys() copies each dict in one call,
+    # under the GIL, iterating them could see them change size
+    def users(self):
+        return sorted(set(self.records.last_records.keys() + self.records.mornings.keys()))
+
+    def history(self, user):
+        with self.lock:
+            history = self.histories.get(user)
+        if history is None:
+            history = History(self.records.all_mornings(user))
+            with self.lock:
+                self.histories[user] = history
+        return history
+
+    def query(self, path):
+        url = urlparse(path)
+        query = parse_qs(url.query)
+        parts = [urllib.unquote(part) for part in url.path.strip("/").split("/")]
+        if parts == ["users"]:
+            return [{'user': user, 'latest': self.latest(user)} for user in self.users()]
+        if len(parts) != 3 or parts[0] != "users":
+            raise KeyError(url.path)
+        user, what = parts[1], parts[2]
+        if user not in self.users():
+            raise KeyError(user)
+        if what == "history":
+            return self.page(user, query)
+        if what == "latest":
+            return self.latest(user)
+        if what == "aggregates" and self.aggregates is not None:
+            aggregates = self.aggregates.user(user)
+            if aggregates is None:
+                raise KeyError("aggregates of {}".format(user))
+            return aggregates.summary(parse_int(query, 'weeks', 8, 0, 10000) or None,
+                                      parse_int(query, 'months', 12, 0, 10000) or None)
+        raise KeyError(url.path)
+
+    # the record flagged last is the user's newest morning
+    def latest(self, user):
+        record = self.records.last(user)
+        if record is None:
+            mornings = self.history(user).records
+            record = mornings[-1] if mornings else None
+        return record_json(record) if record is not None else None
+
+    def page(self, user, query):
+        history = self.history(user)
+        limit = parse_int(query, 'limit', PAGE_SIZE, 1, MAX_PAGE_SIZE)
+        start = 0
+        end = len(history.records)
+        if 'from' in query:
+            start = bisect.bisect_left(history.dates, parse_date(query['from'][0]))
+        if 'to' in query:
+            end = bisect.bisect_right(history.dates, parse_date(query['to'][0]))
+        if 'cursor' in query:
+            start = max(start, self.after_cursor(history, query['cursor'][0]))
+        records = history.records[start:min(end, start + limit)]
+        more = start + limit < end
+        return {'user': user, 'records': [record_json(r) for r in records],
+                'next_cursor': "{}:{}".format(history.times[start + limit - 1], records[-1].pk) if more else None}
+
+    # position after the record named by a cursor, "<time>:<pk>" of the last record of the previous
+    # page. Stays valid while records are added, the pk tells records of the same time apart
+    def after_cursor(self, history, cursor):
+        time, _, pk = cursor.partition(":")
+        try:
+            time = int(time)
+        except ValueError:
+            raise BadRequest("Bad cursor {}".format(cursor))
+        start = bisect.bisect_left(history.times, time)
+        end = bisect.bisect_right(history.times, time)
+        for i in xrange(start, end):
+            if str(history.records[i].pk) == pk:
+                return i + 1
+        # the record is gone, its time goes out again rather than skipping any of it
+        return start
+
+
+class HistoryHandler(BaseHTTPRequestHandler):
+    timeout = REQUEST_TIMEOUT
+
+    def do_GET(self):
+        api = self.server.api
+        gzip_ok = 'gzip' in self.headers.get('Accept-Encoding', '')
+        status, etag, body, gzipped = api.get(self.path, gzip_ok)
+        if status == 200 and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Vary", "Accept-Encoding")
+        if gzipped:
+            self.send_header("Content-Encoding", "gzip")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HistoryServer:
+    # serves the HistoryApi on http://<address>:<port>/ from one daemon thread: requests are
+    # handled one after the other, so however many clients there are, they share one thread's
+    # time with the board and the measurement
+    def __init__(self, api, port, address='127.0.0.1'):
+        self.server = HTTPServer((address, port), HistoryHandler)
+        self.server.api = api
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="history-http")
+        self.thread.daemon = True
+        self.thread.start()
+        logging.info("History API on port {}".format(self.port))
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,242 @@
+import bisect
+import logging
+import threading
+import time
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from atomicfile import write_atomic
+
+# seconds, from a single decode (~10us) to a slow fitbit call
+LATENCY_BUCKETS = (0.00001, 0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0)
+
+# samples in one measurement, ~100 per second
+COUNT_BUCKETS = (50, 100, 200, 300, 500, 800, 1200, 2000, 5000)
+
+# seconds from stepping on until the weight settled
+STABLE_BUCKETS = (0.5, 1.0, 1.5, 2.0, 3.0, 5.0, 8.0, 13.0)
+
+# how often the text file is rewritten
+EXPORT_INTERVAL = 15
+
+# Everything is off until enable(). Hot paths check enabled() once, outside their loops, and
+# take their metrics then, so a disabled build pays for nothing but that check. Updates are not
+# locked, a lost increment between two threads is an acceptable price for a free hot path.
+_enabled = False
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def enabled():
+    return _enabled
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(n, v) for n, v in zip(names, values)) + "}"
+
+
+class Counter:
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = {}
+
+    def inc(self, amount=1, label=None):
+        self.values[label] = self.values.get(label, 0) + amount
+
+    def value(self, label=None):
+        return self.values.get(label, 0)
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} counter".format(self.name)]
+        names = (self.label,) if self.label else ()
+        for label, value in sorted(self.values.items()):
+            lines.append("{}{} {}".format(self.name, _labels(names, (label,)[:len(names)]), value))
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS, label=None):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.label = label
+        # per label: bucket counts (last one is +Inf), sum
+        self.series = {}
+
+    def observe(self, value, label=None):
+        series = self.series.get(label)
+        if series is None:
+            series = self.series[label] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def count(self, label=None):
+        series = self.series.get(label)
+        return sum(series[0]) if series else 0
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} histogram".format(self.name)]
+        names = (self.label, 'le') if self.label else ('le',)
+        for label, (counts, total) in sorted(self.series.items()):
+            prefix = (label,) if self.label else ()
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(self.name, _labels(names, prefix + (bound,)), cumulative))
+            base = _labels(names[:-1], prefix)
+            lines.append("{}_sum{} {}".format(self.name, base, total))
+            lines.append("{}_count{} {}".format(self.name, base, cumulative))
+        return lines
+
+
+class Collected:
+    # value read when exported, for counts something else keeps anyway (ReceiveStats). With a
+    # label func returns {label value: value}
+    def __init__(self, name, help, kind, func, label=None):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.func = func
+        self.label = label
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} {}".format(self.name, self.kind)]
+        if self.label is None:
+            lines.append("{} {}".format(self.name, self.func()))
+            return lines
+        for label, value in sorted(self.func().items()):
+            if value is not None:
+                lines.append("{}{} {}".format(self.name, _labels((self.label,), (label,)), value))
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def get(self, name, factory):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = factory()
+            return metric
+
+    def render(self):
+        with self.lock:
+            metrics = [self.metrics[name] for name in sorted(self.metrics)]
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help, label=None):
+    return REGISTRY.get(name, lambda: Counter(name, help, label))
+
+
+def histogram(name, help, buckets=LATENCY_BUCKETS, label=None):
+    return REGISTRY.get(name, lambda: Histogram(name, help, buckets, label))
+
+
+def collect(name, help, kind, func, label=None):
+    REGISTRY.get(name, lambda: Collected(name, help, kind, func, label))
+
+
+class Timed:
+    # Proxy timing every call of the given methods into one histogram labelled by method, failed
+    # calls are counted as well. Only wrap when metrics are enabled, the object itself is untouched.
+    def __init__(self, target, methods, latency, failures=None):
+        self._target = target
+        self._methods = frozenset(methods)
+        self._latency = latency
+        self._failures = failures
+
+    def __getattr__(self, name):
+        value = getattr(self._target, name)
+        if name not in self._methods:
+            return value
+
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return value(*args, **kwargs)
+            except:
+                if self._failures is not None:
+                    self._failures.inc(label=name)
+                raise
+            finally:
+                self._latency.observe(time.time() - start, name)
+        return timed
+
+
+def timed(target, methods, name, help, failures=None):
+    latency = histogram(name, help, LATENCY_BUCKETS, 'method')
+    if failures is not None:
+        failures = counter(failures, "Failed calls", 'method')
+    return Timed(target, methods, latency, failures)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = REGISTRY.render()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Exporter:
+    # rewrites the Prometheus text file every <interval> seconds and, with a port, serves the
+    # same text on http://127.0.0.1:<port>/metrics
+    def __init__(self, path=None, port=None, interval=EXPORT_INTERVAL):
+        self.path = path
+        self.port = port
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.server = None
+
+    def start(self):
+        if self.path is not None:
+            thread = threading.Thread(target=self.write_loop, name="metrics-file")
+            thread.daemon = True
+            thread.start()
+        if self.port is not None:
+            self.server = HTTPServer(('127.0.0.1', self.port), MetricsHandler)
+            thread = threading.Thread(target=self.server.serve_forever, name="metrics-http")
+            thread.daemon = True
+            thread.start()
+
+    def write(self):
+        write_atomic(self.path, REGISTRY.render())
+
+    def write_loop(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.write()
+            except Exception:
+                logging.exception("Could not write metrics to %s", self.path)
+
+    def stop(self):
+        self.stopped.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        if self.path is not None:
+            self.write()
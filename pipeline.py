@@ -0,0 +1,137 @@
+import Queue
+import logging
+import threading
+
+# events waiting between the receive thread and the estimator, ~2 seconds of reports
+QUEUE_SIZE = 200
+
+# how long the receive thread waits for room in a full queue before dropping the event
+PUT_TIMEOUT = 0.05
+
+
+class LiveDisplay:
+    # Stands in for Display in the estimator thread. Only the latest render request is kept and
+    # the render stage draws it when it gets to it, so a slow screen never holds up the samples.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = None
+        self.pending_clear = False
+        self.requested = 0
+        self.skipped = 0
+
+    def render(self, weight_text, weight_color, user_text):
+        with self.lock:
+            if self.pending is not None:
+                self.skipped += 1
+            self.pending = (weight_text, weight_color, user_text)
+            self.requested += 1
+
+    def clear(self):
+        with self.lock:
+            self.pending_clear = True
+            self.pending = None
+
+    # draws what was requested since the last flush, returns True if anything was drawn
+    def flush(self, display):
+        with self.lock:
+            pending = self.pending
+            pending_clear = self.pending_clear
+            self.pending = None
+            self.pending_clear = False
+        if pending_clear:
+            display.clear()
+        if pending is not None:
+            display.render(*pending)
+        return pending_clear or pending is not None
+
+
+class Pipeline:
+    # Splits the main loop into three stages:
+    #   receive thread:   board.receive() -> decode -> bounded events queue
+    #   estimator thread: events queue -> EventProcessor.mass -> finished weights queue
+    #   render stage:     the caller, draws live updates and processes finished weights
+    # The pipeline is the events processor of the board; its own processor gets the board
+    # through init_board so lights are still switched from the state machine.
+    # A full events queue blocks the receive thread for at most PUT_TIMEOUT, after that the
+    # event is dropped and counted. stop() goes through Wiiboard.disconnect(), the receive
+    # thread completes the handshake and both threads finish. With a BoardSupervisor the
+    # receive thread reconnects when the link drops instead of finishing.
+    def __init__(self, processor, queue_size=QUEUE_SIZE, put_timeout=PUT_TIMEOUT):
+        self.processor = processor
+        self.events = Queue.Queue(queue_size)
+        self.measurements = Queue.Queue()
+        self.put_timeout = put_timeout
+        self.board = None
+        self.supervisor = None
+        # the receive loop runs until the board is disconnected
+        self.done = False
+        self.queued = 0
+        self.dropped = 0
+        self.processed = 0
+        self.threads = []
+
+    def init_board(self, board):
+        self.board = board
+        self.processor.init_board(board)
+
+    # called by the receive thread for every decoded event
+    def mass(self, event):
+        try:
+            self.events.put(event, True, self.put_timeout)
+            self.queued += 1
+        except Queue.Full:
+            self.dropped += 1
+
+    def start(self, supervisor=None):
+        self.supervisor = supervisor
+        for target, name in ((self.receive_loop, "board-receive"), (self.estimate_loop, "estimator")):
+            thread = threading.Thread(target=target, name=name)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def receive_loop(self):
+        try:
+            if self.supervisor is not None:
+                self.supervisor.run()
+            else:
+                self.board.receive()
+        except Exception:
+            logging.exception("Receive thread failed")
+        finally:
+            # nobody reads the board any more, a disconnect() must not wait for the handshake
+            if self.board.status in ("Connected", "Disconnecting"):
+                self.board.status = "Disconnected"
+            self.events.put(None)
+
+    def estimate_loop(self):
+        processor = self.processor
+        try:
+            processor.reset()
+            while True:
+                event = self.events.get()
+                if event is None:
+                    return
+                processor.mass(event)
+                self.processed += 1
+                if processor.done:
+                    self.measurements.put(processor.weight)
+                    processor.reset()
+        except Exception:
+            logging.exception("Estimator thread failed")
+        finally:
+            self.measurements.put(None)
+
+    # next finished weight, None once the pipeline stopped. raises Queue.Empty after timeout
+    def next_measurement(self, timeout):
+        return self.measurements.get(True, timeout)
+
+    def stop(self, timeout=None):
+        if self.supervisor is not None:
+            self.supervisor.stop()
+        self.board.disconnect()
+        for thread in self.threads:
+            thread.join(timeout)
+
+    def stats(self):
+        return "queued {} processed {} dropped {}".format(self.queued, self.processed, self.dropped)
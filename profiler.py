@@ -0,0 +1,268 @@
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from collections import deque
+from datetime import datetime
+from urlparse import urlparse, parse_qs
+
+# seconds a triggered profile runs when nothing else is asked for
+PROFILE_SECONDS = 10
+
+# seconds between two stack samples of all threads
+SAMPLE_INTERVAL = 0.005
+
+# measurements kept in the stage trace
+TRACE_MEASUREMENTS = 10
+
+# per report stages (receive, decode, mass) time one call in this many and count it that many times
+TRACE_SAMPLE_EVERY = 64
+
+# order of the stages of one weigh-in; receive is the handling of a report once it arrived, so it
+# includes decode and mass, process includes commit and fitbit
+STAGES = ('receive', 'decode', 'mass', 'process', 'commit', 'fitbit', 'render_graph')
+
+# Like metrics: nothing is traced until enable_trace(). Hot paths ask trace() once, outside their
+# loops, and wrap nothing when it is None. Stage times are added without a lock, a lost update
+# between two threads only makes one estimate a bit low. Several boards weigh at the same time,
+# so every board has its own measurement in flight: a thread working for a board activate()s it
+# and its stage times go to that board's measurement. Threads that never activate one share the
+# measurement of the single board (key None).
+_trace = None
+
+
+def enable_trace(measurements=TRACE_MEASUREMENTS):
+    global _trace
+    if _trace is None:
+        _trace = Trace(measurements)
+    return _trace
+
+
+def trace():
+    return _trace
+
+
+class Trace:
+    # time spent per stage in each of the last <size> measurements, from stepping on (begin) until
+    # the weight is on the screen (finish)
+    def __init__(self, size=TRACE_MEASUREMENTS):
+        # stage times and start of the measurement in flight per board
+        self.current = {}
+        self.started = {}
+        self.local = threading.local()
+        self.measurements = deque(maxlen=size)
+
+    # the calling thread works for board <key> from now on
+    def activate(self, key):
+        self.local.key = key
+
+    def key(self):
+        return getattr(self.local, 'key', None)
+
+    def begin(self):
+        key = self.key()
+        self.current[key] = {}
+        self.started[key] = time.time()
+
+    def add(self, stage, seconds):
+        current = self.current.setdefault(self.key(), {})
+        current[stage] = current.get(stage, 0.0) + seconds
+
+    def finish(self, weight=None):
+        key = self.key()
+        finished = time.time()
+        self.measurements.append((self.started.pop(key, None) or finished, finished, weight,
+                                  self.current.pop(key, {})))
+
+    # func timing every call into <stage>
+    def timed(self, stage, func):
+        def timed(*args, **kwargs):
+            started = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(stage, time.time() - started)
+        return timed
+
+    # func timing one call in <every> into <stage>, counted <every> times
+    def sampled(self, stage, func, every=TRACE_SAMPLE_EVERY):
+        calls = [0]
+
+        def sampled(*args, **kwargs):
+            calls[0] += 1
+            if calls[0] % every:
+                return func(*args, **kwargs)
+            started = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(stage, (time.time() - started) * every)
+        return sampled
+
+    def render(self):
+        lines = ["{:<20} {:>8} {:>8} ".format("finished", "weight", "total") +
+                 " ".join("{:>12}".format(stage) for stage in STAGES)]
+        for started, finished, weight, stages in list(self.measurements):
+            lines.append("{:<20} {:>8} {:>7.0f}ms ".format(
+                datetime.fromtimestamp(finished).strftime("%Y-%m-%d %H:%M:%S"), weight,
+                (finished - started) * 1000) +
+                " ".join("{:>10.2f}ms".format(stages.get(stage, 0.0) * 1000) for stage in STAGES))
+        return "\n".join(lines) + "\n"
+
+
+# wraps the stage methods of whichever of the given objects are there with the trace. Wrap the
+# objects themselves, before any metrics.Timed proxy, so their own calls are seen as well
+def trace_stages(trace, board=None, processor=None, weight_processor=None, data=None, fitbit=None,
+                 display=None):
+    if board is not None:
+        board.dispatch = trace.sampled('receive', board.dispatch)
+        board.decoder.decode = trace.sampled('decode', board.decoder.decode)
+    if processor is not None:
+        processor.mass = trace.sampled('mass', processor.mass)
+    if weight_processor is not None:
+        weight_processor.process = trace.timed('process', weight_processor.process)
+    if data is not None:
+        data.commit = trace.timed('commit', data.commit)
+    if fitbit is not None:
+        fitbit.log_weight = trace.timed('fitbit', fitbit.log_weight)
+    if display is not None:
+        display.render_graph = trace.timed('render_graph', display.render_graph)
+
+
+def frame_stack(frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append("{}:{}".format(os.path.basename(code.co_filename), code.co_name))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+# {collapsed stack: samples} of all threads but the calling one, sampled every <interval> for <seconds>
+def sample_stacks(seconds, interval=SAMPLE_INTERVAL):
+    own = threading.current_thread().ident
+    counts = {}
+    samples = 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            key = ";".join([names.get(ident, "thread-{}".format(ident))] + frame_stack(frame))
+            counts[key] = counts.get(key, 0) + 1
+        samples += 1
+        time.sleep(interval)
+    return counts, samples
+
+
+# flamegraph.pl / speedscope input, one "stack count" line per stack
+def collapsed(counts):
+    return "".join("{} {}\n".format(stack, count) for stack, count in sorted(counts.items()))
+
+
+class Profiler:
+    # Runs the stack sampler over all threads for a while on request: SIGUSR2 (install_signal) or
+    # GET /profile?seconds=N on the local endpoint. Writes profile-<time>.folded (collapsed stacks)
+    # and trace-<time>.txt (stage times of the last measurements, with enable_trace) to <directory>.
+    # Until triggered there is no sampling thread, nothing runs.
+    def __init__(self, directory, seconds=PROFILE_SECONDS, interval=SAMPLE_INTERVAL):
+        self.directory = directory
+        self.seconds = seconds
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.running = False
+        self.server = None
+        self.last = None
+
+    # starts a profile in the background, False if one is running already
+    def trigger(self, seconds=None):
+        with self.lock:
+            if self.running:
+                return False
+            self.running = True
+        thread = threading.Thread(target=self.profile, args=(seconds or self.seconds,), name="profiler")
+        thread.daemon = True
+        thread.start()
+        return True
+
+    # samples for <seconds> in the calling thread, returns the paths written
+    def profile(self, seconds):
+        try:
+            logging.info("Profiling all threads for {}s".format(seconds))
+            counts, samples = sample_stacks(seconds, self.interval)
+            stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            paths = [os.path.join(self.directory, "profile-{}.folded".format(stamp))]
+            with open(paths[0], 'wb') as f:
+                f.write(collapsed(counts))
+            if _trace is not None:
+                paths.append(os.path.join(self.directory, "trace-{}.txt".format(stamp)))
+                with open(paths[1], 'wb') as f:
+                    f.write(_trace.render())
+            logging.info("Profile of {} samples written to {}".format(samples, ", ".join(paths)))
+            self.last = paths
+            return paths
+        finally:
+            with self.lock:
+                self.running = False
+
+    # the handler runs in the main thread as soon as it gets control again. Interrupted system
+    # calls are restarted, a blocking recv on the board must not see EINTR as a lost link
+    def install_signal(self, signum=signal.SIGUSR2):
+        signal.signal(signum, lambda number, frame: self.trigger())
+        signal.siginterrupt(signum, False)
+
+    def serve(self, port, address='127.0.0.1'):
+        self.server = HTTPServer((address, port), ProfileHandler)
+        self.server.profiler = self
+        thread = threading.Thread(target=self.server.serve_forever, name="profiler-http")
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+class ProfileHandler(BaseHTTPRequestHandler):
+    # /profile?seconds=N profiles right away and answers with the collapsed stacks, /trace with the
+    # stage trace
+    def do_GET(self):
+        url = urlparse(self.path)
+        profiler = self.server.profiler
+        if url.path == "/profile":
+            try:
+                seconds = float(parse_qs(url.query).get('seconds', [profiler.seconds])[0])
+            except ValueError:
+                self.send_error(400)
+                return
+            with profiler.lock:
+                busy = profiler.running
+                profiler.running = True
+            if busy:
+                self.send_error(409, "Already profiling")
+                return
+            paths = profiler.profile(min(seconds, 300))
+            with open(paths[0], 'rb') as f:
+                body = f.read()
+        elif url.path == "/trace" and _trace is not None:
+            body = _trace.render()
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
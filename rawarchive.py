@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+
+# Raw sensor archive: the four raw sensor words of every report while somebody is on the board,
+# one file per day (raw-YYYY-MM-DD.bin), appended in blocks:
+#
+#   header (40 bytes): "RAWS", session (<f8, start in unix seconds), count (uint32),
+#                      calibration (12 x uint16: 0 kg, 17 kg, 34 kg rows)
+#   columns:           time (count x <f8), raw top right, bottom right, top left, bottom left
+#                      (count x <u2 each)
+#
+# Every column is a plain little endian array at an aligned offset, so numpy maps it without
+# copying. The scale itself only needs the standard library, numpy is needed for the analysis:
+#   python rawarchive.py stats <directory or files>
+
+import array
+import logging
+import mmap
+import os
+import struct
+import sys
+import time
+
+from datetime import datetime
+from boarddecoder import EXTENSION_REPORT, EXTENSION_REPORT_OFFSET, CALIBRATION_STEP_KG
+from eventprocessor import MIN_WEIGHT
+
+# the session is the float start time: two weighings started within the same second are
+# still two sessions (the first format, "RAWB", kept whole seconds)
+BLOCK_MAGIC = "RAWS"
+BLOCK_HEADER = struct.Struct("<4sdI12H")
+
+# samples buffered before a block is appended, ~5 seconds of reports
+BLOCK_SIZE = 500
+
+# settle detection of the analysis, same meaning as STABLE_* of the scale
+STABLE_WINDOW = 100
+STABLE_MAX_STDDEV = 0.15
+STABLE_MAX_DRIFT = 0.1
+
+# 0.1 kg bins of the mode, like the histogram estimator
+BIN_SCALE = 10
+MAX_BIN = 4096
+
+
+def archive_path(directory, timestamp):
+    return os.path.join(directory, "raw-{}.bin".format(datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d")))
+
+
+def block_bytes(count):
+    return BLOCK_HEADER.size + count * 16
+
+
+class SensorArchive:
+    # Fed from the receive loop with every weight report. A session starts when the weight
+    # goes above MIN_WEIGHT and ends when it drops below, its samples are appended to the file
+    # of the day it started in every BLOCK_SIZE samples and at its end.
+    def __init__(self, directory, block_size=BLOCK_SIZE):
+        self.directory = directory
+        self.block_size = block_size
+        self.session = None
+        self.calibration = None
+        self.path = None
+        self.times = array.array('d')
+        self.columns = [array.array('H') for _ in xrange(4)]
+        self.blocks = 0
+        self.samples = 0
+
+    # <now> is the time of the report, the current time if not given
+    def add(self, data, total_weight, calibration, offset=EXTENSION_REPORT_OFFSET, now=None):
+        if total_weight > MIN_WEIGHT:
+            if now is None:
+                now = time.time()
+            if self.session is None:
+                self.session = now
+                self.calibration = [word for row in calibration for word in row]
+                self.path = archive_path(self.directory, now)
+            buttons, raw_tr, raw_br, raw_tl, raw_bl = EXTENSION_REPORT.unpack_from(data, offset)
+            columns = self.columns
+            self.times.append(now)
+            columns[0].append(raw_tr)
+            columns[1].append(raw_br)
+            columns[2].append(raw_tl)
+            columns[3].append(raw_bl)
+            if len(self.times) >= self.block_size:
+                self.flush()
+        elif self.session is not None:
+            self.end_session()
+
+    def flush(self):
+        count = len(self.times)
+        if count == 0:
+            return
+        columns = [self.times] + self.columns
+        if sys.byteorder != 'little':
+            columns = [array.array(c.typecode, c) for c in columns]
+            for c in columns:
+                c.byteswap()
+        with open(self.path, 'ab') as f:
+            f.write(BLOCK_HEADER.pack(BLOCK_MAGIC, self.session, count, *self.calibration))
+            for c in columns:
+                c.tofile(f)
+        self.blocks += 1
+        self.samples += count
+        self.times = array.array('d')
+        self.columns = [array.array('H') for _ in xrange(4)]
+
+    def end_session(self):
+        self.flush()
+        self.session = None
+
+    def close(self):
+        self.end_session()
+
+
+# (session, count, calibration, offset of the columns) of every complete block in buf
+def blocks(buf, name=""):
+    offset = 0
+    size = len(buf)
+    while offset + BLOCK_HEADER.size <= size:
+        header = BLOCK_HEADER.unpack_from(buf, offset)
+        magic, session, count = header[:3]
+        if magic != BLOCK_MAGIC:
+            logging.warning("Bad block at {} in {}, skipping the rest".format(offset, name))
+            return
+        if offset + block_bytes(count) > size:
+            logging.warning("Truncated block at {} in {}".format(offset, name))
+            return
+        yield session, count, header[3:], offset + BLOCK_HEADER.size
+        offset += block_bytes(count)
+
+
+def archive_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name) for name in os.listdir(path)
+                         if name.startswith("raw-") and name.endswith(".bin"))
+        else:
+            files.append(path)
+    return sorted(files)
+
+
+class Samples:
+    # all samples of the given archives as arrays: time, raw (n x 4, archive column order),
+    # session and calibration (n x 12, indexed through block)
+    def __init__(self, time, raw, session, block, calibrations):
+        self.time = time
+        self.raw = raw
+        self.session = session
+        self.block = block
+        self.calibrations = calibrations
+
+
+def load(paths):
+    import numpy
+
+    times = []
+    raws = []
+    sessions = []
+    block_index = []
+    calibrations = []
+    for path in archive_files(paths):
+        if os.path.getsize(path) == 0:
+            continue
+        with open(path, 'rb') as f:
+            # the arrays below keep the mapping alive
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        for session, count, calibration, offset in blocks(mapped, path):
+            times.append(numpy.frombuffer(mapped, '<f8', count, offset))
+            raws.append(numpy.frombuffer(mapped, '<u2', count * 4, offset + count * 8).reshape(4, count))
+            sessions.append(numpy.full(count, session, numpy.float64))
+            block_index.append(numpy.full(count, len(calibrations), numpy.int64))
+            calibrations.append(calibration)
+    if not times:
+        return None
+    # the only copy: the mapped blocks into one array per column
+    return Samples(numpy.concatenate(times), numpy.concatenate(raws, axis=1).T.astype(numpy.float64),
+                   numpy.concatenate(sessions), numpy.concatenate(block_index),
+                   numpy.array(calibrations, numpy.float64))
+
+
+# CalibrationTable.mass over whole arrays: raw (n x 4), zero/mid/high (n x 4, or broadcastable)
+def masses(raw, zero, mid, high):
+    import numpy
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        low_slope = numpy.where(mid != zero, CALIBRATION_STEP_KG / (mid - zero), 0.0)
+        high_slope = numpy.where(high != mid, CALIBRATION_STEP_KG / (high - mid), 0.0)
+    mass = numpy.where(raw < mid, (raw - zero) * low_slope, CALIBRATION_STEP_KG + (raw - mid) * high_slope)
+    return numpy.where(raw < zero, 0.0, mass)
+
+
+def session_stats(samples, window=STABLE_WINDOW, max_stddev=STABLE_MAX_STDDEV, max_drift=STABLE_MAX_DRIFT):
+    import numpy
+
+    # sessions contiguous and in time order
+    order = numpy.lexsort((samples.time, samples.session))
+    t = samples.time[order]
+    calibration = samples.calibrations[samples.block[order]]
+    mass = masses(samples.raw[order], calibration[:, 0:4], calibration[:, 4:8], calibration[:, 8:12])
+    total = mass.sum(axis=1)
+    left = mass[:, 2] + mass[:, 3]
+
+    ids, inverse = numpy.unique(samples.session[order], return_inverse=True)
+    sessions = len(ids)
+    count = numpy.bincount(inverse, minlength=sessions)
+    starts = numpy.concatenate(([0], numpy.cumsum(count)[:-1]))
+    mean = numpy.bincount(inverse, total, sessions) / count
+    stddev = numpy.sqrt(numpy.maximum(numpy.bincount(inverse, total * total, sessions) / count - mean ** 2, 0))
+    balance = numpy.bincount(inverse, left, sessions) / numpy.maximum(numpy.bincount(inverse, total, sessions), 1e-9)
+
+    # mode of the 0.1 kg bins: count per (session, bin), the biggest count of each session
+    bins = numpy.clip(numpy.round(total * BIN_SCALE).astype(numpy.int64), 0, MAX_BIN - 1)
+    keys, key_counts = numpy.unique(inverse * MAX_BIN + bins, return_counts=True)
+    key_sessions = keys // MAX_BIN
+    by_count = numpy.lexsort((key_counts, key_sessions))
+    last = numpy.concatenate((numpy.nonzero(numpy.diff(key_sessions[by_count]))[0], [len(by_count) - 1]))
+    mode = (keys[by_count[last]] % MAX_BIN) / float(BIN_SCALE)
+
+    # settle: first sample ending a window of the same session with a small stddev and drift,
+    # windows from running sums
+    n = len(total)
+    sums = numpy.concatenate(([0.0], numpy.cumsum(total)))
+    squares = numpy.concatenate(([0.0], numpy.cumsum(total * total)))
+    end = numpy.arange(window - 1, n)
+    first = end - window + 1
+    half = window // 2
+    window_sum = sums[end + 1] - sums[first]
+    window_variance = (squares[end + 1] - squares[first]) / window - (window_sum / window) ** 2
+    drift = numpy.abs((sums[end + 1] - sums[first + half]) / (window - half)
+                      - (sums[first + half] - sums[first]) / half)
+    stable = (first >= starts[inverse[end]]) & (window_variance <= max_stddev ** 2) & (drift <= max_drift)
+    settle_index = numpy.full(n, n, numpy.int64)
+    settle_index[end[stable]] = end[stable]
+    settled_at = numpy.minimum.reduceat(settle_index, starts)
+    settled = settled_at < n
+    settle_time = numpy.where(settled, t[numpy.minimum(settled_at, n - 1)] - t[starts], numpy.nan)
+
+    # spread of the samples the estimator sees once settled, and the resulting error of its mean
+    after = numpy.arange(n) >= settled_at[inverse]
+    after_count = numpy.bincount(inverse[after], minlength=sessions)
+    after_mean = numpy.bincount(inverse[after], total[after], sessions) / numpy.maximum(after_count, 1)
+    after_variance = numpy.bincount(inverse[after], total[after] ** 2, sessions) / numpy.maximum(after_count, 1) \
+        - after_mean ** 2
+    after_stddev = numpy.where(after_count > 1, numpy.sqrt(numpy.maximum(after_variance, 0)), numpy.nan)
+    estimate_error = after_stddev / numpy.sqrt(numpy.maximum(after_count, 1))
+
+    return {'session': ids, 'samples': count, 'mode': mode, 'mean': mean, 'stddev': stddev,
+            'settle_time': settle_time, 'settled_stddev': after_stddev, 'estimate_error': estimate_error,
+            'left': balance}
+
+
+def print_stats(stats):
+    print "session              samples   mode    mean  stddev  settle  settled sd  est. error  left"
+    for i in xrange(len(stats['session'])):
+        print "{:<20} {:>7} {:>6.1f} {:>7.2f} {:>7.3f} {:>6.2f}s {:>11.3f} {:>11.4f} {:>5.1%}".format(
+            datetime.fromtimestamp(int(stats['session'][i])).strftime("%Y-%m-%d %H:%M:%S"), stats['samples'][i],
+            stats['mode'][i], stats['mean'][i], stats['stddev'][i], stats['settle_time'][i],
+            stats['settled_stddev'][i], stats['estimate_error'][i], stats['left'][i])
+
+
+def main():
+    if len(sys.argv) < 3 or sys.argv[1] != "stats":
+        print "usage: python rawarchive.py stats <directory or files>"
+        sys.exit(1)
+    start = time.time()
+    samples = load(sys.argv[2:])
+    if samples is None:
+        print "no samples"
+        return
+    stats = session_stats(samples)
+    print_stats(stats)
+    print "{} sessions, {} samples in {:.2f}s".format(len(stats['session']), len(samples.time), time.time() - start)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+import logging
+import threading
+import time
+
+from contextlib import contextmanager
+
+
+class StartupTimer:
+    # Wall time of the startup phases, counted from <started> (the process start). Phases may run
+    # in parallel threads, ready() logs each of them and the boot to ready latency.
+    def __init__(self, started=None):
+        self.started = started if started is not None else time.time()
+        self.phases = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            end = time.time()
+            with self.lock:
+                self.phases.append((name, start - self.started, end - self.started))
+            logging.debug("Startup: {} took {:.2f}s".format(name, end - start))
+
+    def ready(self):
+        elapsed = time.time() - self.started
+        with self.lock:
+            phases = sorted(self.phases, key=lambda phase: phase[1])
+        logging.info("Startup: ready after {:.2f}s ({})".format(elapsed, ", ".join(
+            "{} {:.2f}-{:.2f}s".format(name, start, end) for name, start, end in phases)))
+        return elapsed
+
+
+class Background:
+    # runs func(*args) in a thread, result() waits for it and returns its value or raises its error
+    def __init__(self, name, func, *args):
+        self.func = func
+        self.args = args
+        self.value = None
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name=name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        try:
+            self.value = self.func(*self.args)
+        except Exception as e:
+            logging.exception("Startup: {} failed".format(self.thread.name))
+            self.error = e
+
+    def result(self):
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.value
@@ -4,7 +4,7 @@ from pygame.locals import *
 from dataprovider import WeightRecord, DataProvider
 
 data = DataProvider("/home/pi/weight_db")
-all_records = data.all("Alex")
+all_records = data.all_mornings("Alex")
 print all_records
 
 count = sum(1 for r in all_records)
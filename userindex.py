@@ -0,0 +1,199 @@
+import bisect
+import math
+
+from collections import deque
+from datetime import date
+
+# records per user the rolling mean, variance and trend are computed over
+MODEL_WINDOW = 30
+
+# day to day weight changes of one person, variance never goes below this
+MIN_STDDEV = 0.5
+
+# match window of a user: at least max_weight_diff, wider for users whose weight varies a lot
+WINDOW_STDDEVS = 3
+
+# the trend is extrapolated at most this many days past the last record
+MAX_TREND_DAYS = 30
+
+# lookups compare the weight with this many users on each side of it
+NEIGHBOURS = 2
+
+
+def day_number(record):
+    return date(record.year, record.month, record.day).toordinal()
+
+
+class UserModel:
+    # rolling mean, variance and least squares trend (kg/day) over the last <window> records,
+    # kept as running sums so adding a record is O(1)
+    def __init__(self, name, weight=None, window=MODEL_WINDOW):
+        self.name = name
+        self.window = window
+        self.records = deque()
+        # days are counted from the first record, which keeps the sums small
+        self.origin = None
+        self.sum_t = 0.0
+        self.sum_w = 0.0
+        self.sum_ww = 0.0
+        self.sum_tw = 0.0
+        self.sum_tt = 0.0
+        # configured weight, used until there is some history
+        self.seed = weight
+        self.last_day = None
+
+    def add(self, day, w):
+        self.records.append((day, w))
+        self.update(day, w, 1)
+        if len(self.records) > self.window:
+            old_day, old_w = self.records.popleft()
+            self.update(old_day, old_w, -1)
+        if self.last_day is None or day > self.last_day:
+            self.last_day = day
+
+    def copy(self):
+        model = UserModel(self.name)
+        model.__dict__.update(self.__dict__)
+        model.records = deque(self.records)
+        return model
+
+    def update(self, day, w, sign):
+        if self.origin is None:
+            self.origin = day
+        t = day - self.origin
+        self.sum_t += sign * t
+        self.sum_w += sign * w
+        self.sum_ww += sign * w * w
+        self.sum_tw += sign * t * w
+        self.sum_tt += sign * t * t
+
+    def count(self):
+        return len(self.records)
+
+    def mean(self):
+        if not self.records:
+            return self.seed
+        return self.sum_w / len(self.records)
+
+    # variance around the trend line, a steady diet doesn't make the user's window wider
+    def variance(self):
+        n = len(self.records)
+        if n < 2:
+            return MIN_STDDEV ** 2
+        mean_t = self.sum_t / n
+        mean_w = self.sum_w / n
+        variance = self.sum_ww / n - mean_w ** 2
+        covariance = self.sum_tw / n - mean_t * mean_w
+        return max(variance - self.trend() * covariance, MIN_STDDEV ** 2)
+
+    def stddev(self):
+        return math.sqrt(self.variance())
+
+    def trend(self):
+        n = len(self.records)
+        if n < 2:
+            return 0.0
+        denominator = n * self.sum_tt - self.sum_t ** 2
+        if denominator <= 0:
+            return 0.0
+        return (n * self.sum_tw - self.sum_t * self.sum_w) / denominator
+
+    # expected weight on <day>, the trend continued from the records' centre
+    def predict(self, day=None):
+        if not self.records:
+            return self.seed
+        mean_t = self.sum_t / len(self.records) + self.origin
+        if day is None:
+            day = self.last_day
+        day = min(day, self.last_day + MAX_TREND_DAYS)
+        return self.mean() + self.trend() * (day - mean_t)
+
+
+class UserIndex:
+    # Users sorted by predicted weight. A lookup bisects the sorted predictions and scores only
+    # the nearest users on each side, so it is O(log users). Every user matches within
+    # max(max_weight_diff, WINDOW_STDDEVS * stddev) of the prediction, overlapping windows are
+    # resolved by likelihood and the confidence is the winner's share of the total likelihood.
+    # Lookups come from other threads (the estimator's live render) without a lock: add() works
+    # on copies and swaps in the changed model, then (centres, names) as one tuple, so a lookup
+    # sees the index before or after a record, never half of it.
+    def __init__(self, max_weight_diff, day=None):
+        self.max_weight_diff = max_weight_diff
+        self.day = day
+        self.models = {}
+        self.entries = ([], [])
+
+    def train(self, users_provider, data):
+        for user in users_provider.all():
+            model = UserModel(user, users_provider.weight(user))
+            records = data.all_mornings(user)[-MODEL_WINDOW:]
+            last = data.last(user)
+            if last is not None and all(r is not last for r in records):
+                records.append(last)
+            for record in sorted(records, key=day_number):
+                model.add(day_number(record), record.w)
+            self.models[user] = model
+        self.rebuild()
+
+    def rebuild(self):
+        entries = sorted((model.predict(self.day), name) for name, model in self.models.items()
+                         if model.predict(self.day) is not None)
+        self.entries = ([centre for centre, _ in entries], [name for _, name in entries])
+
+    # a new saved record of <user>, moves only that user in the index
+    def add(self, user, record):
+        centres, names = self.entries
+        centres = list(centres)
+        names = list(names)
+        model = self.models.get(user)
+        if model is None:
+            model = UserModel(user)
+        else:
+            remove(centres, names, user, model.predict(self.day))
+            model = model.copy()
+        model.add(day_number(record), record.w)
+        centre = model.predict(self.day)
+        position = bisect.bisect_left(centres, centre)
+        centres.insert(position, centre)
+        names.insert(position, user)
+        self.models[user] = model
+        self.entries = (centres, names)
+
+    def half_width(self, model):
+        return max(self.max_weight_diff, WINDOW_STDDEVS * model.stddev())
+
+    # (user, confidence) of the most likely user, (None, 0.0) if the weight is nobody's
+    def identify(self, w):
+        centres, names = self.entries
+        position = bisect.bisect_left(centres, w)
+        best = None
+        best_likelihood = 0.0
+        total = 0.0
+        for i in xrange(max(position - NEIGHBOURS, 0), min(position + NEIGHBOURS, len(centres))):
+            model = self.models[names[i]]
+            distance = abs(w - centres[i])
+            if distance > self.half_width(model):
+                continue
+            stddev = model.stddev()
+            likelihood = math.exp(-0.5 * (distance / stddev) ** 2) / stddev
+            total += likelihood
+            if best is None or likelihood > best_likelihood:
+                best = names[i]
+                best_likelihood = likelihood
+        if best is None:
+            return None, 0.0
+        if total <= 0:
+            # far out in the tails of every candidate, nothing to tell them apart
+            return best, 0.0
+        return best, best_likelihood / total
+
+    def user(self, w):
+        return self.identify(w)[0]
+
+
+def remove(centres, names, user, centre):
+    position = bisect.bisect_left(centres, centre)
+    while names[position] != user:
+        position += 1
+    del centres[position]
+    del names[position]
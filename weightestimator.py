@@ -0,0 +1,157 @@
+import collections
+
+# values are grouped in 0.1 kg bins, same as round(value, 1)
+BIN_SCALE = 10
+MAX_WEIGHT = 300
+
+
+def weight_bin(value):
+    return int(round(round(value, 1) * BIN_SCALE))
+
+
+class CounterEstimator:
+    # keeps every sample of the measurement and counts them on each read
+    def __init__(self):
+        self.events = []
+
+    def reset(self):
+        self.events = []
+
+    def add(self, value):
+        self.events.append(value)
+
+    def count(self):
+        return len(self.events)
+
+    @property
+    def weight(self):
+        if not self.events:
+            return 0
+        histogram = collections.Counter(round(num, 1) for num in self.events)
+        return histogram.most_common(1)[0][0]
+
+
+class HistogramEstimator:
+    # Fixed size histogram of 0.1 kg bins updated per sample. The most common bin is tracked
+    # while adding, so reading the weight is O(1) and memory doesn't depend on how long
+    # somebody stands on the board.
+    def __init__(self, max_weight=MAX_WEIGHT):
+        self.bins = [0] * (max_weight * BIN_SCALE + 1)
+        self.last_bin = len(self.bins) - 1
+        self.touched = []
+        self.samples = 0
+        self.best = 0
+        self.best_count = 0
+
+    def reset(self):
+        # only clear bins that were used, a session touches a few dozen of them
+        bins = self.bins
+        for i in self.touched:
+            bins[i] = 0
+        self.touched = []
+        self.samples = 0
+        self.best = 0
+        self.best_count = 0
+
+    def add(self, value):
+        i = weight_bin(value)
+        if i > self.last_bin:
+            i = self.last_bin
+        elif i < 0:
+            i = 0
+        bins = self.bins
+        c = bins[i] + 1
+        bins[i] = c
+        if c == 1:
+            self.touched.append(i)
+        self.samples += 1
+        if c > self.best_count:
+            self.best_count = c
+            self.best = i
+
+    def count(self):
+        return self.samples
+
+    @property
+    def weight(self):
+        if not self.samples:
+            return 0
+        return self.best / float(BIN_SCALE)
+
+    def median(self):
+        if not self.samples:
+            return 0
+        half = (self.samples + 1) // 2
+        seen = 0
+        bins = self.bins
+        for i in sorted(self.touched):
+            seen += bins[i]
+            if seen >= half:
+                return i / float(BIN_SCALE)
+        return self.best / float(BIN_SCALE)
+
+
+ESTIMATORS = {
+    'counter': CounterEstimator,
+    'histogram': HistogramEstimator,
+}
+
+
+def create_estimator(name):
+    return ESTIMATORS[name]()
+
+
+class StabilityDetector:
+    # Sliding window over the last <window> samples with running sums, so each sample is O(1).
+    # The weight is considered settled when the window is full, its standard deviation is within
+    # max_stddev and the mean of the newer half differs from the older half by at most max_drift.
+    def __init__(self, window, max_stddev, max_drift):
+        self.window = window
+        self.half = window // 2
+        self.max_variance = max_stddev * max_stddev
+        self.max_drift = max_drift
+        self.values = [0.0] * window
+        self.reset()
+
+    def reset(self):
+        self.samples = 0
+        self.position = 0
+        self.total = 0.0
+        self.total_sq = 0.0
+        self.recent = 0.0
+
+    def add(self, value):
+        values = self.values
+        position = self.position
+        if self.samples >= self.window:
+            old = values[position]
+            self.total -= old
+            self.total_sq -= old * old
+        if self.samples >= self.half:
+            # sample moving from the newer half to the older one
+            self.recent -= values[(position - self.half) % self.window]
+        values[position] = value
+        self.total += value
+        self.total_sq += value * value
+        self.recent += value
+        self.position = (position + 1) % self.window
+        self.samples += 1
+        return self.stable()
+
+    def variance(self):
+        n = min(self.samples, self.window)
+        if n == 0:
+            return 0.0
+        mean = self.total / n
+        return max(self.total_sq / n - mean * mean, 0.0)
+
+    def drift(self):
+        if self.samples < self.window:
+            return 0.0
+        older = self.window - self.half
+        return abs(self.recent / self.half - (self.total - self.recent) / older)
+
+    def stable(self):
+        return self.samples >= self.window \
+               and self.variance() <= self.max_variance \
+               and self.drift() <= self.max_drift
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+
+# Append-only binary weight log, an alternative storage for DataProvider.
+#
+# <path>      8 byte file header followed by fixed width records, never rewritten
+# <path>.idx  small JSON header with the user table (user id -> name)
+#
+# Only the morning/last flags of the moment a record was written are stored with it. Clearing
+# "last" on the previous morning is not written at all: the newest record of a user written
+# with the last flag is its last record, so the flags are recovered by reading the log in order.
+
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+
+from datetime import datetime
+from atomicfile import write_atomic
+from dataprovider import WeightRecord, RecordIndex, Transactional
+
+LOG_HEADER = struct.Struct("<4sHH")
+LOG_MAGIC = "WLOG"
+LOG_VERSION = 1
+
+# time (ms since epoch), weight, year, month, day, user id, flags
+RECORD = struct.Struct("<qdHBBHH")
+
+FLAG_MORNING = 1
+FLAG_LAST = 2
+
+# records of a migration written (and synced) together
+IMPORT_GROUP = 1000
+
+
+def timestamp_ms(value=None):
+    return int(((value or datetime.utcnow()) - datetime(1970, 1, 1)).total_seconds() * 1000)
+
+
+class LogDataProvider(Transactional):
+    def __init__(self, path):
+        Transactional.__init__(self)
+        self.path = path
+        self.header_path = path + ".idx"
+        self.users = []
+        self.user_ids = {}
+        self.records = RecordIndex()
+        self.count = 0
+
+        if os.path.exists(self.header_path):
+            with open(self.header_path, 'rb') as f:
+                self.users = json.load(f)['users']
+            self.user_ids = dict((name, i) for i, name in enumerate(self.users))
+
+        self.file = self.open_log()
+        last = {}
+        for record in self.read_all():
+            if record.last:
+                if record.user in last:
+                    last[record.user].last = False
+                last[record.user] = record
+            self.records.add(record)
+
+    def open_log(self):
+        if not os.path.exists(self.path):
+            write_atomic(self.path, LOG_HEADER.pack(LOG_MAGIC, LOG_VERSION, RECORD.size))
+
+        f = open(self.path, 'r+b')
+        magic, version, record_size = LOG_HEADER.unpack(f.read(LOG_HEADER.size))
+        if magic != LOG_MAGIC or record_size != RECORD.size:
+            raise Exception("{} is not a weight log".format(self.path))
+
+        # a crash in the middle of an append leaves a partial record at the end
+        size = os.fstat(f.fileno()).st_size
+        tail = (size - LOG_HEADER.size) % RECORD.size
+        if tail:
+            logging.warning("Dropping {} bytes of incomplete record at the end of {}".format(tail, self.path))
+            size -= tail
+            f.truncate(size)
+        self.count = (size - LOG_HEADER.size) // RECORD.size
+        f.seek(size)
+        return f
+
+    def iter_raw(self):
+        self.file.flush()
+        size = LOG_HEADER.size + self.count * RECORD.size
+        if self.count == 0:
+            return
+        data = mmap.mmap(self.file.fileno(), size, access=mmap.ACCESS_READ)
+        try:
+            unpack_from = RECORD.unpack_from
+            for offset in xrange(LOG_HEADER.size, size, RECORD.size):
+                yield unpack_from(data, offset)
+        finally:
+            data.close()
+
+    def read_all(self):
+        for position, (time, w, year, month, day, user_id, flags) in enumerate(self.iter_raw()):
+            yield WeightRecord({'pk': position, 'time': time, 'w': w,
+                                'year': year, 'month': month, 'day': day,
+                                'user': self.user_name(user_id),
+                                'morning': bool(flags & FLAG_MORNING),
+                                'last': bool(flags & FLAG_LAST)})
+
+    def user_name(self, user_id):
+        if user_id < len(self.users):
+            return self.users[user_id]
+        return "User{}".format(user_id)
+
+    def user_id(self, name):
+        user_id = self.user_ids.get(name)
+        if user_id is None:
+            # the header has to be on disk before any record refers to the new id
+            user_id = len(self.users)
+            self.users.append(name)
+            self.user_ids[name] = user_id
+            write_atomic(self.header_path, json.dumps({'users': self.users}))
+        return user_id
+
+    def last(self, user):
+        return self.records.last(user)
+
+    def all_mornings(self, user):
+        return self.records.all_mornings(user)
+
+    def last_morning(self, data):
+        return self.records.last_morning(data)
+
+    def today_morning(self, data):
+        return self.records.today_morning(data)
+
+    def save(self, record):
+        if self.queue(record):
+            return
+        if getattr(record, 'pk', None) is None:
+            self.append(record)
+        # records already in the log only change their last flag, which lives in the index
+        self.records.add(record)
+        self.version += 1
+
+    def pack(self, record):
+        flags = 0
+        if getattr(record, 'morning', False):
+            flags |= FLAG_MORNING
+        if getattr(record, 'last', False):
+            flags |= FLAG_LAST
+        if getattr(record, 'time', None) is None:
+            record.time = timestamp_ms()
+        return RECORD.pack(record.time, record.w, record.year, record.month, record.day,
+                           self.user_id(record.user), flags)
+
+    def append(self, record):
+        self.file.write(self.pack(record))
+        record.pk = self.count
+        self.count += 1
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def stored_last(self, record):
+        return self.records.last(getattr(record, 'user', None)) is record
+
+    # the new records in one write and one fsync. a failed write is cut off again, the log
+    # never keeps a part of a batch
+    def write_batch(self, records, deleted=()):
+        if deleted:
+            raise Exception("Records can't be deleted from the weight log")
+        new = [record for record in records if getattr(record, 'pk', None) is None]
+        size = LOG_HEADER.size + self.count * RECORD.size
+        if new:
+            data = "".join(self.pack(record) for record in new)
+            try:
+                self.file.write(data)
+                self.sync()
+            except:
+                self.file.seek(size)
+                self.file.truncate(size)
+                raise
+            for i, record in enumerate(new):
+                record.pk = self.count + i
+            self.count += len(new)
+        for record in records:
+            self.records.add(record)
+
+    def close(self):
+        self.flush()
+        self.sync()
+        self.file.close()
+
+
+def migration_order(record):
+    return (record.year, record.month, record.day, getattr(record, 'time', None) or 0)
+
+
+# copies every WeightRecord of a blitzdb directory into a new weight log
+def migrate(db_path, log_path):
+    from dataprovider import DataProvider
+
+    if os.path.exists(log_path):
+        raise Exception("{} already exists".format(log_path))
+
+    source = DataProvider(db_path)
+    log = LogDataProvider(log_path)
+    records = sorted(source.db.filter(WeightRecord, {}), key=migration_order)
+    log.group_commit(IMPORT_GROUP)
+    for record in records:
+        time = getattr(record, 'time', None)
+        if time is None:
+            time = timestamp_ms(datetime(record.year, record.month, record.day))
+        log.begin()
+        log.save(WeightRecord({'time': time, 'w': record.w,
+                               'year': record.year, 'month': record.month, 'day': record.day,
+                               'user': getattr(record, 'user', 'User'),
+                               'morning': getattr(record, 'morning', False),
+                               'last': getattr(record, 'last', False)}))
+        log.commit()
+    log.close()
+    return len(records)
+
+
+def main():
+    if len(sys.argv) != 4 or sys.argv[1] != "migrate":
+        print "usage: weightlog.py migrate <blitzdb directory> <log file>"
+        sys.exit(1)
+    print "Migrated {} records".format(migrate(sys.argv[2], sys.argv[3]))
+
+
+if __name__ == "__main__":
+    main()
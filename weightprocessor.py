@@ -1,6 +1,7 @@
 import logging
 
 from datetime import date, datetime
+from userindex import UserIndex
 
 
 def get_first_func(iterable, default=None):
@@ -36,19 +37,15 @@ class WeightProcessorConfiguration:
 
 
 class WeightProcessor:
-    def __init__(self, data, configuration, users_provider, fitbit=None):
+    def __init__(self, data, configuration, users_provider, fitbit=None, aggregates=None):
         self.data = data
         self.configuration = configuration
         self.users_provider = users_provider
         self.fitbit = fitbit
-        self.update_users_map()
-
-    # update user's weights in USER structure
-    def update_users_map(self):
-        for user in self.users_provider.all():
-            last_user_record = self.data.last(user)
-            if last_user_record is not None:
-                self.users_provider.update_weight(user, last_user_record.w)
+        self.aggregates = aggregates
+        # trained from the history once, then kept up to date with every saved morning
+        self.users = UserIndex(configuration.max_weight_diff_to_define_user())
+        self.users.train(users_provider, data)
 
     def timestamp_ms(self):
         return int((datetime.utcnow() - datetime(1970, 1, 1)).total_seconds() * 1000)
@@ -65,8 +62,11 @@ class WeightProcessor:
         today_morning.time = self.timestamp_ms()
         self.data.save(today_morning)
 
+    # only for a morning that is committed, a rolled back one must not reach fitbit
+    def upload_morning(self, today_morning):
         if self.fitbit is not None:
-            self.fitbit.log_weight(today_morning.user, today_morning.w)
+            day = date(today_morning.year, today_morning.month, today_morning.day).strftime("%Y-%m-%d")
+            self.fitbit.log_weight(today_morning.user, today_morning.w, day)
 
     def process_new_regular_record(self, data):
         logging.debug("Saving as regular value")
@@ -81,33 +81,25 @@ class WeightProcessor:
         diff_date = diff_dates_func(d1, d2)
         diff_w = data.w - last_morning.w
 
-        logging.debug(
-            "Compare with last: Date diff {} Weight diff {}".format(diff_date, diff_w))
+        logging.debug("Compare with last: Date diff %s Weight diff %s", diff_date, diff_w)
 
         return diff_date < self.configuration.max_pause_for_morning_checks_days() \
                and diff_w > self.configuration.max_morning_weight_diff()
 
     def get_user_by_weight(self, w):
-        diff_to_define_user = self.configuration.max_weight_diff_to_define_user()
-
-        for user in self.users_provider.all():
-            map_weight = self.users_provider.weight(user)
-            if map_weight - diff_to_define_user <= w <= map_weight + diff_to_define_user:
-                return user
-
-        return None
+        return self.users.user(w)
 
     def process(self, data):
-        user = self.get_user_by_weight(data.w)
+        user, confidence = self.users.identify(data.w)
         morning_flow = True
 
         if user is not None:
-            logging.debug("User {} matching to {} kg".format(user, data.w))
+            logging.debug("User %s matching to %s kg (confidence %.2f)", user, data.w, confidence)
             data.user = user
         else:
             # in case if we can't define user, we are saving weight for generic user and not
             # doing any other flows
-            logging.warn("Nobody is matching to {} kg".format(data.w))
+            logging.warn("Nobody is matching to %s kg", data.w)
             data.user = 'User'
             morning_flow = False
 
@@ -117,36 +109,45 @@ class WeightProcessor:
             logging.debug("Morning flow will not be executed because of hours limit")
             morning_flow = False
 
-        if morning_flow:
-            today_morning = self.data.today_morning(data)
-            last_morning = self.data.last_morning(data)
-
-            if today_morning is None and last_morning is None:
-                # if we don't have any records for this day and none for previous, just record this value as
-                # first morning
-                logging.info("Wow, your first value in db! Saving that")
-                self.process_new_morning_record(data, last_morning)
-
-            elif today_morning is None and last_morning is not None:
-                # if we don't have morning record for today but we have for last_morning 5 days, we should check the diff
-                # between last_morning morning and today morning. We should not accept diff in w greater than 2
-                if self.check_for_morning_value(data, last_morning):
-                    logging.warn(
-                        "Weight diff is too significant to be consider as morning weight. "
-                        "Will be recorded as regular")
-                    data.morning = False
-                    self.data.save(data)
-                else:
-                    logging.info("Saving as morning weight for today")
-                    self.process_new_morning_record(data, last_morning)
+        # the saves of this measurement are written together, or not at all
+        with self.data.unit_of_work():
+            if morning_flow:
+                today_morning = self.data.today_morning(data)
+                last_morning = self.data.last_morning(data)
 
-            elif today_morning is not None and last_morning is not None:
-                # in situation when we already log morning value, when we have new data, we just saving that as
-                # regular data
+                if today_morning is None and last_morning is None:
+                    # if we don't have any records for this day and none for previous, just record this value as
+                    # first morning
+                    logging.info("Wow, your first value in db! Saving that")
+                    self.process_new_morning_record(data, last_morning)
 
-                logging.info("We already have morning value. Saving new one as regular")
+                elif today_morning is None and last_morning is not None:
+                    # if we don't have morning record for today but we have for last_morning 5 days, we should check the diff
+                    # between last_morning morning and today morning. We should not accept diff in w greater than 2
+                    if self.check_for_morning_value(data, last_morning):
+                        logging.warn(
+                            "Weight diff is too significant to be consider as morning weight. "
+                            "Will be recorded as regular")
+                        data.morning = False
+                        self.data.save(data)
+                    else:
+                        logging.info("Saving as morning weight for today")
+                        self.process_new_morning_record(data, last_morning)
+
+                elif today_morning is not None and last_morning is not None:
+                    # in situation when we already log morning value, when we have new data, we just saving that as
+                    # regular data
+
+                    logging.info("We already have morning value. Saving new one as regular")
+                    self.process_new_regular_record(data)
+            else:
                 self.process_new_regular_record(data)
-        else:
-            self.process_new_regular_record(data)
 
-        self.data.commit()
+        if getattr(data, 'morning', False):
+            self.upload_morning(data)
+            # the index is trained from the mornings, regular records would make it drift from
+            # what a restart rebuilds
+            if user is not None:
+                self.users.add(user, data)
+        if self.aggregates is not None:
+            self.aggregates.update(data)
@@ -0,0 +1,434 @@
+import errno
+import logging
+import metrics
+import time
+
+from boarddecoder import BoardEvent, BoardDecoder, EXTENSION_REPORT, EXTENSION_REPORT_OFFSET, dummy_calibration, \
+    unpack_calibration_words
+from eventprocessor import MIN_WEIGHT
+from boardtransport import PacketRing, ReceiveStats, L2capTransport, CaptureTransport, PACKET_SIZE, \
+    CAPTURE_OUT, discover_devices
+
+CONTINUOUS_REPORTING = "04"  # Easier as string with leading zero
+REPORT_ON_CHANGE = "00"
+
+COMMAND_LIGHT = 11
+COMMAND_REPORTING = 12
+COMMAND_REQUEST_STATUS = 15
+COMMAND_REGISTER = 16
+COMMAND_READ_REGISTER = 17
+
+# input is Wii device to host
+INPUT_STATUS = 20
+INPUT_READ_DATA = 21
+
+EXTENSION_8BYTES = 32
+# end "hex" values
+
+# same input reports as raw byte values, used to dispatch on the received type byte
+REPORT_STATUS = 0x20
+REPORT_READ_DATA = 0x21
+REPORT_EXTENSION_8BYTES = 0x32
+
+# smallest valid length of each input report
+MIN_REPORT_SIZE = {REPORT_STATUS: 8,
+                   REPORT_READ_DATA: 7,
+                   REPORT_EXTENSION_8BYTES: EXTENSION_REPORT_OFFSET + 10}
+
+BUTTON_DOWN_MASK = 8
+
+BLUETOOTH_NAME = "Nintendo RVL-WBC-01"
+
+# with metrics enabled one report in this many is timed through decoding
+DECODE_SAMPLE_EVERY = 64
+
+# while the board is empty only one report in this many feeds the tare tracker
+IDLE_TARE_EVERY = 8
+
+# with idle_reporting, empty board reports (~100 per second) before reporting switches from
+# continuous to on change
+IDLE_REPORTING_AFTER = 3000
+
+# reports handled per receive_pending() call at most, so one busy board can't hold up the others
+RECEIVE_BATCH = 32
+
+# seconds disconnect() waits for the receive loop to acknowledge, the transport is closed anyway after
+DISCONNECT_TIMEOUT = 2.0
+
+
+class Wiiboard:
+    def __init__(self, events_processor, transport=None, capture=None, archive=None):
+        # Transport and status
+        # bluetooth sockets can't be reused after a failed connect, new_transport makes fresh ones
+        self.new_transport = None
+        if transport is None:
+            self.new_transport = L2capTransport
+            transport = L2capTransport()
+        self.transport = transport
+        # CaptureWriter recording everything received from and sent to the board
+        self.capture = capture
+        # SensorArchive keeping the raw sensor words of every weighing
+        self.archive = archive
+        self.ring = PacketRing()
+        self.stats = ReceiveStats()
+
+        events_processor.init_board(self)
+
+        self.processor = events_processor
+        self.calibration = dummy_calibration()
+        self.decoder = BoardDecoder(self.calibration)
+        self.calibrationRequested = False
+        # the calibration of the board at self.address was read completely
+        self.calibrated = False
+        # raw sensor sum below which less than MIN_WEIGHT is on the board, None until calibrated.
+        # after the first such report the next ones are dropped right after unpacking (idle)
+        self.idle_base = None
+        self.idle_threshold = None
+        self.idle = False
+        self.idle_reports = 0
+        # ask the board to report only on change while it is empty
+        self.idle_reporting = False
+        self.reporting_continuous = True
+        self.LED = False
+        self.address = None
+        self.buttonDown = False
+
+        self.status = "Disconnected"
+        self.lastEvent = BoardEvent(0, 0, 0, 0, False, False)
+
+    def is_connected(self):
+        return self.status == "Connected"
+
+    # Connect to the Wiiboard at bluetooth address <address>
+    # calibrate=False keeps the calibration read before, only right for the same board
+    def connect(self, address, calibrate=True):
+        if address is None:
+            logging.debug("Non existent address")
+            return
+        if self.transport.connect(address):
+            logging.debug("Connected to Wiiboard at address " + address)
+            self.status = "Connected"
+            self.address = address
+            if calibrate:
+                self.calibrated = False
+                self.calibrate()
+            use_ext = ["00", COMMAND_REGISTER, "04", "A4", "00", "40", "00"]
+            self.send(use_ext)
+            self.set_reporting_type()
+            logging.debug("Wiiboard connected")
+        else:
+            logging.debug(
+                "Could not connect to Wiiboard at address " + address)
+
+    # connect without raising, returns True when connected
+    def try_connect(self, address, calibrate=True):
+        try:
+            self.connect(address, calibrate)
+        except Exception as e:
+            logging.debug("Could not connect to Wiiboard at {}: {}".format(address, e))
+            self.status = "Disconnected"
+            self.transport.close()
+            if self.new_transport is not None:
+                self.transport = self.new_transport()
+        return self.is_connected()
+
+    # connect again after the link was lost, on new sockets. the calibration already read is
+    # kept when it is the same board
+    def reconnect(self, address):
+        self.transport.close()
+        if self.new_transport is not None:
+            self.transport = self.new_transport()
+        self.status = "Disconnected"
+        self.calibrationRequested = False
+        return self.try_connect(address, not (self.calibrated and address == self.address))
+
+    def receive(self):
+        ring = self.ring
+        buffers = ring.buffers
+        views = ring.views
+        stats = self.stats
+        recv_into = self.transport.recv_into
+        capture = self.capture
+        decode_time = None
+        if metrics.enabled():
+            decode_time = metrics.histogram("scale_decode_seconds",
+                                            "Dispatch and decode time of sampled reports")
+        if stats.started is None:
+            stats.started = time.time()
+
+        while self.status == "Connected" and not self.processor.done:
+            slot = ring.next_slot()
+            try:
+                size = recv_into(views[slot], PACKET_SIZE)
+            except (IOError, OSError) as e:
+                # bluetooth and socket errors, the link is gone
+                logging.debug("Connection to Wiiboard lost: {}".format(e))
+                size = 0
+            if size == 0:
+                logging.debug("Connection to Wiiboard closed")
+                if self.status == "Connected":
+                    self.status = "Disconnected"
+                break
+            stats.received += 1
+            stats.bytes += size
+            if capture is not None:
+                capture.write(views[slot][:size])
+            if decode_time is not None and stats.received % DECODE_SAMPLE_EVERY == 0:
+                started = time.time()
+                self.dispatch(buffers[slot], views[slot], size)
+                decode_time.observe(time.time() - started)
+            else:
+                self.dispatch(buffers[slot], views[slot], size)
+
+        stats.finished = time.time()
+        if self.status == "Disconnecting":
+            self.status = "Disconnected"
+
+    # file descriptor of the receive socket, for select()
+    def fileno(self):
+        return self.transport.fileno()
+
+    # for an event loop multiplexing several boards: handles the reports the (non-blocking)
+    # transport already has, at most <limit>, without waiting for more. Stops early when the
+    # measurement is done, the rest stays in the socket. Returns the number of reports handled
+    def receive_pending(self, limit=RECEIVE_BATCH):
+        ring = self.ring
+        stats = self.stats
+        recv_into = self.transport.recv_into
+        capture = self.capture
+        if stats.started is None:
+            stats.started = time.time()
+
+        handled = 0
+        while handled < limit and self.status == "Connected" and not self.processor.done:
+            slot = ring.next_slot()
+            try:
+                size = recv_into(ring.views[slot], PACKET_SIZE)
+            except (IOError, OSError) as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                logging.debug("Connection to Wiiboard lost: {}".format(e))
+                size = 0
+            if size == 0:
+                logging.debug("Connection to Wiiboard closed")
+                self.status = "Disconnected"
+                break
+            handled += 1
+            stats.received += 1
+            stats.bytes += size
+            if capture is not None:
+                capture.write(ring.views[slot][:size])
+            self.dispatch(ring.buffers[slot], ring.views[slot], size)
+
+        stats.finished = time.time()
+        return handled
+
+    # packet is the ring slot (bytearray) and view its memoryview, only the first size bytes are valid
+    def dispatch(self, packet, view, size):
+        if size < 2:
+            self.stats.dropped += 1
+            return
+        in_type = packet[1]
+        if size < MIN_REPORT_SIZE.get(in_type, 0):
+            self.stats.dropped += 1
+            return
+
+        if in_type == REPORT_EXTENSION_8BYTES:
+            threshold = self.idle_threshold
+            if threshold is not None:
+                buttons, raw_tr, raw_br, raw_tl, raw_bl = EXTENSION_REPORT.unpack_from(view, EXTENSION_REPORT_OFFSET)
+                if raw_tr + raw_br + raw_tl + raw_bl < threshold and not buttons:
+                    if self.idle:
+                        self.idle_report(raw_tr, raw_br, raw_tl, raw_bl)
+                        return
+                    # the first empty report still goes to the processor, it ends the measurement
+                    self.idle = True
+                    self.idle_reports = 0
+                else:
+                    self.idle = False
+                    if not self.reporting_continuous:
+                        self.set_reporting_type()
+            event = self.create_board_event(view)
+            if self.archive is not None:
+                self.archive.add(view, event.totalWeight, self.calibration)
+            self.processor.mass(event)
+            self.stats.decoded += 1
+        elif in_type == REPORT_STATUS:
+            self.set_reporting_type()
+        elif in_type == REPORT_READ_DATA:
+            if self.calibrationRequested:
+                packet_length = (packet[4] >> 4) + 1
+                self.parse_calibration_response(view[7:(7 + packet_length)])
+
+                if packet_length < 16:
+                    self.calibrationRequested = False
+        else:
+            logging.debug("ACK to data write received")
+
+    def idle_report(self, raw_tr, raw_br, raw_tl, raw_bl):
+        self.stats.idle += 1
+        self.idle_reports += 1
+        if self.idle_reports % IDLE_TARE_EVERY == 0:
+            tare = self.decoder.tare
+            if tare is not None:
+                tare.update(raw_tr, raw_br, raw_tl, raw_bl)
+                o_tr, o_br, o_tl, o_bl = tare.offsets
+                self.idle_threshold = self.idle_base + o_tr + o_br + o_tl + o_bl
+        if self.idle_reporting and self.reporting_continuous and self.idle_reports >= IDLE_REPORTING_AFTER:
+            logging.debug("Board is empty, reporting on change only")
+            self.set_reporting_type(False)
+
+    # raw sum of MIN_WEIGHT kg: every sensor's zero plus MIN_WEIGHT at the steepest calibration
+    # piece, so a smaller sum can't be MIN_WEIGHT however the weight is spread
+    def update_idle_threshold(self):
+        table = self.decoder.table
+        slopes = table.low_slope + table.high_slope
+        if not self.calibrated or not all(slopes):
+            self.idle_base = self.idle_threshold = None
+            return
+        self.idle_base = sum(table.zero) + MIN_WEIGHT / max(slopes)
+        tare = self.decoder.tare
+        self.idle_threshold = self.idle_base + (sum(tare.offsets) if tare is not None else 0)
+
+    # the receive loop acknowledges by setting Disconnected. When nothing is receiving any more (the
+    # thread died, or ended right before the handshake) nobody will, so the wait is bounded
+    def disconnect(self, timeout=DISCONNECT_TIMEOUT):
+        if self.status == "Connected":
+            self.status = "Disconnecting"
+            deadline = time.time() + timeout
+            while self.status == "Disconnecting":
+                if time.time() >= deadline:
+                    logging.warning("Receive loop did not acknowledge the disconnect, closing anyway")
+                    self.status = "Disconnected"
+                    break
+                self.wait(100)
+
+        self.transport.close()
+        if self.capture is not None:
+            self.capture.close()
+        if self.archive is not None:
+            self.archive.close()
+
+        logging.debug("WiiBoard disconnected")
+
+    # Try to discover a Wiiboard
+    def discover(self):
+        logging.debug("Press the red sync button on the board now")
+        address = None
+        bluetooth_devices = discover_devices(6)
+        for bluetooth_device in bluetooth_devices:
+            if bluetooth_device[1] == BLUETOOTH_NAME:
+                address = bluetooth_device[0]
+                logging.debug("Found Wiiboard at address " + address)
+        if address is None:
+            logging.debug("No Wiiboards discovered.")
+        return address
+
+    # data is the whole 0x32 report, buttons and sensors are unpacked in one go by the decoder
+    def create_board_event(self, data, offset=EXTENSION_REPORT_OFFSET):
+        state, top_left, top_right, bottom_left, bottom_right = self.decoder.decode(data, offset)
+        button_pressed = False
+        button_released = False
+
+        if state == BUTTON_DOWN_MASK:
+            button_pressed = True
+            if not self.buttonDown:
+                logging.debug("Button pressed")
+                self.buttonDown = True
+
+        if not button_pressed:
+            if self.lastEvent.buttonPressed:
+                button_released = True
+                self.buttonDown = False
+                logging.debug("Button released")
+
+        return BoardEvent(top_left, top_right, bottom_left, bottom_right,
+                          button_pressed, button_released)
+
+    def calc_mass(self, raw, pos):
+        return self.decoder.table.mass(raw, pos)
+
+    def get_last_event(self):
+        return self.lastEvent
+
+    def get_led(self):
+        return self.LED
+
+    def parse_calibration_response(self, data):
+        if len(data) == 16:
+            words = unpack_calibration_words(data, 8)
+            self.calibration[0][:] = words[0:4]
+            self.calibration[1][:] = words[4:8]
+        elif len(data) < 16:
+            self.calibration[2][:] = unpack_calibration_words(data, 4)
+            # second (last) block received, calibration is complete
+            self.decoder.update_calibration(self.calibration)
+            self.calibrated = True
+            self.update_idle_threshold()
+
+    # Send <data> to the Wiiboard
+    # <data> should be an array of strings, each string representing a single hex byte
+    def send(self, data):
+        if self.status != "Connected":
+            return
+        data[0] = "52"
+
+        send_data = ""
+        for byte in data:
+            byte = str(byte)
+            send_data += byte.decode("hex")
+
+        self.transport.send(send_data)
+        if self.capture is not None:
+            self.capture.write(send_data, CAPTURE_OUT)
+
+    # Turns the power button LED on if light is True, off if False
+    # The board must be connected in order to set the light
+    def set_light(self, light):
+        if light:
+            val = "10"
+        else:
+            val = "00"
+
+        message = ["00", COMMAND_LIGHT, val]
+        self.send(message)
+        self.LED = light
+
+    def calibrate(self):
+        message = ["00", COMMAND_READ_REGISTER,
+                   "04", "A4", "00", "24", "00", "18"]
+        self.send(message)
+        self.calibrationRequested = True
+
+    # continuous: a report every ~10 ms, otherwise only when the sensor words change
+    def set_reporting_type(self, continuous=True):
+        data = ["00", COMMAND_REPORTING, CONTINUOUS_REPORTING if continuous else REPORT_ON_CHANGE, EXTENSION_8BYTES]
+        self.send(data)
+        self.reporting_continuous = continuous
+
+    def wait(self, millis):
+        time.sleep(millis / 1000.0)
+
+
+# last connected board address, lets the next start connect without a discovery scan
+def load_address(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read().strip() or None
+    except IOError:
+        return None
+
+
+def save_address(path, address):
+    with open(path, 'wb') as f:
+        f.write(address)
+
+
+class ReplayWiiboard(Wiiboard):
+    # board stand-in playing back a capture recorded with Wiiboard(..., capture=CaptureWriter(path)),
+    # calibration included. receive() ends when the capture does
+    def __init__(self, events_processor, path, realtime=False):
+        Wiiboard.__init__(self, events_processor, CaptureTransport(path, realtime))
+
+    def discover(self):
+        return "00:00:00:00:00:00"